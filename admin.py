@@ -5,6 +5,7 @@ import pandas as pd
 import time
 from datetime import datetime
 import audit
+import auth
 import os
 from PIL import Image
 
@@ -73,6 +74,9 @@ def create_admin_form():
                 }
             )
             
+            # Admin list changed, so the cached admin check is stale
+            auth.invalidate_admin_cache()
+            
             # Record in audit log
             audit.record_activity(None, "Admin Created", f"Initial admin account created: {username}")
             
@@ -107,8 +111,8 @@ def admin_settings():
             st.info("No users found.")
         else:
             # Format dates
-            users_df['created_at'] = pd.to_datetime(users_df['created_at']).dt.strftime('%Y-%m-%d %H:%M')
-            users_df['last_login'] = pd.to_datetime(users_df['last_login']).dt.strftime('%Y-%m-%d %H:%M')
+            users_df['created_at'] = users_df['created_at'].dt.strftime('%Y-%m-%d %H:%M')
+            users_df['last_login'] = users_df['last_login'].dt.strftime('%Y-%m-%d %H:%M')
             
             st.dataframe(users_df, use_container_width=True)
         
@@ -167,6 +171,8 @@ def admin_settings():
                                 }
                             )
                             
+                            auth.invalidate_admin_cache()
+                            
                             # Record in audit log
                             audit.record_activity(
                                 st.session_state.user_id, 
@@ -286,6 +292,7 @@ def admin_settings():
                                         "Users",
                                         {"user_id": selected_user_id}
                                     )
+                                    auth.invalidate_admin_cache()
                                     
                                     audit.record_activity(
                                         st.session_state.user_id,
@@ -300,8 +307,113 @@ def admin_settings():
     
     with tab2:
         st.subheader("System Settings")
-        st.info("System settings functionality will be implemented in future updates.")
+
+        # Query performance
+        st.write("#### Query Performance")
+
+        col1, col2 = st.columns(2)
+
+        with col1:
+            order_by = st.selectbox(
+                "Rank By",
+                ["total_time", "max_time", "avg_time", "calls", "rows", "errors"],
+                format_func=lambda x: x.replace('_', ' ').title()
+            )
+
+        with col2:
+            top_n = st.number_input("Top N", min_value=5, max_value=100, value=20, step=5)
+
+        query_stats = database.get_query_stats(top_n=int(top_n), order_by=order_by)
+
+        if not query_stats:
+            st.info("No queries have been profiled yet.")
+        else:
+            stats_df = pd.DataFrame(query_stats)
+
+            # Show timings in milliseconds
+            for col in ['total_time', 'max_time', 'avg_time']:
+                stats_df[col] = (stats_df[col] * 1000).round(2)
+            stats_df['callers'] = stats_df['callers'].apply(', '.join)
+
+            stats_df = stats_df[['fingerprint', 'calls', 'total_time', 'avg_time', 'max_time', 'rows', 'errors', 'slow', 'callers']]
+            stats_df.columns = ['Query', 'Calls', 'Total (ms)', 'Avg (ms)', 'Max (ms)', 'Rows', 'Errors', 'Slow', 'Callers']
+
+            st.dataframe(stats_df, use_container_width=True)
+
+        if st.button("Reset Query Statistics"):
+            database.reset_query_stats()
+            st.rerun()
+
+        # Slow query log
+        st.write(f"#### Slow Queries (over {database.SLOW_QUERY_THRESHOLD * 1000:.0f} ms)")
+
+        slow_queries = database.read_slow_query_log(limit=50)
+
+        if not slow_queries:
+            st.info("No slow queries logged.")
+        else:
+            for entry in slow_queries:
+                with st.expander(f"{entry['logged_at']} - {entry['duration_ms']} ms - {entry['caller']}"):
+                    st.code(entry['fingerprint'], language="sql")
+                    st.write(f"**Rows:** {entry['rows']}")
+                    if entry['plan']:
+                        st.write("**Query Plan:**")
+                        st.code('\n'.join(entry['plan']))
+
+        # Trigger-maintained dashboard counters
+        st.write("#### Dashboard Counters")
+
+        col1, col2 = st.columns(2)
+
+        with col1:
+            if st.button("Verify Counters"):
+                drift = database.verify_counters()
+
+                if not drift:
+                    st.success("All counters match their tables.")
+                else:
+                    st.warning(f"{len(drift)} counter(s) have drifted. Rebuild them to reconcile.")
+                    st.dataframe(
+                        pd.DataFrame(drift, columns=['Counter', 'Bucket', 'Stored', 'Expected']),
+                        use_container_width=True
+                    )
+
+        with col2:
+            if st.button("Rebuild Counters"):
+                counter_rows = database.rebuild_counters()
+                audit.record_activity(st.session_state.user_id, "Counters Rebuilt", f"Rebuilt {counter_rows} counter rows")
+                st.success(f"Rebuilt {counter_rows} counter rows.")
+
+        # Daily rollups read by the reports page
+        st.write("#### Report Rollups")
+
+        if st.button("Backfill Rollups"):
+            written = database.backfill_rollups()
+            audit.record_activity(st.session_state.user_id, "Rollups Backfilled", f"Rebuilt {sum(written.values())} rollup rows")
+            st.success("Rollups rebuilt from the source tables.")
+            st.dataframe(
+                pd.DataFrame(list(written.items()), columns=['Rollup', 'Rows']),
+                use_container_width=True
+            )
         
     with tab3:
         st.subheader("Backup & Restore")
-        st.info("Backup and restore functionality will be implemented in future updates.")
+
+        # Full table export, streamed so large tables such as AuditLogs stay in constant memory
+        st.write("#### Export Table")
+
+        tables = [row[0] for row in database.fetch_all(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        )]
+
+        export_table = st.selectbox("Table", tables)
+
+        if st.button("Export Table to CSV"):
+            st.download_button(
+                label="Download CSV",
+                data=database.export_csv(f"SELECT * FROM {export_table}"),
+                file_name=f"{export_table}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+                mime="text/csv"
+            )
+
+        st.info("Restore functionality will be implemented in future updates.")
@@ -0,0 +1,270 @@
+import database
+from datetime import datetime
+import os
+import sqlite3
+import threading
+import time
+from urllib.request import pathname2url
+
+# Reporting copy of the live database, so long report scans never touch the file clinics write to
+MIRROR_PATH = os.environ.get(
+    'HOSPITAL_ANALYTICS_DB_PATH', os.path.splitext(database.DB_PATH)[0] + '_analytics.db'
+)
+MIRROR_INTERVAL = int(os.environ.get('HOSPITAL_ANALYTICS_INTERVAL', '60'))  # Seconds between syncs; 0 disables
+MIRROR_CACHE_SIZE = -262144  # Sync page cache in KiB; re-copied rows land on random pages of every index
+
+# Indexes only the mirror carries: they cover report aggregates but would slow every clinic write
+MIRROR_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS mirror_billing_service ON Billing (service_description, amount)",
+    "CREATE INDEX IF NOT EXISTS mirror_billing_insurance ON Billing (insurance_provider, amount)",
+    "CREATE INDEX IF NOT EXISTS mirror_appointments_status ON Appointments (status, appointment_date, doctor_id)",
+    "CREATE INDEX IF NOT EXISTS mirror_appointments_doctor_status ON Appointments (doctor_id, status)",
+]
+
+# Live tables never copied: the change log itself and full-text indexes, which reports do not use
+MIRROR_SKIPPED_TABLES = ('MirrorChanges',)
+
+# Background sync worker
+_sync_lock = threading.Lock()  # Held for the whole of a sync
+_worker = None
+_worker_lock = threading.Lock()
+_mirror_stats = {"syncs": 0, "rebuilds": 0, "failures": 0, "rows_copied": 0, "last_sync_time": 0.0}
+
+def _open_mirror():
+    """Open the mirror for writing with the live database attached read-only as "live"."""
+    conn = sqlite3.connect(MIRROR_PATH, isolation_level=None, uri=True, timeout=database.BUSY_TIMEOUT)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = {MIRROR_CACHE_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute(
+        "ATTACH DATABASE ? AS live",
+        (f"file:{pathname2url(os.path.abspath(database.DB_PATH))}?mode=ro",)
+    )
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS MirrorState (
+            name TEXT PRIMARY KEY,
+            value
+        )
+    """)
+    return conn
+
+def _mirrored_tables(conn):
+    """Return the live tables the mirror copies, as (name, create sql) pairs."""
+    rows = conn.execute(
+        "SELECT name, sql FROM live.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+    ).fetchall()
+    
+    # FTS5 tables and the shadow tables that store them
+    virtual = [name for name, sql in rows if sql.upper().startswith('CREATE VIRTUAL TABLE')]
+    
+    return [
+        (name, sql) for name, sql in rows
+        if name not in MIRROR_SKIPPED_TABLES
+        and not any(name == table or name.startswith(f"{table}_") for table in virtual)
+    ]
+
+def _rebuild(conn):
+    """Replace every mirrored table with a fresh copy of the live one (caller holds the transaction)."""
+    for (name,) in conn.execute(
+        "SELECT name FROM main.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' AND name != 'MirrorState'"
+    ).fetchall():
+        conn.execute(f'DROP TABLE main."{name}"')
+    
+    tables = _mirrored_tables(conn)
+    for name, sql in tables:
+        conn.execute(sql)
+        conn.execute(f'INSERT INTO main."{name}" SELECT * FROM live."{name}"')
+    
+    # Indexes are built after the copy, which is faster than maintaining them row by row
+    names = [name for name, _ in tables]
+    for (sql,) in conn.execute(
+        f"""
+        SELECT sql FROM live.sqlite_master
+        WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({', '.join('?' * len(names))})
+        """,
+        names
+    ).fetchall():
+        conn.execute(sql)
+    for sql in MIRROR_INDEXES:
+        conn.execute(sql)
+    
+    # Planner statistics, so the mirror-only indexes are used where they pay off
+    conn.execute("PRAGMA main.analysis_limit = 1000")
+    conn.execute("ANALYZE main")
+
+def _copy_differences(conn, name, sql):
+    """Make a mirror table match the live one by writing only the rows that differ (caller holds the transaction)."""
+    if 'WITHOUT ROWID' in sql.upper():
+        # Rows are identified by their primary key, in key order
+        columns = sorted(conn.execute(f'PRAGMA live.table_info("{name}")').fetchall(), key=lambda info: info[5])
+        key = key_column = ', '.join(f'"{column[1]}"' for column in columns if column[5])
+        select = '*'
+    else:
+        key, key_column = 'rowid', 'mirror_rowid'
+        select = 'rowid AS mirror_rowid, *'
+    
+    # EXCEPT compares whole rows, treating NULLs as equal; a changed row is deleted, then re-inserted
+    stale = f'SELECT {key_column} FROM (SELECT {select} FROM main."{name}" EXCEPT SELECT {select} FROM live."{name}")'
+    fresh = f'SELECT {key_column} FROM (SELECT {select} FROM live."{name}" EXCEPT SELECT {select} FROM main."{name}")'
+    
+    conn.execute(f'DELETE FROM main."{name}" WHERE ({key}) IN ({stale})')
+    conn.execute(f'INSERT INTO main."{name}" SELECT * FROM live."{name}" WHERE ({key}) IN ({fresh})')
+
+def _apply_changes(conn, applied_seq, max_seq):
+    """Copy rows inserted, updated or deleted since the last sync (caller holds the transaction)."""
+    conn.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS mirror_changed (
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            PRIMARY KEY (table_name, row_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("DELETE FROM temp.mirror_changed")
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO temp.mirror_changed (table_name, row_id)
+        SELECT table_name, row_id FROM live.MirrorChanges WHERE seq > ? AND seq <= ?
+        """,
+        (applied_seq, max_seq)
+    )
+    
+    for name, sql in _mirrored_tables(conn):
+        if name not in database.MIRROR_TRACKED_TABLES:
+            # Untracked tables are small rollups and settings, so comparing them whole is cheap
+            _copy_differences(conn, name, sql)
+            continue
+        
+        # New rows first, then re-copy changed rows, which may include some of those new rows
+        newest = conn.execute(f'SELECT COALESCE(MAX(rowid), 0) FROM main."{name}"').fetchone()[0]
+        conn.execute(f'INSERT INTO main."{name}" SELECT * FROM live."{name}" WHERE rowid > ?', (newest,))
+        
+        changed = f"SELECT row_id FROM temp.mirror_changed WHERE table_name = '{name}'"
+        conn.execute(f'DELETE FROM main."{name}" WHERE rowid IN ({changed})')
+        conn.execute(f'INSERT INTO main."{name}" SELECT * FROM live."{name}" WHERE rowid IN ({changed})')
+
+def sync_mirror():
+    """Bring the analytics mirror up to date with the live database; returns the number of rows written.
+    
+    The first sync, and any sync after the live schema changes or the change
+    log was trimmed past what the mirror applied, rebuilds the mirror. Later
+    syncs copy rows past each tracked table's highest rowid, re-copy the rows
+    MirrorChanges logged as updated or deleted, and write the rows of the small
+    untracked tables that differ. Everything is read from one live snapshot and
+    committed as one mirror transaction, so readers never see a half sync.
+    """
+    with _sync_lock:
+        started = time.monotonic()
+        conn = _open_mirror()
+        
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            state = dict(conn.execute("SELECT name, value FROM MirrorState").fetchall())
+            before = conn.total_changes
+            
+            schema_version = conn.execute("PRAGMA live.schema_version").fetchone()[0]
+            applied_seq = state.get('applied_seq', 0)
+            
+            # The log's sequence only grows, so a lower one means the live file was replaced
+            row = conn.execute("SELECT seq FROM live.sqlite_sequence WHERE name = 'MirrorChanges'").fetchone()
+            max_seq = row[0] if row else 0
+            
+            # Sequence numbers have no gaps, so a missing next entry means the log overflowed
+            trimmed = max_seq > applied_seq and conn.execute(
+                "SELECT 1 FROM live.MirrorChanges WHERE seq = ?", (applied_seq + 1,)
+            ).fetchone() is None
+            
+            rebuild = state.get('schema_version') != schema_version or max_seq < applied_seq or trimmed
+            if rebuild:
+                _rebuild(conn)
+            else:
+                _apply_changes(conn, applied_seq, max_seq)
+            
+            rows = conn.total_changes - before
+            conn.executemany(
+                "INSERT OR REPLACE INTO MirrorState (name, value) VALUES (?, ?)",
+                [
+                    ('schema_version', schema_version),
+                    ('applied_seq', max_seq),
+                    ('synced_at', datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
+                    ('sync_seconds', time.monotonic() - started),
+                ]
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        
+        # Logged changes are now in the mirror; trim them from the live file
+        if max_seq and (rebuild or max_seq > applied_seq):
+            database.execute_query("DELETE FROM MirrorChanges WHERE seq <= ?", (max_seq,))
+        
+        with _worker_lock:
+            _mirror_stats["syncs"] += 1
+            _mirror_stats["rebuilds"] += 1 if rebuild else 0
+            _mirror_stats["rows_copied"] += rows
+            _mirror_stats["last_sync_time"] = time.monotonic() - started
+        
+        return rows
+
+def get_mirror_status():
+    """Return when the mirror last synced and how many logged changes it has not applied, or None if it is not built."""
+    if not os.path.exists(MIRROR_PATH):
+        return None
+    
+    # A short-lived connection: page renders run on threads that come and go
+    try:
+        conn = database.get_connection(read_only=True, path=MIRROR_PATH)
+        try:
+            state = dict(conn.execute("SELECT name, value FROM MirrorState").fetchall())
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    
+    if 'synced_at' not in state:
+        return None
+    
+    pending = database.fetch_one(
+        "SELECT COUNT(*) FROM MirrorChanges WHERE seq > ?", (state.get('applied_seq', 0),)
+    )[0]
+    synced_at = datetime.strptime(state['synced_at'], '%Y-%m-%d %H:%M:%S')
+    
+    return {
+        "synced_at": synced_at,
+        "age_seconds": (datetime.now() - synced_at).total_seconds(),
+        "pending_changes": pending,
+        "sync_seconds": state.get('sync_seconds', 0.0),
+    }
+
+def start_mirror():
+    """Start the background mirror sync unless it is disabled or already running."""
+    global _worker
+    
+    if MIRROR_INTERVAL <= 0:
+        return
+    
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run_mirror, name="analytics-mirror", daemon=True)
+            _worker.start()
+
+def _run_mirror():
+    """Sync the mirror every MIRROR_INTERVAL seconds, keeping the last good copy if a sync fails."""
+    while True:
+        try:
+            sync_mirror()
+        except Exception as e:
+            with _worker_lock:
+                _mirror_stats["failures"] += 1
+            print(f"Error syncing analytics mirror: {e}")
+        
+        time.sleep(MIRROR_INTERVAL)
+
+def get_mirror_stats():
+    """Return counters for mirror syncs."""
+    with _worker_lock:
+        return dict(_mirror_stats)
@@ -18,9 +18,18 @@ import staff
 import reports
 import audit
 import utils
+import dashboard
+import report_store
+import analytics
 
-# Initialize database
-database.init_db()
+# Initialize database once per process rather than on every rerun
+database.bootstrap_db()
+
+# Keep the saved report snapshots fresh in the background
+report_store.start_scheduler()
+
+# Keep the analytics mirror that reports can read in step with the live database
+analytics.start_mirror()
 
 # Set page config
 st.set_page_config(
@@ -65,6 +74,8 @@ if 'admin_exists' not in st.session_state:
     st.session_state.admin_exists = False
 if 'login_time' not in st.session_state:
     st.session_state.login_time = None
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = None
 
 # Check if admin exists
 st.session_state.admin_exists = auth.check_admin_exists()
@@ -88,9 +99,9 @@ if not st.session_state.logged_in:
         with tab2:
             auth.register_form()
 else:
-    # Record user activity
-    if st.session_state.login_time:
-        audit.record_activity(st.session_state.user_id, "Active", f"Session duration: {utils.format_time_difference(st.session_state.login_time, datetime.now())}")
+    # Record a throttled session heartbeat instead of an audit row per rerun
+    if st.session_state.session_id:
+        audit.record_heartbeat(st.session_state.session_id)
     
     # Sidebar with navigation
     with st.sidebar:
@@ -119,13 +130,13 @@ else:
         if st.session_state.role == "admin":
             selected = st.radio(
                 "Navigation", 
-                ["Dashboard", "Patients", "Appointments", "Billing", "Inventory", 
+                ["Dashboard", "Patients", "Clinical Search", "Appointments", "Billing", "Inventory", 
                  "Pharmacy", "Staff Management", "Reports", "Audit Logs", "Admin Settings"]
             )
         elif st.session_state.role == "doctor":
             selected = st.radio(
                 "Navigation", 
-                ["Dashboard", "My Patients", "Appointments", "Medical Records"]
+                ["Dashboard", "My Patients", "Appointments", "Medical Records", "Clinical Search"]
             )
         elif st.session_state.role == "nurse":
             selected = st.radio(
@@ -160,36 +171,34 @@ else:
     if selected == "Dashboard":
         st.header("Dashboard")
         
+        # All metrics come from one shared snapshot, refreshed in the background
+        snapshot = dashboard.get_snapshot()
+        st.caption(f"Updated {snapshot['taken_at'].strftime('%H:%M:%S')}")
+        
         # Create dashboard layout
         col1, col2, col3 = st.columns(3)
         
         with col1:
             st.subheader("Patient Statistics")
-            patient_count = patient.get_patient_count()
-            st.metric("Total Patients", patient_count)
+            st.metric("Total Patients", snapshot['patient_count'])
             
             # Today's appointments
-            today_appointments = appointment.get_appointments_count_for_today()
-            st.metric("Today's Appointments", today_appointments)
+            st.metric("Today's Appointments", snapshot['today_appointments'])
         
         with col2:
             st.subheader("Inventory Status")
-            low_stock_count = inventory.get_low_stock_count()
-            st.metric("Low Stock Items", low_stock_count)
+            st.metric("Low Stock Items", snapshot['low_stock_count'])
+            st.metric("Low Stock Medications", snapshot['low_stock_medications'])
             
             # Today's revenue
-            today_revenue = billing.get_revenue_for_today()
-            st.metric("Today's Revenue", utils.format_currency(today_revenue))
+            st.metric("Today's Revenue", utils.format_currency(snapshot['today_revenue']))
         
         with col3:
             st.subheader("Staff Status")
-            active_staff = staff.get_active_staff_count()
-            total_staff = staff.get_total_staff_count()
-            st.metric("Active Staff", f"{active_staff}/{total_staff}")
+            st.metric("Active Staff", f"{snapshot['active_staff']}/{snapshot['total_staff']}")
             
             # Pending prescriptions
-            pending_prescriptions = pharmacy.get_pending_prescriptions_count()
-            st.metric("Pending Prescriptions", pending_prescriptions)
+            st.metric("Pending Prescriptions", snapshot['pending_prescriptions'])
         
         # Recent activities - Only visible to admin users
         if st.session_state.role == "admin":
@@ -216,6 +225,9 @@ else:
     elif selected == "Medical Records":
         patient.medical_records()
         
+    elif selected == "Clinical Search":
+        patient.clinical_search()
+        
     elif selected == "Billing":
         billing.billing_management()
         
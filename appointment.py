@@ -4,6 +4,7 @@ import pandas as pd
 from datetime import datetime, timedelta
 import time
 import audit
+import utils
 
 def get_appointments_count_for_today():
     """Get the count of appointments scheduled for today."""
@@ -37,7 +38,8 @@ def appointment_management():
                 doctor_filter = st.selectbox(
                     "Doctor",
                     ["All"] + [row[0] for row in database.fetch_all(
-                        "SELECT full_name FROM Users WHERE role = 'doctor' ORDER BY full_name"
+                        "SELECT full_name FROM Users WHERE role = 'doctor' ORDER BY full_name",
+                        cache=True
                     )]
                 )
             else:
@@ -87,16 +89,19 @@ def appointment_management():
         if where_clauses:
             query += " WHERE " + " AND ".join(where_clauses)
         
-        query += " ORDER BY a.appointment_date, a.appointment_time"
-        
-        # Execute query
-        appointments_df = database.query_to_dataframe(query, params)
+        # Fetch the current page, ordered by time with the ID as a tiebreaker for paging
+        appointments_df = utils.keyset_pager(
+            "appointment_list",
+            query,
+            params,
+            [("appointment_date", False), ("appointment_time", False), ("appointment_id", False)]
+        )
         
         if appointments_df.empty:
             st.info("No appointments found matching your criteria.")
         else:
             # Format dates and times
-            appointments_df['appointment_date'] = pd.to_datetime(appointments_df['appointment_date']).dt.strftime('%Y-%m-%d')
+            appointments_df['appointment_date'] = appointments_df['appointment_date'].dt.strftime('%Y-%m-%d')
             
             # Rename columns for display
             display_df = appointments_df.rename(columns={
@@ -243,37 +248,21 @@ def appointment_management():
                     
                     # Handle appointment edit
                     if hasattr(st.session_state, 'edit_appointment') and st.session_state.edit_appointment == appointment_id:
-                        with st.form("edit_appointment_form"):
-                            # Get patient list
-                            patients_df = database.query_to_dataframe(
-                                "SELECT patient_id, first_name || ' ' || last_name as patient_name FROM Patients WHERE status = 'active'"
+                        # Patient and doctor search sit outside the form so the matches update as the user types
+                        col1, col2 = st.columns(2)
+                        
+                        with col1:
+                            selected_patient = utils.entity_picker(
+                                "Patient", "patient", f"edit_appointment_patient_{appointment_id}",
+                                default=appointment[1], status="active"
                             )
-                            patient_options = {row['patient_id']: row['patient_name'] for _, row in patients_df.iterrows()}
-                            
-                            # Get doctor list
-                            doctors_df = database.query_to_dataframe(
-                                "SELECT user_id, full_name FROM Users WHERE role = 'doctor'"
+                        
+                        with col2:
+                            selected_doctor = utils.entity_picker(
+                                "Doctor", "doctor", f"edit_appointment_doctor_{appointment_id}", default=appointment[3]
                             )
-                            doctor_options = {row['user_id']: row['full_name'] for _, row in doctors_df.iterrows()}
-                            
-                            col1, col2 = st.columns(2)
-                            
-                            with col1:
-                                selected_patient = st.selectbox(
-                                    "Patient",
-                                    options=list(patient_options.keys()),
-                                    format_func=lambda x: patient_options[x],
-                                    index=list(patient_options.keys()).index(appointment[1]) if appointment[1] in patient_options else 0
-                                )
-                            
-                            with col2:
-                                selected_doctor = st.selectbox(
-                                    "Doctor",
-                                    options=list(doctor_options.keys()),
-                                    format_func=lambda x: doctor_options[x],
-                                    index=list(doctor_options.keys()).index(appointment[3]) if appointment[3] in doctor_options else 0
-                                )
-                            
+                        
+                        with st.form("edit_appointment_form"):
                             col1, col2 = st.columns(2)
                             
                             with col1:
@@ -293,7 +282,9 @@ def appointment_management():
                             
                             edit_appointment_submitted = st.form_submit_button("Update Appointment")
                             
-                            if edit_appointment_submitted:
+                            if edit_appointment_submitted and (selected_patient is None or selected_doctor is None):
+                                st.error("Please select a patient and a doctor")
+                            elif edit_appointment_submitted:
                                 # Animation
                                 with st.spinner("Updating appointment..."):
                                     time.sleep(1)  # Simple animation delay
@@ -340,49 +331,22 @@ def appointment_management():
             if patient_details:
                 st.info(f"Scheduling appointment for: {patient_details[0]}")
         
+        # Patient and doctor search sit outside the form so the matches update as the user types
+        col1, col2 = st.columns(2)
+        
+        with col1:
+            # Patient selection (if not already selected)
+            if patient_id_to_schedule is None:
+                selected_patient = utils.entity_picker("Patient*", "patient", "schedule_appointment_patient", status="active")
+            else:
+                selected_patient = patient_id_to_schedule
+        
+        with col2:
+            selected_doctor = utils.entity_picker("Doctor*", "doctor", "schedule_appointment_doctor")
+        
         with st.form("schedule_appointment_form"):
             col1, col2 = st.columns(2)
             
-            with col1:
-                # Patient selection (if not already selected)
-                if patient_id_to_schedule is None:
-                    # Get patient list
-                    patients_df = database.query_to_dataframe(
-                        "SELECT patient_id, first_name || ' ' || last_name as patient_name FROM Patients WHERE status = 'active'"
-                    )
-                    patient_options = {row['patient_id']: row['patient_name'] for _, row in patients_df.iterrows()}
-                    
-                    # Add a placeholder
-                    patient_options[0] = "Select a patient"
-                    
-                    selected_patient = st.selectbox(
-                        "Patient*",
-                        options=list(patient_options.keys()),
-                        format_func=lambda x: patient_options[x],
-                        index=0
-                    )
-                else:
-                    selected_patient = patient_id_to_schedule
-            
-            with col2:
-                # Doctor selection
-                doctors_df = database.query_to_dataframe(
-                    "SELECT user_id, full_name FROM Users WHERE role = 'doctor'"
-                )
-                doctor_options = {row['user_id']: row['full_name'] for _, row in doctors_df.iterrows()}
-                
-                # Add a placeholder
-                doctor_options[0] = "Select a doctor"
-                
-                selected_doctor = st.selectbox(
-                    "Doctor*",
-                    options=list(doctor_options.keys()),
-                    format_func=lambda x: doctor_options[x],
-                    index=0
-                )
-            
-            col1, col2 = st.columns(2)
-            
             with col1:
                 appointment_date = st.date_input("Appointment Date*", min_value=datetime.now().date())
             
@@ -395,7 +359,7 @@ def appointment_management():
             schedule_submitted = st.form_submit_button("Schedule Appointment")
             
             if schedule_submitted:
-                if (patient_id_to_schedule is None and selected_patient == 0) or selected_doctor == 0:
+                if selected_patient is None or selected_doctor is None:
                     st.error("Please select both a patient and a doctor.")
                 else:
                     # Check for scheduling conflicts
@@ -489,7 +453,6 @@ def appointment_management():
             st.info(f"No appointments scheduled for the week of {start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')}.")
         else:
             # Group appointments by date
-            appointments_df['appointment_date'] = pd.to_datetime(appointments_df['appointment_date'])
             dates = appointments_df['appointment_date'].dt.date.unique()
             
             # Display appointments for each day
@@ -3,23 +3,152 @@ import database
 import pandas as pd
 from datetime import datetime
 import time
+import os
+import queue
+import threading
+import atexit
+
+# Minimum seconds between session heartbeat writes
+HEARTBEAT_INTERVAL = int(os.environ.get('HOSPITAL_HEARTBEAT_INTERVAL', '60'))
+
+# Most rows shown on screen; CSV exports include everything
+DISPLAY_LIMIT = 1000
+
+# Background audit writer settings
+AUDIT_QUEUE_SIZE = 10000
+AUDIT_BATCH_SIZE = 500
+
+# Background audit writer state
+_audit_queue = queue.Queue(maxsize=AUDIT_QUEUE_SIZE)
+_audit_lock = threading.Lock()
+_audit_worker = None
+_audit_stats = {
+    "enqueued": 0,
+    "written": 0,
+    "dropped": 0,
+    "batches": 0,
+    "blocked": 0,
+    "max_depth": 0,
+}
 
 def record_activity(user_id, activity, details=None):
     """Record user activity in the audit log."""
+    _start_audit_writer()
+    
+    event = (user_id, activity, details or "", datetime.now())
+    
+    # Queue for the background writer, blocking the caller only when the queue is full
+    try:
+        _audit_queue.put_nowait(event)
+    except queue.Full:
+        with _audit_lock:
+            _audit_stats["blocked"] += 1
+        _audit_queue.put(event)
+    
+    with _audit_lock:
+        _audit_stats["enqueued"] += 1
+        _audit_stats["max_depth"] = max(_audit_stats["max_depth"], _audit_queue.qsize())
+
+def _start_audit_writer():
+    """Start the background audit writer thread if it is not running."""
+    global _audit_worker
+    
+    with _audit_lock:
+        if _audit_worker is None or not _audit_worker.is_alive():
+            _audit_worker = threading.Thread(target=_audit_writer, name="audit-writer", daemon=True)
+            _audit_worker.start()
+
+def _audit_writer():
+    """Drain the audit queue, writing everything waiting in one transaction per batch."""
+    while True:
+        batch = [_audit_queue.get()]
+        
+        while len(batch) < AUDIT_BATCH_SIZE:
+            try:
+                batch.append(_audit_queue.get_nowait())
+            except queue.Empty:
+                break
+        
+        events = [event for event in batch if event is not None]
+        if events:
+            _write_audit_batch(events)
+        
+        for _ in batch:
+            _audit_queue.task_done()
+        
+        # A None in the queue asks the writer to stop
+        if len(events) < len(batch):
+            return
+
+def _write_audit_batch(events):
+    """Insert a batch of audit events as one statement through the database's single writer."""
+    placeholders = ', '.join(['(?, ?, ?, ?)'] * len(events))
+    
+    try:
+        # The writer commits it alongside other queued writes and retries while the database is busy
+        database.execute_query(
+            f"INSERT INTO AuditLogs (user_id, activity, details, timestamp) VALUES {placeholders}",
+            [value for event in events for value in event]
+        )
+    except Exception as e:
+        print(f"Error writing audit log batch: {e}")
+        with _audit_lock:
+            _audit_stats["dropped"] += len(events)
+        return
+    
+    with _audit_lock:
+        _audit_stats["written"] += len(events)
+        _audit_stats["batches"] += 1
+
+def flush_audit_log():
+    """Block until every queued audit event has been written."""
+    if _audit_queue.unfinished_tasks:
+        _start_audit_writer()
+        _audit_queue.join()
+
+def shutdown_audit_writer(timeout=10):
+    """Write any pending audit events and stop the background writer."""
+    global _audit_worker
+    
+    with _audit_lock:
+        worker = _audit_worker
+        _audit_worker = None
+    
+    if worker is not None and worker.is_alive():
+        _audit_queue.put(None)
+        worker.join(timeout)
+
+atexit.register(shutdown_audit_writer)
+
+def get_audit_writer_stats():
+    """Return counters for the background audit writer, including current queue depth."""
+    with _audit_lock:
+        stats = dict(_audit_stats)
+    
+    stats["queued"] = _audit_queue.qsize()
+    return stats
+
+def record_heartbeat(session_id):
+    """Update a session's last-seen time, writing at most once per HEARTBEAT_INTERVAL."""
+    now = time.monotonic()
+    last_heartbeat = st.session_state.get('last_heartbeat')
+    
+    if last_heartbeat is not None and now - last_heartbeat < HEARTBEAT_INTERVAL:
+        return False
+    
+    st.session_state.last_heartbeat = now
     
-    # Insert into AuditLogs table
-    database.insert_record(
-        "AuditLogs",
-        {
-            "user_id": user_id,
-            "activity": activity,
-            "details": details or "",
-            "timestamp": datetime.now()
-        }
+    database.update_record(
+        "UserSessions",
+        {"last_seen": datetime.now()},
+        {"session_id": session_id}
     )
+    
+    return True
 
 def get_recent_activities(limit=10):
     """Get recent activities from the audit log."""
+    flush_audit_log()
     
     # Query recent activities
     activities = database.query_to_dataframe(
@@ -40,7 +169,7 @@ def get_recent_activities(limit=10):
     
     # Format timestamp
     if not activities.empty:
-        activities['timestamp'] = pd.to_datetime(activities['timestamp']).dt.strftime('%Y-%m-%d %H:%M:%S')
+        activities['timestamp'] = activities['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S')
     
     return activities
 
@@ -48,6 +177,9 @@ def audit_logs():
     """Audit logs page."""
     st.header("Audit Logs")
     
+    # Make sure queued events show up in the log
+    flush_audit_log()
+    
     tab1, tab2 = st.tabs(["Activity Log", "User Sessions"])
     
     with tab1:
@@ -60,7 +192,8 @@ def audit_logs():
             user_filter = st.selectbox(
                 "User",
                 ["All Users"] + [row[0] for row in database.fetch_all(
-                    "SELECT DISTINCT username FROM Users ORDER BY username"
+                    "SELECT DISTINCT username FROM Users ORDER BY username",
+                    cache=True
                 ) or []]
             )
         
@@ -68,7 +201,8 @@ def audit_logs():
             activity_filter = st.selectbox(
                 "Activity Type",
                 ["All Activities"] + sorted(set([row[0] for row in database.fetch_all(
-                    "SELECT DISTINCT activity FROM AuditLogs ORDER BY activity"
+                    "SELECT DISTINCT activity FROM AuditLogs ORDER BY activity",
+                    cache=True
                 ) or []]))
             )
         
@@ -112,23 +246,23 @@ def audit_logs():
         if where_clauses:
             query += " WHERE " + " AND ".join(where_clauses)
         
-        query += " ORDER BY a.timestamp DESC LIMIT 1000"
+        query += " ORDER BY a.timestamp DESC"
         
-        # Execute query
-        audit_df = database.query_to_dataframe(query, params)
+        # Execute query, showing only the most recent entries on screen
+        audit_df = database.query_to_dataframe(query + f" LIMIT {DISPLAY_LIMIT}", params)
         
         if audit_df.empty:
             st.info("No audit logs found matching your criteria.")
         else:
             # Format timestamp
-            audit_df['timestamp'] = pd.to_datetime(audit_df['timestamp']).dt.strftime('%Y-%m-%d %H:%M:%S')
+            audit_df['timestamp'] = audit_df['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S')
             
             # Display dataframe
             st.dataframe(audit_df, use_container_width=True)
             
-            # Download option
+            # Download option covering every matching entry, not just those on screen
             if st.button("Export to CSV"):
-                csv = audit_df.to_csv(index=False)
+                csv = database.export_csv(query, params)
                 
                 # Get current timestamp for filename
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -167,53 +301,68 @@ def audit_logs():
         st.subheader("User Sessions")
         
         # Get user sessions
-        user_sessions = database.query_to_dataframe(
-            """
+        sessions_query = """
             SELECT 
                 s.session_id,
                 u.username,
                 s.login_time,
                 s.logout_time,
+                s.last_seen,
                 s.status
             FROM UserSessions s
             JOIN Users u ON s.user_id = u.user_id
             ORDER BY s.login_time DESC
-            LIMIT 1000
             """
-        )
+        user_sessions = database.query_to_dataframe(sessions_query + f" LIMIT {DISPLAY_LIMIT}")
         
         if user_sessions.empty:
             st.info("No user sessions recorded.")
         else:
             # Format timestamps
-            user_sessions['login_time'] = pd.to_datetime(user_sessions['login_time']).dt.strftime('%Y-%m-%d %H:%M:%S')
-            user_sessions['logout_time'] = pd.to_datetime(user_sessions['logout_time']).dt.strftime('%Y-%m-%d %H:%M:%S')
+            user_sessions['login_time'] = user_sessions['login_time'].dt.strftime('%Y-%m-%d %H:%M:%S')
+            user_sessions['logout_time'] = user_sessions['logout_time'].dt.strftime('%Y-%m-%d %H:%M:%S')
+            user_sessions['last_seen'] = user_sessions['last_seen'].dt.strftime('%Y-%m-%d %H:%M:%S')
             
-            # Calculate session duration
+            # Calculate session duration, using the last heartbeat for sessions still active
             def calculate_duration(row):
-                if pd.isna(row['logout_time']) or row['logout_time'] == 'NaT':
-                    if row['status'] == 'active':
+                end_time = row['logout_time']
+                suffix = ""
+                
+                if pd.isna(end_time) or end_time == 'NaT':
+                    if row['status'] == 'active' and not pd.isna(row['last_seen']):
+                        end_time = row['last_seen']
+                        suffix = " (active)"
+                    elif row['status'] == 'active':
                         return "Session active"
                     else:
                         return "Unknown"
+                
+                login = datetime.strptime(row['login_time'], '%Y-%m-%d %H:%M:%S')
+                end = datetime.strptime(end_time, '%Y-%m-%d %H:%M:%S')
+                
+                duration = end - login
+                minutes, seconds = divmod(duration.seconds, 60)
+                hours, minutes = divmod(minutes, 60)
+                hours += duration.days * 24
+                
+                if hours > 0:
+                    return f"{hours}h {minutes}m{suffix}"
                 else:
-                    login = datetime.strptime(row['login_time'], '%Y-%m-%d %H:%M:%S')
-                    logout = datetime.strptime(row['logout_time'], '%Y-%m-%d %H:%M:%S')
-                    
-                    duration = logout - login
-                    minutes, seconds = divmod(duration.seconds, 60)
-                    hours, minutes = divmod(minutes, 60)
-                    
-                    if hours > 0:
-                        return f"{hours}h {minutes}m"
-                    else:
-                        return f"{minutes}m {seconds}s"
+                    return f"{minutes}m {seconds}s{suffix}"
             
             user_sessions['duration'] = user_sessions.apply(calculate_duration, axis=1)
             
             # Display dataframe
             st.dataframe(user_sessions, use_container_width=True)
             
+            if st.button("Export Sessions to CSV"):
+                st.download_button(
+                    label="Download CSV",
+                    data=database.export_csv(sessions_query),
+                    file_name=f"user_sessions_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+                    mime="text/csv"
+                )
+            
             # Active sessions
             active_sessions = user_sessions[user_sessions['status'] == 'active']
             
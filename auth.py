@@ -13,11 +13,16 @@ def hash_password(password):
     """Hash a password for storing."""
     return hashlib.sha256(password.encode()).hexdigest()
 
+@st.cache_data(show_spinner=False)
 def check_admin_exists():
-    """Check if at least one admin user exists in the database."""
+    """Check if at least one admin user exists in the database (cached until users change)."""
     result = database.fetch_one("SELECT COUNT(*) FROM Users WHERE role = 'admin'")
     return result[0] > 0
 
+def invalidate_admin_cache():
+    """Forget the cached admin-exists flag after users are added, changed or deleted."""
+    check_admin_exists.clear()
+
 def validate_password(password):
     """Validate password strength."""
     if len(password) < 8:
@@ -126,14 +131,16 @@ def login_form():
                 audit.record_activity(user_id, "Logged In", f"User {username} logged in")
                 
                 # Create user session
-                database.insert_record(
+                st.session_state.session_id = database.insert_record(
                     "UserSessions",
                     {
                         "user_id": user_id,
                         "login_time": datetime.now(),
+                        "last_seen": datetime.now(),
                         "status": "active"
                     }
                 )
+                st.session_state.last_heartbeat = time.monotonic()
                 
                 st.success("Login successful!")
                 st.rerun()
@@ -256,3 +263,5 @@ def logout():
     st.session_state.username = None
     st.session_state.role = None
     st.session_state.login_time = None
+    st.session_state.session_id = None
+    st.session_state.last_heartbeat = None
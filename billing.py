@@ -6,6 +6,24 @@ import time
 import audit
 import utils
 
+# Outstanding bills for payment processing, paged by due date with undated bills last.
+# due_key matches the expression idx_billing_due_date is built on
+UNPAID_BILLS_QUERY = f"""
+SELECT 
+    b.bill_id, 
+    p.first_name || ' ' || p.last_name as patient_name,
+    b.service_description,
+    b.amount,
+    b.bill_date,
+    b.due_date,
+    COALESCE(b.due_date, '{database.NO_DUE_DATE}') as due_key,
+    b.status
+FROM Billing b
+JOIN Patients p ON b.patient_id = p.patient_id
+WHERE +b.status IN ('unpaid', 'partial', 'overdue')
+"""
+UNPAID_BILLS_SORT = [("due_key", False), ("bill_id", False)]
+
 def get_revenue_for_today():
     """Get the total revenue for today."""
     today = datetime.now().strftime('%Y-%m-%d')
@@ -18,6 +36,29 @@ def get_revenue_for_today():
     )
     return result[0] if result else 0
 
+def process_payment(bill_id, payment_amount):
+    """Apply a payment to an outstanding bill in one transaction.
+    
+    Returns the bill's new status, or None if the bill is missing or already paid.
+    """
+    with database.transaction() as conn:
+        bill = conn.execute(
+            "SELECT amount, status FROM Billing WHERE bill_id = ?",
+            (bill_id,)
+        ).fetchone()
+        
+        if not bill or bill[1] == 'paid':
+            return None
+        
+        new_status = "paid" if payment_amount >= bill[0] else "partial"
+        
+        conn.execute(
+            "UPDATE Billing SET status = ? WHERE bill_id = ?",
+            (new_status, bill_id)
+        )
+    
+    return new_status
+
 def billing_management():
     """Billing management page."""
     st.header("Billing Management")
@@ -69,8 +110,9 @@ def billing_management():
         # Date range filter
         if date_range == "Today":
             today = datetime.now().strftime('%Y-%m-%d')
-            where_clauses.append("b.bill_date LIKE ? || '%'")
-            params.append(today)
+            tomorrow = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+            where_clauses.append("b.bill_date >= ? AND b.bill_date < ?")
+            params.extend([today, tomorrow])
         elif date_range == "Last 7 Days":
             seven_days_ago = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
             where_clauses.append("b.bill_date >= ?")
@@ -89,25 +131,25 @@ def billing_management():
         if where_clauses:
             query += " WHERE " + " AND ".join(where_clauses)
         
-        # Sort order
+        # Sort order, ending with the bill ID so every row has a unique position for paging
         if sort_by == "Newest First":
-            query += " ORDER BY b.bill_date DESC"
+            sort_keys = [("bill_date", True), ("bill_id", True)]
         elif sort_by == "Oldest First":
-            query += " ORDER BY b.bill_date ASC"
+            sort_keys = [("bill_date", False), ("bill_id", False)]
         elif sort_by == "Amount (High to Low)":
-            query += " ORDER BY b.amount DESC"
-        elif sort_by == "Amount (Low to High)":
-            query += " ORDER BY b.amount ASC"
+            sort_keys = [("amount", True), ("bill_id", True)]
+        else:
+            sort_keys = [("amount", False), ("bill_id", False)]
         
-        # Execute query
-        bills_df = database.query_to_dataframe(query, params)
+        # Fetch the current page
+        bills_df = utils.keyset_pager("billing_list", query, params, sort_keys)
         
         if bills_df.empty:
             st.info("No bills found matching your criteria.")
         else:
             # Format dates and amounts
-            bills_df['bill_date'] = pd.to_datetime(bills_df['bill_date']).dt.strftime('%Y-%m-%d')
-            bills_df['due_date'] = pd.to_datetime(bills_df['due_date']).dt.strftime('%Y-%m-%d')
+            bills_df['bill_date'] = bills_df['bill_date'].dt.strftime('%Y-%m-%d')
+            bills_df['due_date'] = bills_df['due_date'].dt.strftime('%Y-%m-%d')
             bills_df['amount'] = bills_df['amount'].apply(utils.format_currency)
             
             # Rename columns for display
@@ -128,7 +170,7 @@ def billing_management():
         if not bills_df.empty:
             st.subheader("Bill Details")
             
-            bill_options = [f"Bill #{row['bill_id']} - {row['patient_name']} - {utils.format_currency(row['amount'])}" 
+            bill_options = [f"Bill #{row['bill_id']} - {row['patient_name']} - {row['amount']}" 
                            for _, row in bills_df.iterrows()]
             
             selected_bill = st.selectbox("Select Bill", ["Select a bill"] + bill_options)
@@ -270,26 +312,13 @@ def billing_management():
     with tab2:
         st.subheader("Create New Bill")
         
+        # Patient search sits outside the form so the matches update as the user types
+        selected_patient = utils.entity_picker("Patient*", "patient", "create_bill_patient", status="active")
+        
         with st.form("create_bill_form"):
-            # Get patient list
-            patients_df = database.query_to_dataframe(
-                "SELECT patient_id, first_name || ' ' || last_name as patient_name FROM Patients WHERE status = 'active'"
-            )
-            patient_options = {row['patient_id']: row['patient_name'] for _, row in patients_df.iterrows()}
-            
-            # Add a placeholder
-            patient_options[0] = "Select a patient"
-            
             col1, col2 = st.columns(2)
             
             with col1:
-                selected_patient = st.selectbox(
-                    "Patient*",
-                    options=list(patient_options.keys()),
-                    format_func=lambda x: patient_options[x],
-                    index=0
-                )
-                
                 service_description = st.text_input("Service Description*")
                 amount = st.number_input("Amount (KSh)*", min_value=0.0, step=10.0)
             
@@ -309,7 +338,7 @@ def billing_management():
             create_bill_submitted = st.form_submit_button("Create Bill")
             
             if create_bill_submitted:
-                if selected_patient == 0 or not service_description or amount <= 0:
+                if selected_patient is None or not service_description or amount <= 0:
                     st.error("Please fill in all required fields.")
                 else:
                     # Animation
@@ -345,37 +374,22 @@ def billing_management():
     with tab3:
         st.subheader("Payment Processing")
         
-        # Get unpaid bills
-        unpaid_bills_df = database.query_to_dataframe(
-            """
-            SELECT 
-                b.bill_id, 
-                p.first_name || ' ' || p.last_name as patient_name,
-                b.service_description,
-                b.amount,
-                b.bill_date,
-                b.due_date,
-                b.status
-            FROM Billing b
-            JOIN Patients p ON b.patient_id = p.patient_id
-            WHERE b.status IN ('unpaid', 'partial', 'overdue')
-            ORDER BY b.due_date ASC
-            """
-        )
+        # Get the current page of unpaid bills, walking the due date index rather than sorting every open bill
+        unpaid_bills_df = utils.keyset_pager("unpaid_bills", UNPAID_BILLS_QUERY, sort_keys=UNPAID_BILLS_SORT)
         
         if unpaid_bills_df.empty:
             st.info("No unpaid bills to process.")
         else:
-            # Format dates and amounts
-            unpaid_bills_df['bill_date'] = pd.to_datetime(unpaid_bills_df['bill_date']).dt.strftime('%Y-%m-%d')
-            unpaid_bills_df['due_date'] = pd.to_datetime(unpaid_bills_df['due_date']).dt.strftime('%Y-%m-%d')
-            
-            # Calculate days overdue
-            today = datetime.now().date()
-            unpaid_bills_df['days_overdue'] = unpaid_bills_df['due_date'].apply(
-                lambda x: max(0, (today - datetime.strptime(x, '%Y-%m-%d').date()).days)
+            # Calculate days overdue; bills without a due date are never overdue
+            today = pd.Timestamp(datetime.now().date())
+            unpaid_bills_df['days_overdue'] = (
+                (today - unpaid_bills_df['due_date']).dt.days.clip(lower=0).fillna(0).astype(int)
             )
             
+            # Format dates and amounts
+            unpaid_bills_df['bill_date'] = unpaid_bills_df['bill_date'].dt.strftime('%Y-%m-%d')
+            unpaid_bills_df['due_date'] = unpaid_bills_df['due_date'].dt.strftime('%Y-%m-%d').fillna('Not set')
+            
             # Add formatting for display
             unpaid_bills_df['display_amount'] = unpaid_bills_df['amount'].apply(utils.format_currency)
             
@@ -438,31 +452,25 @@ def billing_management():
                             with st.spinner("Processing payment..."):
                                 time.sleep(1.5)  # Simple animation delay
                             
-                            # Determine new status
-                            new_status = "paid"
-                            if payment_amount < bill_details['amount']:
-                                new_status = "partial"
-                            
-                            # Update bill status
-                            database.update_record(
-                                "Billing",
-                                {"status": new_status},
-                                {"bill_id": payment_bill_id}
-                            )
+                            # Check the bill is still outstanding and update its status atomically
+                            new_status = process_payment(payment_bill_id, payment_amount)
                             
-                            # Construct payment details for audit
-                            payment_details = (
-                                f"Amount: {utils.format_currency(payment_amount)}, Method: {payment_method}, "
-                                f"Reference: {payment_reference}, Notes: {payment_notes}"
-                            )
-                            
-                            # Record in audit log
-                            audit.record_activity(
-                                st.session_state.user_id,
-                                "Payment Processed",
-                                f"Processed payment for Bill #{payment_bill_id}. {payment_details}"
-                            )
-                            
-                            st.success("Payment processed successfully!")
-                            time.sleep(1)
-                            st.rerun()
+                            if new_status is None:
+                                st.error("This bill has already been paid.")
+                            else:
+                                # Construct payment details for audit
+                                payment_details = (
+                                    f"Amount: {utils.format_currency(payment_amount)}, Method: {payment_method}, "
+                                    f"Reference: {payment_reference}, Notes: {payment_notes}"
+                                )
+                                
+                                # Record in audit log
+                                audit.record_activity(
+                                    st.session_state.user_id,
+                                    "Payment Processed",
+                                    f"Processed payment for Bill #{payment_bill_id}. {payment_details}"
+                                )
+                                
+                                st.success("Payment processed successfully!")
+                                time.sleep(1)
+                                st.rerun()
@@ -0,0 +1,105 @@
+import database
+from datetime import datetime
+import os
+import threading
+import time
+
+# Seconds a dashboard snapshot is served before it is refreshed in the background
+SNAPSHOT_TTL = int(os.environ.get('HOSPITAL_DASHBOARD_TTL', '30'))
+
+# Every dashboard metric in one statement, so a render costs a single round trip. Table-wide
+# counts and daily revenue are read from the trigger-maintained Counters table
+SNAPSHOT_QUERY = """
+SELECT
+    (SELECT COALESCE(SUM(value), 0) FROM Counters WHERE name = 'active_patients' AND bucket = ''),
+    (SELECT COUNT(*) FROM Appointments WHERE appointment_date = ?),
+    (SELECT COALESCE(SUM(value), 0) FROM Counters WHERE name = 'low_stock_items' AND bucket = ''),
+    (SELECT COALESCE(SUM(value), 0) FROM Counters WHERE name = 'low_stock_medications' AND bucket = ''),
+    (SELECT COALESCE(SUM(value), 0) FROM Counters WHERE name = 'paid_revenue' AND bucket = ?),
+    (SELECT COUNT(*) FROM Staff s JOIN Users u ON s.user_id = u.user_id WHERE s.status = 'active' AND u.status = 'active'),
+    (SELECT COUNT(*) FROM Staff),
+    (SELECT COALESCE(SUM(value), 0) FROM Counters WHERE name = 'pending_prescriptions' AND bucket = '')
+"""
+SNAPSHOT_METRICS = (
+    'patient_count',
+    'today_appointments',
+    'low_stock_count',
+    'low_stock_medications',
+    'today_revenue',
+    'active_staff',
+    'total_staff',
+    'pending_prescriptions',
+)
+
+# Snapshot shared by every session in this process
+_snapshot = None
+_snapshot_lock = threading.Lock()
+_refresh_worker = None
+_snapshot_stats = {"hits": 0, "stale_hits": 0, "refreshes": 0, "failures": 0, "last_refresh_time": 0.0}
+
+def get_snapshot():
+    """Return the dashboard metrics as a dict, plus the date and time they were taken.
+    
+    A snapshot younger than SNAPSHOT_TTL is served as is. An older one is still
+    served while a background thread computes its replacement, so only the first
+    render of the day waits for the query.
+    """
+    today = datetime.now().strftime('%Y-%m-%d')
+    
+    with _snapshot_lock:
+        snapshot = _snapshot
+        
+        if snapshot is not None and snapshot['date'] == today:
+            if snapshot['expires_at'] > time.monotonic():
+                _snapshot_stats["hits"] += 1
+            else:
+                _snapshot_stats["stale_hits"] += 1
+                _start_refresh()
+            return snapshot
+    
+    # No snapshot yet, or it belongs to yesterday: today's figures are needed now
+    return _refresh_snapshot()
+
+def _start_refresh():
+    """Start a background snapshot refresh unless one is already running (caller holds the lock)."""
+    global _refresh_worker
+    
+    if _refresh_worker is None or not _refresh_worker.is_alive():
+        _refresh_worker = threading.Thread(target=_background_refresh, name="dashboard-snapshot", daemon=True)
+        _refresh_worker.start()
+
+def _background_refresh():
+    """Refresh the snapshot, keeping the old one if the query fails."""
+    try:
+        _refresh_snapshot()
+    except Exception as e:
+        with _snapshot_lock:
+            _snapshot_stats["failures"] += 1
+        print(f"Error refreshing dashboard snapshot: {e}")
+
+def _refresh_snapshot():
+    """Compute every metric in one query and publish the result as the current snapshot."""
+    global _snapshot
+    
+    started = time.monotonic()
+    now = datetime.now()
+    today = now.strftime('%Y-%m-%d')
+    
+    row = database.fetch_one(SNAPSHOT_QUERY, (today, today))
+    
+    snapshot = dict(zip(SNAPSHOT_METRICS, row))
+    snapshot['date'] = today
+    snapshot['taken_at'] = now
+    snapshot['expires_at'] = time.monotonic() + SNAPSHOT_TTL
+    
+    with _snapshot_lock:
+        _snapshot = snapshot
+        _snapshot_stats["refreshes"] += 1
+        _snapshot_stats["last_refresh_time"] = time.monotonic() - started
+    
+    return snapshot
+
+def get_snapshot_stats():
+    """Return counters for snapshot hits and refreshes."""
+    with _snapshot_lock:
+        return dict(_snapshot_stats)
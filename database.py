@@ -2,11 +2,930 @@ import sqlite3
 import streamlit as st
 import pandas as pd
 import os
-from datetime import datetime
+import queue
+import threading
+import time
+import atexit
+import re
+import sys
+import json
+import functools
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from urllib.request import pathname2url
+
+# Connection settings
+DB_PATH = os.environ.get('HOSPITAL_DB_PATH', 'hospital_management.db')
+POOL_SIZE = int(os.environ.get('HOSPITAL_DB_POOL_SIZE', '8'))
+POOL_TIMEOUT = 10  # Seconds to wait for a free pooled connection
+HEALTH_CHECK_INTERVAL = 30  # Idle seconds before a pooled connection is pinged
+BUSY_TIMEOUT = float(os.environ.get('HOSPITAL_DB_BUSY_TIMEOUT', '10'))  # Seconds SQLite waits on a locked database
+
+# Pragmas applied once when a connection is opened
+CONNECTION_PRAGMAS = {
+    'temp_store': 'MEMORY',
+    'cache_size': '-16000',
+}
+
+# Single-writer settings
+WRITE_BATCH_SIZE = 200  # Most write requests committed together
+WRITE_TIMEOUT = 30  # Seconds the writer keeps retrying a busy database before failing a batch
+
+# Declared column types loaded as timestamps, and low-cardinality text columns loaded as categoricals
+TIMESTAMP_TYPES = ('DATE', 'DATETIME', 'TIMESTAMP')
+CATEGORICAL_COLUMNS = {'status', 'gender', 'role', 'department', 'category', 'blood_group'}
+
+# Rows fetched per chunk when streaming large results
+STREAM_CHUNK_SIZE = 10000
+
+# Custom report sandbox limits for ad hoc SQL
+SANDBOX_TIME_BUDGET = float(os.environ.get('HOSPITAL_SANDBOX_TIME_BUDGET', '15'))  # Seconds a query may run
+SANDBOX_MAX_ROWS = int(os.environ.get('HOSPITAL_SANDBOX_MAX_ROWS', '200000'))
+SANDBOX_MAX_BYTES = int(os.environ.get('HOSPITAL_SANDBOX_MAX_BYTES', str(50 * 1024 * 1024)))  # CSV output cap
+SANDBOX_MAX_COST = float(os.environ.get('HOSPITAL_SANDBOX_MAX_COST', '1e9'))  # Estimated rows a plan may visit
+SANDBOX_PROGRESS_STEPS = 10000  # VM instructions between time budget checks
+SANDBOX_CHUNK_SIZE = 1000
+SANDBOX_SEARCH_ROWS = 10  # Rows an indexed equality lookup is assumed to visit
+SANDBOX_UNKNOWN_ROWS = 1000  # Rows assumed for subqueries the plan does not size
+SANDBOX_HIDDEN_COLUMNS = {('users', 'password')}  # (table, column) pairs that read as NULL
+
+# Keyset pagination settings
+PAGE_SIZE = 50
+COUNT_ESTIMATE_CAP = 10000  # Rows counted before a list reports "N+"
+
+# Query result cache settings
+QUERY_CACHE_SIZE = 256  # Maximum cached results
+QUERY_CACHE_TTL = 300  # Seconds before a cached result expires
+
+# Query profiling settings
+QUERY_PROFILING = os.environ.get('HOSPITAL_QUERY_PROFILING', '1') != '0'
+SLOW_QUERY_THRESHOLD = float(os.environ.get('HOSPITAL_SLOW_QUERY_THRESHOLD', '0.2'))  # Seconds
+SLOW_QUERY_LOG = os.environ.get('HOSPITAL_SLOW_QUERY_LOG', 'slow_queries.log')
+
+# Connection pool state
+_pool = queue.LifoQueue()
+_pool_lock = threading.Lock()
+_pool_created = 0
+_local = threading.local()
+_read_only_connections = []  # Per-thread read-only connections, closed at exit
+_read_only_lock = threading.Lock()
+
+# Single-writer state
+_write_queue = queue.Queue()
+_write_lock = threading.Lock()  # Held by whichever caller is committing queued writes
+_writer_conn = None
+_writer_stats = {"requests": 0, "batches": 0, "busy_retries": 0, "failed": 0, "max_batch": 0}
+
+# Query result cache state
+_query_cache = OrderedDict()  # (query, params) -> (expires_at, tables, result)
+_query_cache_lock = threading.Lock()
+_table_generations = {}  # Bumped whenever a table is invalidated
+_query_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+
+# Tables named by a statement; reads are found by walking the tokens of each FROM list
+_SQL_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_SQL_TOKENS = re.compile(r'[A-Za-z_]\w*|\S')
+_WRITE_TABLES = re.compile(
+    r'\b(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+([A-Za-z_]\w*)',
+    re.IGNORECASE
+)
+_SCHEMA_CHANGE = re.compile(r'^\s*(?:CREATE|DROP|ALTER)\b', re.IGNORECASE)
+
+# Result column name -> pandas dtype, built from the schema on first use
+_column_dtypes = None
+
+# Day the patient age bands were last brought up to date in this process
+_age_bands_checked = None
+
+# Query profiling state
+_query_stats = {}  # fingerprint -> aggregated timings
+_query_stats_lock = threading.Lock()
+_slow_log_lock = threading.Lock()
+
+# Literals and placeholder lists folded together by query fingerprints
+_FINGERPRINT_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_FINGERPRINT_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_EXPLAINABLE = re.compile(r'^\s*(?:SELECT|WITH|INSERT|UPDATE|DELETE|REPLACE)\b', re.IGNORECASE)
+
+# Sandbox authorizer actions allowed, and FROM/JOIN aliases mapped back to tables for cost estimates
+_SANDBOX_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+_SANDBOX_ALIASES = re.compile(
+    r'(?:\bFROM|\bJOIN|,)\s+([A-Za-z_]\w*)\s+(?:AS\s+)?([A-Za-z_]\w*)', re.IGNORECASE
+)
+
+# Patient age bands as (label, oldest age in the band); the last band is open-ended
+AGE_BANDS = (('Under 18', 17), ('18-30', 30), ('31-45', 45), ('46-60', 60), ('61-75', 75), ('Over 75', None))
+
+# Whole years between {dob} and {today}, and the age band that age falls in
+AGE_SQL = (
+    "(CAST(strftime('%Y', {today}) AS INTEGER) - CAST(strftime('%Y', {dob}) AS INTEGER)"
+    " - (strftime('%m-%d', {today}) < strftime('%m-%d', {dob})))"
+)
+AGE_BAND_SQL = (
+    "CASE WHEN {age} IS NULL THEN NULL "
+    + " ".join(f"WHEN {{age}} <= {oldest} THEN '{label}'" for label, oldest in AGE_BANDS[:-1])
+    + f" ELSE '{AGE_BANDS[-1][0]}' END"
+)
+TODAY_SQL = "date('now', 'localtime')"
+
+# Tables whose updates and deletes are logged for the analytics mirror. Each has an INTEGER PRIMARY KEY,
+# so the mirror finds inserts by rowid and keeps row identity; other tables are small and compared whole
+MIRROR_TRACKED_TABLES = (
+    'Users', 'Patients', 'Appointments', 'MedicalHistory', 'Prescriptions', 'Inventory',
+    'Pharmacy', 'Billing', 'Staff', 'AuditLogs', 'UserSessions',
+)
+
+# Most logged changes kept for a mirror that is behind or not running; older ones are trimmed
+# and the mirror rebuilds when it next syncs, so the log cannot grow without bound
+MIRROR_LOG_LIMIT = 500000
+
+# Due date that bills without one sort under, after every real due date
+NO_DUE_DATE = '9999-12-31'
+
+# Report rollups recomputed from their source tables, used by migration 10 and backfill_rollups
+ROLLUP_QUERIES = {
+    'DailyRegistrations': """
+        SELECT COALESCE(substr(registration_date, 1, 10), ''), COALESCE(gender, ''), COUNT(*)
+        FROM Patients GROUP BY 1, 2
+    """,
+    'DailyAppointments': """
+        SELECT substr(appointment_date, 1, 10), doctor_id, COALESCE(status, ''), COUNT(*)
+        FROM Appointments GROUP BY 1, 2, 3
+    """,
+    'DailyBilling': """
+        SELECT COALESCE(substr(bill_date, 1, 10), ''), service_description, COALESCE(insurance_provider, ''),
+               COALESCE(status, ''), COUNT(*), SUM(amount)
+        FROM Billing GROUP BY 1, 2, 3, 4
+    """,
+    'InventoryByCategory': """
+        SELECT category, COUNT(*), SUM(quantity), SUM(quantity * unit_price),
+               SUM(quantity = 0 OR status IS 'out of stock')
+        FROM Inventory GROUP BY category
+    """,
+}
+
+# Ordered schema migrations as (version, description, statements)
+MIGRATIONS = [
+    (1, "Indexes for patient, appointment and medical record lookups", [
+        "CREATE INDEX IF NOT EXISTS idx_patients_status_name ON Patients (status, last_name, first_name)",
+        "CREATE INDEX IF NOT EXISTS idx_patients_registration_date ON Patients (registration_date)",
+        "CREATE INDEX IF NOT EXISTS idx_patients_last_name ON Patients (last_name)",
+        "CREATE INDEX IF NOT EXISTS idx_patients_first_name ON Patients (first_name)",
+        "CREATE INDEX IF NOT EXISTS idx_patients_gender ON Patients (gender)",
+        "CREATE INDEX IF NOT EXISTS idx_appointments_date_time ON Appointments (appointment_date, appointment_time, status)",
+        "CREATE INDEX IF NOT EXISTS idx_appointments_doctor_date ON Appointments (doctor_id, appointment_date, appointment_time)",
+        "CREATE INDEX IF NOT EXISTS idx_appointments_patient ON Appointments (patient_id)",
+        "CREATE INDEX IF NOT EXISTS idx_medical_history_patient_date ON MedicalHistory (patient_id, date)",
+        "CREATE INDEX IF NOT EXISTS idx_medical_history_doctor ON MedicalHistory (doctor_id)",
+    ]),
+    (2, "Indexes for billing, pharmacy, prescription and inventory lookups", [
+        "CREATE INDEX IF NOT EXISTS idx_billing_status_date ON Billing (status, bill_date, amount)",
+        "CREATE INDEX IF NOT EXISTS idx_billing_bill_date ON Billing (bill_date)",
+        "CREATE INDEX IF NOT EXISTS idx_billing_patient ON Billing (patient_id)",
+        "CREATE INDEX IF NOT EXISTS idx_prescriptions_status_created ON Prescriptions (status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_prescriptions_created ON Prescriptions (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_prescriptions_patient ON Prescriptions (patient_id, status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_prescriptions_doctor ON Prescriptions (doctor_id)",
+        "CREATE INDEX IF NOT EXISTS idx_prescriptions_medication ON Prescriptions (medication_id)",
+        "CREATE INDEX IF NOT EXISTS idx_pharmacy_category_name ON Pharmacy (category, name)",
+        "CREATE INDEX IF NOT EXISTS idx_pharmacy_name ON Pharmacy (name)",
+        "CREATE INDEX IF NOT EXISTS idx_pharmacy_status ON Pharmacy (status)",
+        "CREATE INDEX IF NOT EXISTS idx_inventory_category_name ON Inventory (category, item_name)",
+        "CREATE INDEX IF NOT EXISTS idx_inventory_status ON Inventory (status)",
+        "CREATE INDEX IF NOT EXISTS idx_inventory_expiry_date ON Inventory (expiry_date)",
+    ]),
+    (3, "Indexes for user, staff, audit log and session lookups", [
+        "CREATE INDEX IF NOT EXISTS idx_users_role_name ON Users (role, full_name)",
+        "CREATE INDEX IF NOT EXISTS idx_users_full_name ON Users (full_name)",
+        "CREATE INDEX IF NOT EXISTS idx_users_created_at ON Users (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_staff_user ON Staff (user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_staff_department ON Staff (department)",
+        "CREATE INDEX IF NOT EXISTS idx_staff_status_department ON Staff (status, department)",
+        "CREATE INDEX IF NOT EXISTS idx_audit_logs_timestamp ON AuditLogs (timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_audit_logs_user_timestamp ON AuditLogs (user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_audit_logs_activity ON AuditLogs (activity, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_user_sessions_user_status ON UserSessions (user_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_user_sessions_login_time ON UserSessions (login_time)",
+    ]),
+    (4, "Track session heartbeats in UserSessions", [
+        "ALTER TABLE UserSessions ADD COLUMN last_seen TIMESTAMP",
+        "UPDATE UserSessions SET last_seen = logout_time",
+    ]),
+    (5, "Full-text trigram search index over patients", [
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS PatientSearch USING fts5(
+            patient_id, first_name, last_name, contact_number, email,
+            content='Patients', content_rowid='patient_id', tokenize='trigram'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_patients_search_insert AFTER INSERT ON Patients BEGIN
+            INSERT INTO PatientSearch (rowid, patient_id, first_name, last_name, contact_number, email)
+            VALUES (new.patient_id, new.patient_id, new.first_name, new.last_name, new.contact_number, new.email);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_patients_search_delete AFTER DELETE ON Patients BEGIN
+            INSERT INTO PatientSearch (PatientSearch, rowid, patient_id, first_name, last_name, contact_number, email)
+            VALUES ('delete', old.patient_id, old.patient_id, old.first_name, old.last_name, old.contact_number, old.email);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_patients_search_update
+        AFTER UPDATE OF patient_id, first_name, last_name, contact_number, email ON Patients BEGIN
+            INSERT INTO PatientSearch (PatientSearch, rowid, patient_id, first_name, last_name, contact_number, email)
+            VALUES ('delete', old.patient_id, old.patient_id, old.first_name, old.last_name, old.contact_number, old.email);
+            INSERT INTO PatientSearch (rowid, patient_id, first_name, last_name, contact_number, email)
+            VALUES (new.patient_id, new.patient_id, new.first_name, new.last_name, new.contact_number, new.email);
+        END
+        """,
+        "INSERT INTO PatientSearch (PatientSearch) VALUES ('rebuild')",
+    ]),
+    (6, "Full-text search over medical histories and prescription notes", [
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS MedicalHistorySearch USING fts5(
+            diagnosis, treatment, notes,
+            content='MedicalHistory', content_rowid='record_id', tokenize='porter unicode61 remove_diacritics 2'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_medical_history_search_insert AFTER INSERT ON MedicalHistory BEGIN
+            INSERT INTO MedicalHistorySearch (rowid, diagnosis, treatment, notes)
+            VALUES (new.record_id, new.diagnosis, new.treatment, new.notes);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_medical_history_search_delete AFTER DELETE ON MedicalHistory BEGIN
+            INSERT INTO MedicalHistorySearch (MedicalHistorySearch, rowid, diagnosis, treatment, notes)
+            VALUES ('delete', old.record_id, old.diagnosis, old.treatment, old.notes);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_medical_history_search_update
+        AFTER UPDATE OF record_id, diagnosis, treatment, notes ON MedicalHistory BEGIN
+            INSERT INTO MedicalHistorySearch (MedicalHistorySearch, rowid, diagnosis, treatment, notes)
+            VALUES ('delete', old.record_id, old.diagnosis, old.treatment, old.notes);
+            INSERT INTO MedicalHistorySearch (rowid, diagnosis, treatment, notes)
+            VALUES (new.record_id, new.diagnosis, new.treatment, new.notes);
+        END
+        """,
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS PrescriptionSearch USING fts5(
+            notes,
+            content='Prescriptions', content_rowid='prescription_id', tokenize='porter unicode61 remove_diacritics 2'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_prescriptions_search_insert AFTER INSERT ON Prescriptions BEGIN
+            INSERT INTO PrescriptionSearch (rowid, notes) VALUES (new.prescription_id, new.notes);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_prescriptions_search_delete AFTER DELETE ON Prescriptions BEGIN
+            INSERT INTO PrescriptionSearch (PrescriptionSearch, rowid, notes) VALUES ('delete', old.prescription_id, old.notes);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_prescriptions_search_update
+        AFTER UPDATE OF prescription_id, notes ON Prescriptions BEGIN
+            INSERT INTO PrescriptionSearch (PrescriptionSearch, rowid, notes) VALUES ('delete', old.prescription_id, old.notes);
+            INSERT INTO PrescriptionSearch (rowid, notes) VALUES (new.prescription_id, new.notes);
+        END
+        """,
+        "INSERT INTO MedicalHistorySearch (MedicalHistorySearch) VALUES ('rebuild')",
+        "INSERT INTO PrescriptionSearch (PrescriptionSearch) VALUES ('rebuild')",
+    ]),
+    (7, "Indexes for the sort orders of paginated lists", [
+        "CREATE INDEX IF NOT EXISTS idx_patients_status_registration_date ON Patients (status, registration_date)",
+        "CREATE INDEX IF NOT EXISTS idx_patients_status_first_name ON Patients (status, first_name)",
+        "CREATE INDEX IF NOT EXISTS idx_billing_amount ON Billing (amount)",
+        "CREATE INDEX IF NOT EXISTS idx_billing_status_amount ON Billing (status, amount)",
+        "CREATE INDEX IF NOT EXISTS idx_inventory_status_category_name ON Inventory (status, category, item_name)",
+    ]),
+    (8, "Indexes for type-ahead pickers and the payment queue", [
+        "CREATE INDEX IF NOT EXISTS idx_users_role_full_name_nocase ON Users (role, full_name COLLATE NOCASE)",
+        "CREATE INDEX IF NOT EXISTS idx_pharmacy_name_nocase ON Pharmacy (name COLLATE NOCASE)",
+        "CREATE INDEX IF NOT EXISTS idx_billing_due_date ON Billing (due_date)",
+    ]),
+    (9, "Trigger-maintained counters for dashboard metrics", [
+        """
+        CREATE TABLE IF NOT EXISTS Counters (
+            name TEXT NOT NULL,
+            bucket TEXT NOT NULL DEFAULT '',
+            value NUMERIC NOT NULL DEFAULT 0,
+            PRIMARY KEY (name, bucket)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_patients_counters_insert AFTER INSERT ON Patients
+        WHEN new.status IS 'active' BEGIN
+            INSERT INTO Counters (name, bucket, value) VALUES ('active_patients', '', 1)
+            ON CONFLICT (name, bucket) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_patients_counters_delete AFTER DELETE ON Patients
+        WHEN old.status IS 'active' BEGIN
+            INSERT INTO Counters (name, bucket, value) VALUES ('active_patients', '', -1)
+            ON CONFLICT (name, bucket) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_patients_counters_update AFTER UPDATE OF status ON Patients
+        WHEN (old.status IS 'active') != (new.status IS 'active') BEGIN
+            INSERT INTO Counters (name, bucket, value) VALUES ('active_patients', '', IIF(new.status IS 'active', 1, -1))
+            ON CONFLICT (name, bucket) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_prescriptions_counters_insert AFTER INSERT ON Prescriptions
+        WHEN new.status IS 'pending' BEGIN
+            INSERT INTO Counters (name, bucket, value) VALUES ('pending_prescriptions', '', 1)
+            ON CONFLICT (name, bucket) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_prescriptions_counters_delete AFTER DELETE ON Prescriptions
+        WHEN old.status IS 'pending' BEGIN
+            INSERT INTO Counters (name, bucket, value) VALUES ('pending_prescriptions', '', -1)
+            ON CONFLICT (name, bucket) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_prescriptions_counters_update AFTER UPDATE OF status ON Prescriptions
+        WHEN (old.status IS 'pending') != (new.status IS 'pending') BEGIN
+            INSERT INTO Counters (name, bucket, value) VALUES ('pending_prescriptions', '', IIF(new.status IS 'pending', 1, -1))
+            ON CONFLICT (name, bucket) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_inventory_counters_insert AFTER INSERT ON Inventory
+        WHEN new.status IS 'available' AND new.quantity <= new.reorder_level BEGIN
+            INSERT INTO Counters (name, bucket, value) VALUES ('low_stock_items', '', 1)
+            ON CONFLICT (name, bucket) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_inventory_counters_delete AFTER DELETE ON Inventory
+        WHEN old.status IS 'available' AND old.quantity <= old.reorder_level BEGIN
+            INSERT INTO Counters (name, bucket, value) VALUES ('low_stock_items', '', -1)
+            ON CONFLICT (name, bucket) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_inventory_counters_update AFTER UPDATE OF quantity, reorder_level, status ON Inventory
+        WHEN (old.status IS 'available' AND COALESCE(old.quantity <= old.reorder_level, 0))
+            != (new.status IS 'available' AND COALESCE(new.quantity <= new.reorder_level, 0)) BEGIN
+            INSERT INTO Counters (name, bucket, value)
+            VALUES ('low_stock_items', '', IIF(new.status IS 'available' AND COALESCE(new.quantity <= new.reorder_level, 0), 1, -1))
+            ON CONFLICT (name, bucket) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_pharmacy_counters_insert AFTER INSERT ON Pharmacy
+        WHEN new.status IN ('low stock', 'out of stock') BEGIN
+            INSERT INTO Counters (name, bucket, value) VALUES ('low_stock_medications', '', 1)
+            ON CONFLICT (name, bucket) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_pharmacy_counters_delete AFTER DELETE ON Pharmacy
+        WHEN old.status IN ('low stock', 'out of stock') BEGIN
+            INSERT INTO Counters (name, bucket, value) VALUES ('low_stock_medications', '', -1)
+            ON CONFLICT (name, bucket) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_pharmacy_counters_update AFTER UPDATE OF status ON Pharmacy
+        WHEN COALESCE(old.status IN ('low stock', 'out of stock'), 0) != COALESCE(new.status IN ('low stock', 'out of stock'), 0) BEGIN
+            INSERT INTO Counters (name, bucket, value)
+            VALUES ('low_stock_medications', '', IIF(new.status IN ('low stock', 'out of stock'), 1, -1))
+            ON CONFLICT (name, bucket) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+        # Paid revenue is bucketed by the day of the bill, matching a bill_date >= day AND < next day range
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_billing_counters_insert AFTER INSERT ON Billing
+        WHEN new.status IS 'paid' BEGIN
+            INSERT INTO Counters (name, bucket, value)
+            VALUES ('paid_revenue', COALESCE(substr(new.bill_date, 1, 10), ''), COALESCE(new.amount, 0))
+            ON CONFLICT (name, bucket) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_billing_counters_delete AFTER DELETE ON Billing
+        WHEN old.status IS 'paid' BEGIN
+            INSERT INTO Counters (name, bucket, value)
+            VALUES ('paid_revenue', COALESCE(substr(old.bill_date, 1, 10), ''), -COALESCE(old.amount, 0))
+            ON CONFLICT (name, bucket) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_billing_counters_update AFTER UPDATE OF status, amount, bill_date ON Billing
+        WHEN old.status IS 'paid' OR new.status IS 'paid' BEGIN
+            INSERT INTO Counters (name, bucket, value)
+            SELECT 'paid_revenue', COALESCE(substr(old.bill_date, 1, 10), ''), -COALESCE(old.amount, 0) WHERE old.status IS 'paid'
+            ON CONFLICT (name, bucket) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO Counters (name, bucket, value)
+            SELECT 'paid_revenue', COALESCE(substr(new.bill_date, 1, 10), ''), COALESCE(new.amount, 0) WHERE new.status IS 'paid'
+            ON CONFLICT (name, bucket) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+        "INSERT OR REPLACE INTO Counters (name, bucket, value) SELECT 'active_patients', '', COUNT(*) FROM Patients WHERE status = 'active'",
+        "INSERT OR REPLACE INTO Counters (name, bucket, value) SELECT 'pending_prescriptions', '', COUNT(*) FROM Prescriptions WHERE status = 'pending'",
+        "INSERT OR REPLACE INTO Counters (name, bucket, value) SELECT 'low_stock_items', '', COUNT(*) FROM Inventory WHERE status = 'available' AND quantity <= reorder_level",
+        "INSERT OR REPLACE INTO Counters (name, bucket, value) SELECT 'low_stock_medications', '', COUNT(*) FROM Pharmacy WHERE status IN ('low stock', 'out of stock')",
+        "INSERT OR REPLACE INTO Counters (name, bucket, value) SELECT 'paid_revenue', COALESCE(substr(bill_date, 1, 10), ''), SUM(COALESCE(amount, 0)) FROM Billing WHERE status = 'paid' GROUP BY 2",
+    ]),
+    (10, "Daily rollup tables for reports", [
+        """
+        CREATE TABLE IF NOT EXISTS DailyRegistrations (
+            day TEXT NOT NULL,
+            gender TEXT NOT NULL,
+            patients INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, gender)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS DailyAppointments (
+            day TEXT NOT NULL,
+            doctor_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            appointments INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, doctor_id, status)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS DailyBilling (
+            day TEXT NOT NULL,
+            service_description TEXT NOT NULL,
+            insurance_provider TEXT NOT NULL,
+            status TEXT NOT NULL,
+            bills INTEGER NOT NULL DEFAULT 0,
+            amount REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, service_description, insurance_provider, status)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS InventoryByCategory (
+            category TEXT NOT NULL PRIMARY KEY,
+            items INTEGER NOT NULL DEFAULT 0,
+            quantity INTEGER NOT NULL DEFAULT 0,
+            value REAL NOT NULL DEFAULT 0,
+            out_of_stock INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        """,
+        # Each trigger takes the old row out of its rollup and adds the new one; NULL keys are stored as ''
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_patients_rollup_insert AFTER INSERT ON Patients BEGIN
+            INSERT INTO DailyRegistrations (day, gender, patients)
+            VALUES (COALESCE(substr(new.registration_date, 1, 10), ''), COALESCE(new.gender, ''), 1)
+            ON CONFLICT (day, gender) DO UPDATE SET patients = patients + excluded.patients;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_patients_rollup_delete AFTER DELETE ON Patients BEGIN
+            INSERT INTO DailyRegistrations (day, gender, patients)
+            VALUES (COALESCE(substr(old.registration_date, 1, 10), ''), COALESCE(old.gender, ''), -1)
+            ON CONFLICT (day, gender) DO UPDATE SET patients = patients + excluded.patients;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_patients_rollup_update AFTER UPDATE OF registration_date, gender ON Patients BEGIN
+            INSERT INTO DailyRegistrations (day, gender, patients)
+            VALUES (COALESCE(substr(old.registration_date, 1, 10), ''), COALESCE(old.gender, ''), -1)
+            ON CONFLICT (day, gender) DO UPDATE SET patients = patients + excluded.patients;
+            INSERT INTO DailyRegistrations (day, gender, patients)
+            VALUES (COALESCE(substr(new.registration_date, 1, 10), ''), COALESCE(new.gender, ''), 1)
+            ON CONFLICT (day, gender) DO UPDATE SET patients = patients + excluded.patients;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_appointments_rollup_insert AFTER INSERT ON Appointments BEGIN
+            INSERT INTO DailyAppointments (day, doctor_id, status, appointments)
+            VALUES (substr(new.appointment_date, 1, 10), new.doctor_id, COALESCE(new.status, ''), 1)
+            ON CONFLICT (day, doctor_id, status) DO UPDATE SET appointments = appointments + excluded.appointments;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_appointments_rollup_delete AFTER DELETE ON Appointments BEGIN
+            INSERT INTO DailyAppointments (day, doctor_id, status, appointments)
+            VALUES (substr(old.appointment_date, 1, 10), old.doctor_id, COALESCE(old.status, ''), -1)
+            ON CONFLICT (day, doctor_id, status) DO UPDATE SET appointments = appointments + excluded.appointments;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_appointments_rollup_update
+        AFTER UPDATE OF appointment_date, doctor_id, status ON Appointments BEGIN
+            INSERT INTO DailyAppointments (day, doctor_id, status, appointments)
+            VALUES (substr(old.appointment_date, 1, 10), old.doctor_id, COALESCE(old.status, ''), -1)
+            ON CONFLICT (day, doctor_id, status) DO UPDATE SET appointments = appointments + excluded.appointments;
+            INSERT INTO DailyAppointments (day, doctor_id, status, appointments)
+            VALUES (substr(new.appointment_date, 1, 10), new.doctor_id, COALESCE(new.status, ''), 1)
+            ON CONFLICT (day, doctor_id, status) DO UPDATE SET appointments = appointments + excluded.appointments;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_billing_rollup_insert AFTER INSERT ON Billing BEGIN
+            INSERT INTO DailyBilling (day, service_description, insurance_provider, status, bills, amount)
+            VALUES (
+                COALESCE(substr(new.bill_date, 1, 10), ''), new.service_description,
+                COALESCE(new.insurance_provider, ''), COALESCE(new.status, ''), 1, new.amount
+            )
+            ON CONFLICT (day, service_description, insurance_provider, status)
+            DO UPDATE SET bills = bills + excluded.bills, amount = amount + excluded.amount;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_billing_rollup_delete AFTER DELETE ON Billing BEGIN
+            INSERT INTO DailyBilling (day, service_description, insurance_provider, status, bills, amount)
+            VALUES (
+                COALESCE(substr(old.bill_date, 1, 10), ''), old.service_description,
+                COALESCE(old.insurance_provider, ''), COALESCE(old.status, ''), -1, -old.amount
+            )
+            ON CONFLICT (day, service_description, insurance_provider, status)
+            DO UPDATE SET bills = bills + excluded.bills, amount = amount + excluded.amount;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_billing_rollup_update
+        AFTER UPDATE OF bill_date, service_description, insurance_provider, status, amount ON Billing BEGIN
+            INSERT INTO DailyBilling (day, service_description, insurance_provider, status, bills, amount)
+            VALUES (
+                COALESCE(substr(old.bill_date, 1, 10), ''), old.service_description,
+                COALESCE(old.insurance_provider, ''), COALESCE(old.status, ''), -1, -old.amount
+            )
+            ON CONFLICT (day, service_description, insurance_provider, status)
+            DO UPDATE SET bills = bills + excluded.bills, amount = amount + excluded.amount;
+            INSERT INTO DailyBilling (day, service_description, insurance_provider, status, bills, amount)
+            VALUES (
+                COALESCE(substr(new.bill_date, 1, 10), ''), new.service_description,
+                COALESCE(new.insurance_provider, ''), COALESCE(new.status, ''), 1, new.amount
+            )
+            ON CONFLICT (day, service_description, insurance_provider, status)
+            DO UPDATE SET bills = bills + excluded.bills, amount = amount + excluded.amount;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_inventory_rollup_insert AFTER INSERT ON Inventory BEGIN
+            INSERT INTO InventoryByCategory (category, items, quantity, value, out_of_stock)
+            VALUES (
+                new.category, 1, new.quantity, new.quantity * new.unit_price,
+                new.quantity = 0 OR new.status IS 'out of stock'
+            )
+            ON CONFLICT (category) DO UPDATE SET
+                items = items + excluded.items, quantity = quantity + excluded.quantity,
+                value = value + excluded.value, out_of_stock = out_of_stock + excluded.out_of_stock;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_inventory_rollup_delete AFTER DELETE ON Inventory BEGIN
+            INSERT INTO InventoryByCategory (category, items, quantity, value, out_of_stock)
+            VALUES (
+                old.category, -1, -old.quantity, -(old.quantity * old.unit_price),
+                -(old.quantity = 0 OR old.status IS 'out of stock')
+            )
+            ON CONFLICT (category) DO UPDATE SET
+                items = items + excluded.items, quantity = quantity + excluded.quantity,
+                value = value + excluded.value, out_of_stock = out_of_stock + excluded.out_of_stock;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_inventory_rollup_update
+        AFTER UPDATE OF category, quantity, unit_price, status ON Inventory BEGIN
+            INSERT INTO InventoryByCategory (category, items, quantity, value, out_of_stock)
+            VALUES (
+                old.category, -1, -old.quantity, -(old.quantity * old.unit_price),
+                -(old.quantity = 0 OR old.status IS 'out of stock')
+            )
+            ON CONFLICT (category) DO UPDATE SET
+                items = items + excluded.items, quantity = quantity + excluded.quantity,
+                value = value + excluded.value, out_of_stock = out_of_stock + excluded.out_of_stock;
+            INSERT INTO InventoryByCategory (category, items, quantity, value, out_of_stock)
+            VALUES (
+                new.category, 1, new.quantity, new.quantity * new.unit_price,
+                new.quantity = 0 OR new.status IS 'out of stock'
+            )
+            ON CONFLICT (category) DO UPDATE SET
+                items = items + excluded.items, quantity = quantity + excluded.quantity,
+                value = value + excluded.value, out_of_stock = out_of_stock + excluded.out_of_stock;
+        END
+        """,
+    ] + [f"INSERT INTO {table} {query}" for table, query in ROLLUP_QUERIES.items()]),
+    (11, "Precomputed patient age bands", [
+        "ALTER TABLE Patients ADD COLUMN age_band TEXT",
+        f"UPDATE Patients SET age_band = {AGE_BAND_SQL.format(age=AGE_SQL.format(dob='date_of_birth', today=TODAY_SQL))}",
+        "CREATE INDEX IF NOT EXISTS idx_patients_age_band ON Patients (age_band, registration_date)",
+        "CREATE INDEX IF NOT EXISTS idx_patients_date_of_birth ON Patients (date_of_birth)",
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_patients_age_band_insert AFTER INSERT ON Patients BEGIN
+            UPDATE Patients SET age_band = {AGE_BAND_SQL.format(age=AGE_SQL.format(dob='new.date_of_birth', today=TODAY_SQL))}
+            WHERE patient_id = new.patient_id;
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_patients_age_band_update AFTER UPDATE OF date_of_birth ON Patients BEGIN
+            UPDATE Patients SET age_band = {AGE_BAND_SQL.format(age=AGE_SQL.format(dob='new.date_of_birth', today=TODAY_SQL))}
+            WHERE patient_id = new.patient_id;
+        END
+        """,
+        # Last day each periodic maintenance task ran
+        """
+        CREATE TABLE IF NOT EXISTS MaintenanceRuns (
+            task TEXT PRIMARY KEY,
+            last_run DATE NOT NULL
+        )
+        """,
+        f"INSERT OR REPLACE INTO MaintenanceRuns (task, last_run) VALUES ('age_bands', {TODAY_SQL})",
+    ]),
+    (12, "Change log for the analytics mirror", [
+        # Rows updated or deleted since the mirror last synced; inserts are found by rowid instead
+        """
+        CREATE TABLE IF NOT EXISTS MirrorChanges (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL
+        )
+        """,
+    ] + [
+        statement
+        for table in MIRROR_TRACKED_TABLES
+        for statement in (
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table.lower()}_mirror_update AFTER UPDATE ON {table} BEGIN
+                INSERT INTO MirrorChanges (table_name, row_id) VALUES ('{table}', old.rowid);
+                INSERT INTO MirrorChanges (table_name, row_id) SELECT '{table}', new.rowid WHERE new.rowid != old.rowid;
+            END
+            """,
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table.lower()}_mirror_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO MirrorChanges (table_name, row_id) VALUES ('{table}', old.rowid);
+            END
+            """,
+        )
+    ]),
+    (13, "Cap the analytics mirror change log", [
+        # Trimmed every thousand entries rather than on every insert
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_mirror_changes_cap AFTER INSERT ON MirrorChanges
+        WHEN new.seq % 1000 = 0 BEGIN
+            DELETE FROM MirrorChanges WHERE seq <= new.seq - {MIRROR_LOG_LIMIT};
+        END
+        """,
+    ]),
+    (14, "Page unpaid bills by due date with undated bills last", [
+        # The unpaid bills list pages on this expression; a NULL due date cannot be paged past
+        "DROP INDEX IF EXISTS idx_billing_due_date",
+        f"CREATE INDEX IF NOT EXISTS idx_billing_due_date ON Billing (COALESCE(due_date, '{NO_DUE_DATE}'))",
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Tables that triggers write to when the key table changes, so cached reads of them are invalidated too
+TRIGGER_WRITES = {
+    'Users': ('MirrorChanges',),
+    'Patients': ('PatientSearch', 'Counters', 'DailyRegistrations', 'MirrorChanges'),
+    'Appointments': ('DailyAppointments', 'MirrorChanges'),
+    'MedicalHistory': ('MedicalHistorySearch', 'MirrorChanges'),
+    'Prescriptions': ('PrescriptionSearch', 'Counters', 'MirrorChanges'),
+    'Inventory': ('Counters', 'InventoryByCategory', 'MirrorChanges'),
+    'Pharmacy': ('Counters', 'MirrorChanges'),
+    'Billing': ('Counters', 'DailyBilling', 'MirrorChanges'),
+    'Staff': ('MirrorChanges',),
+    'AuditLogs': ('MirrorChanges',),
+    'UserSessions': ('MirrorChanges',),
+}
+
+# What each trigger-maintained counter holds, as (bucket, value) rows computed from scratch
+COUNTER_QUERIES = {
+    'active_patients': "SELECT '', COUNT(*) FROM Patients WHERE status = 'active'",
+    'pending_prescriptions': "SELECT '', COUNT(*) FROM Prescriptions WHERE status = 'pending'",
+    'low_stock_items': "SELECT '', COUNT(*) FROM Inventory WHERE status = 'available' AND quantity <= reorder_level",
+    'low_stock_medications': "SELECT '', COUNT(*) FROM Pharmacy WHERE status IN ('low stock', 'out of stock')",
+    'paid_revenue': "SELECT COALESCE(substr(bill_date, 1, 10), ''), SUM(COALESCE(amount, 0)) FROM Billing WHERE status = 'paid' GROUP BY 1",
+}
+
+# Shortest term the trigram tokenizer can match
+FTS_MIN_TERM_LENGTH = 3
+
+# Entity picker lookups: entity -> (table, key column, label expression, name column, fixed filter, match any word).
+# Doctors match the start of any word so "smith" finds "Dr. John Smith"; the role index keeps that scan to doctors
+PICKER_ENTITIES = {
+    'patient': ('Patients', 'patient_id', "first_name || ' ' || last_name || ' (ID: ' || patient_id || ')'", None, None, False),
+    'doctor': ('Users', 'user_id', 'full_name', 'full_name', "role = 'doctor'", True),
+    'medication': ('Pharmacy', 'medication_id', "name || ' (' || dosage || ')'", 'name', None, False),
+}
+
+# Clinical search sources: label -> (FTS table, content table, key column, date column, title expression)
+CLINICAL_SEARCH_SOURCES = {
+    'Medical Record': ('MedicalHistorySearch', 'MedicalHistory', 'record_id', 'date', 't.diagnosis'),
+    'Prescription': ('PrescriptionSearch', 'Prescriptions', 'prescription_id', 'created_at',
+                     "(SELECT name FROM Pharmacy WHERE medication_id = t.medication_id) || ' ' || t.dosage"),
+}
+SNIPPET_MARKERS = ('\x02', '\x03')
+SNIPPET_TOKENS = 24
+CLINICAL_SEARCH_WINDOW = 1000
+
+# Representative page queries and the index each one is expected to use
+QUERY_PLAN_CHECKS = [
+    ("SELECT COUNT(*) FROM Patients WHERE status = 'active'", "idx_patients_status_registration_date"),
+    ("SELECT patient_id FROM Patients WHERE status = 'active' ORDER BY last_name, first_name", "idx_patients_status_name"),
+    ("SELECT patient_id FROM Patients ORDER BY registration_date DESC", "idx_patients_registration_date"),
+    ("SELECT gender, COUNT(*) FROM Patients GROUP BY gender", "idx_patients_gender"),
+    ("SELECT COUNT(*) FROM Appointments WHERE appointment_date = '2025-01-01'", "idx_appointments_date_time"),
+    ("SELECT appointment_id FROM Appointments WHERE appointment_date BETWEEN '2025-01-01' AND '2025-01-07' ORDER BY appointment_date, appointment_time", "idx_appointments_date_time"),
+    ("SELECT COUNT(*) FROM Appointments WHERE doctor_id = 1 AND appointment_date = '2025-01-01' AND appointment_time BETWEEN '09:00:00' AND '09:30:00'", "idx_appointments_doctor_date"),
+    ("SELECT record_id FROM MedicalHistory WHERE patient_id = 1 ORDER BY date DESC", "idx_medical_history_patient_date"),
+    ("SELECT COALESCE(SUM(amount), 0) FROM Billing WHERE bill_date BETWEEN '2025-01-01' AND '2025-02-01' AND status = 'paid'", "idx_billing_status_date"),
+    ("SELECT bill_id FROM Billing WHERE bill_date >= '2025-01-01' ORDER BY bill_date DESC", "idx_billing_bill_date"),
+    (f"SELECT bill_id FROM Billing WHERE +status IN ('unpaid', 'partial', 'overdue') ORDER BY COALESCE(due_date, '{NO_DUE_DATE}'), bill_id", "idx_billing_due_date"),
+    (f"SELECT bill_id FROM Billing WHERE COALESCE(due_date, '{NO_DUE_DATE}') >= '2025-01-01' ORDER BY COALESCE(due_date, '{NO_DUE_DATE}'), bill_id", "idx_billing_due_date"),
+    ("SELECT COUNT(*) FROM Prescriptions WHERE status = 'pending'", "idx_prescriptions_status_created"),
+    ("SELECT prescription_id FROM Prescriptions WHERE patient_id = 1 AND status = 'filled' ORDER BY created_at DESC", "idx_prescriptions_patient"),
+    ("SELECT DISTINCT category FROM Pharmacy ORDER BY category", "idx_pharmacy_category_name"),
+    ("SELECT medication_id FROM Pharmacy ORDER BY category, name", "idx_pharmacy_category_name"),
+    ("SELECT DISTINCT category FROM Inventory ORDER BY category", "idx_inventory_category_name"),
+    ("SELECT item_id FROM Inventory WHERE expiry_date BETWEEN '2025-01-01' AND '2025-02-01' ORDER BY expiry_date", "idx_inventory_expiry_date"),
+    ("SELECT COUNT(*) FROM Users WHERE role = 'admin'", "idx_users_role_full_name_nocase"),
+    ("SELECT full_name FROM Users WHERE role = 'doctor' ORDER BY full_name", "idx_users_role_name"),
+    ("SELECT DISTINCT department FROM Staff ORDER BY department", "idx_staff_department"),
+    ("SELECT log_id FROM AuditLogs ORDER BY timestamp DESC LIMIT 10", "idx_audit_logs_timestamp"),
+    ("SELECT activity FROM AuditLogs WHERE user_id = 1 ORDER BY timestamp DESC LIMIT 50", "idx_audit_logs_user_timestamp"),
+    ("SELECT DISTINCT activity FROM AuditLogs ORDER BY activity", "idx_audit_logs_activity"),
+    ("SELECT session_id FROM UserSessions ORDER BY login_time DESC LIMIT 1000", "idx_user_sessions_login_time"),
+    ("SELECT patient_id FROM Patients WHERE status = 'active' ORDER BY registration_date DESC, patient_id DESC LIMIT 50", "idx_patients_status_registration_date"),
+    ("SELECT patient_id FROM Patients WHERE status = 'active' ORDER BY first_name, patient_id LIMIT 50", "idx_patients_status_first_name"),
+    ("SELECT bill_id FROM Billing ORDER BY amount DESC, bill_id DESC LIMIT 50", "idx_billing_amount"),
+    ("SELECT bill_id FROM Billing WHERE status = 'unpaid' ORDER BY amount DESC, bill_id DESC LIMIT 50", "idx_billing_status_amount"),
+    ("SELECT item_id FROM Inventory WHERE status = 'available' ORDER BY category, item_name, item_id LIMIT 50", "idx_inventory_status_category_name"),
+    ("SELECT user_id FROM Users WHERE role = 'doctor' AND (full_name LIKE 'jo%' ESCAPE '\\' OR full_name LIKE '% jo%' ESCAPE '\\') ORDER BY full_name COLLATE NOCASE LIMIT 20", "idx_users_role_full_name_nocase"),
+    ("SELECT medication_id FROM Pharmacy WHERE name LIKE 'am%' ESCAPE '\\' ORDER BY name COLLATE NOCASE LIMIT 20", "idx_pharmacy_name_nocase"),
+    ("SELECT age_band, COUNT(*) FROM Patients GROUP BY age_band", "idx_patients_age_band"),
+    ("SELECT patient_id FROM Patients WHERE age_band = '18-30' ORDER BY registration_date DESC, patient_id DESC LIMIT 50", "idx_patients_age_band"),
+    ("SELECT patient_id FROM Patients WHERE date_of_birth > '2008-02-27' AND date_of_birth <= '2008-03-02'", "idx_patients_date_of_birth"),
+]
 
 # Database initialization
 def init_db():
-    conn = get_connection()
+    global _column_dtypes
+    _column_dtypes = None
+    
+    with pooled_connection() as conn:
+        # WAL lets readers keep reading while the writer commits; the mode persists in the file
+        conn.execute("PRAGMA journal_mode = WAL")
+        _create_tables(conn)
+        conn.commit()
+        migrate(conn)
+
+@st.cache_resource(show_spinner=False)
+def bootstrap_db(schema_version=SCHEMA_VERSION):
+    """Initialize the database once per process for the given schema version"""
+    init_db()
+    return schema_version
+
+def get_schema_version(conn):
+    """Return the highest migration version applied to the database"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS SchemaVersion (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    
+    result = conn.execute("SELECT MAX(version) FROM SchemaVersion").fetchone()
+    return result[0] or 0
+
+def migrate(conn):
+    """Apply pending schema migrations in order, one transaction per migration"""
+    for version, description, statements in MIGRATIONS:
+        if version <= get_schema_version(conn):
+            continue
+        
+        # Take the write lock, then re-check in case another process migrated first
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if version > get_schema_version(conn):
+                for statement in statements:
+                    conn.execute(statement)
+                
+                conn.execute(
+                    "INSERT INTO SchemaVersion (version, description, applied_at) VALUES (?, ?, ?)",
+                    (version, description, datetime.now())
+                )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    
+    return get_schema_version(conn)
+
+def check_query_plans():
+    """Return (query, expected_index, plan) for every check query that does not use its index"""
+    failures = []
+    
+    with pooled_connection() as conn:
+        for query, expected_index in QUERY_PLAN_CHECKS:
+            plan = ' | '.join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}"))
+            if expected_index not in plan:
+                failures.append((query, expected_index, plan))
+    
+    return failures
+
+def verify_counters():
+    """Return (name, bucket, stored, expected) for every counter that has drifted from its tables"""
+    with pooled_connection() as conn:
+        # One read snapshot, so writes committed meanwhile cannot show up as drift
+        conn.execute("BEGIN")
+        try:
+            stored = {(name, bucket): value for name, bucket, value in conn.execute("SELECT name, bucket, value FROM Counters")}
+            expected = {
+                (name, bucket): value
+                for name, query in COUNTER_QUERIES.items()
+                for bucket, value in conn.execute(query)
+            }
+        finally:
+            conn.rollback()
+    
+    # Revenue is summed in floating point, so differences under a cent are not drift
+    return [
+        (name, bucket, stored.get((name, bucket), 0), expected.get((name, bucket), 0))
+        for name, bucket in sorted(set(stored) | set(expected))
+        if round(stored.get((name, bucket), 0) - expected.get((name, bucket), 0), 2) != 0
+    ]
+
+def rebuild_counters():
+    """Recompute every counter from its tables in one transaction; returns the number of counter rows"""
+    with transaction() as conn:
+        conn.execute("DELETE FROM Counters")
+        for name, query in COUNTER_QUERIES.items():
+            conn.execute(f"INSERT INTO Counters (name, bucket, value) SELECT '{name}', * FROM ({query})")
+        
+        return conn.execute("SELECT COUNT(*) FROM Counters").fetchone()[0]
+
+def backfill_rollups():
+    """Recompute every report rollup from its source table in one transaction; returns rows written per rollup"""
+    written = {}
+    
+    with transaction() as conn:
+        for table, query in ROLLUP_QUERIES.items():
+            conn.execute(f"DELETE FROM {table}")
+            written[table] = conn.execute(f"INSERT INTO {table} {query}").rowcount
+    
+    return written
+
+def refresh_age_bands(today=None):
+    """Move patients whose birthdays since the last run put them in a new age band; returns patients moved.
+    
+    Runs at most once a day. A band only changes on a birthday that crosses a
+    band boundary, so each boundary is one indexed date_of_birth range instead
+    of a pass over every patient. A first run, or a gap of over a year, recomputes
+    every band.
+    """
+    global _age_bands_checked
+    
+    today = today or datetime.now().strftime('%Y-%m-%d')
+    if _age_bands_checked == today:
+        return 0
+    
+    band = AGE_BAND_SQL.format(age=AGE_SQL.format(dob='date_of_birth', today=':today'))
+    year_ago = (datetime.strptime(today, '%Y-%m-%d') - timedelta(days=365)).strftime('%Y-%m-%d')
+    moved = 0
+    
+    with transaction() as conn:
+        row = conn.execute("SELECT last_run FROM MaintenanceRuns WHERE task = 'age_bands'").fetchone()
+        last_run = row[0] if row else None
+        
+        if last_run == today:
+            pass
+        elif last_run is None or last_run > today or last_run < year_ago:
+            moved = conn.execute(
+                f"UPDATE Patients SET age_band = {band} WHERE age_band IS NOT {band}", {'today': today}
+            ).rowcount
+        else:
+            # Widened by a day either side so leap-day birthdays are never skipped
+            for _, oldest in AGE_BANDS[:-1]:
+                moved += conn.execute(
+                    f"""
+                    UPDATE Patients SET age_band = {band}
+                    WHERE date_of_birth > date(:last_run, :shift, '-1 day')
+                    AND date_of_birth <= date(:today, :shift, '+1 day')
+                    AND age_band IS NOT {band}
+                    """,
+                    {'today': today, 'last_run': last_run, 'shift': f"-{oldest + 1} years"}
+                ).rowcount
+        
+        conn.execute("INSERT OR REPLACE INTO MaintenanceRuns (task, last_run) VALUES ('age_bands', ?)", (today,))
+    
+    _age_bands_checked = today
+    return moved
+
+def _create_tables(conn):
+    """Create all application tables if they do not exist"""
     
     # Create Users table
     conn.execute('''
@@ -185,215 +1104,1490 @@ def init_db():
         FOREIGN KEY (user_id) REFERENCES Users(user_id)
     )
     ''')
+
+class _TrackingCursor(sqlite3.Cursor):
+    """Cursor that notes which tables its statements write to and profiles them"""
+    
+    def execute(self, sql, parameters=()):
+        self.connection._note_writes(sql)
+        started = _profile_start(self, sql, parameters)
+        try:
+            super().execute(sql, parameters)
+        except Exception:
+            _profile_error(self, started)
+            raise
+        _profile_step(self, started, max(self.rowcount, 0), self.description is None)
+        return self
+    
+    def executemany(self, sql, seq_of_parameters):
+        self.connection._note_writes(sql)
+        started = _profile_start(self, sql, None)
+        try:
+            super().executemany(sql, seq_of_parameters)
+        except Exception:
+            _profile_error(self, started)
+            raise
+        _profile_step(self, started, max(self.rowcount, 0), True)
+        return self
+    
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        _profile_step(self, started, int(row is not None), True)
+        return row
+    
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(size or self.arraysize)
+        _profile_step(self, started, len(rows), len(rows) < (size or self.arraysize))
+        return rows
+    
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        _profile_step(self, started, len(rows), True)
+        return rows
+
+class _TrackingConnection(sqlite3.Connection):
+    """Connection that invalidates cached query results for tables it commits writes to"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.written_tables = set()
+    
+    def cursor(self, factory=_TrackingCursor):
+        return super().cursor(factory)
+    
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
     
-    conn.commit()
-    conn.close()
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+    
+    def _note_writes(self, sql):
+        for table in _written_tables(sql):
+            self.written_tables.add(table)
+            self.written_tables.update(TRIGGER_WRITES.get(table, ()))
+    
+    def commit(self):
+        super().commit()
+        if self.written_tables:
+            invalidate_cache(*self.written_tables)
+            self.written_tables.clear()
+    
+    def rollback(self):
+        super().rollback()
+        self.written_tables.clear()
 
-def get_connection():
-    """Create or get existing SQLite database connection"""
-    return sqlite3.connect('hospital_management.db', detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+def _read_tables(sql):
+    """Return the tables a query reads: every name after FROM or JOIN, including comma-separated FROM lists"""
+    tables = set()
+    state = None  # 'table' when a table name is expected, 'after' once a FROM item has been read
+    aliased = False
+    depth = 0
+    subqueries = []  # Depths of open subqueries used as FROM items, after which the list carries on
+    
+    for token in _SQL_TOKENS.findall(_SQL_STRINGS.sub("''", sql).replace('"', '')):
+        upper = token.upper()
+        name = token[0].isalpha() or token[0] == '_'
+        
+        if token == '(':
+            depth += 1
+            # A subquery, or a table-valued function's arguments, in place of a table name
+            if state in ('table', 'after'):
+                subqueries.append(depth)
+            state = None
+        elif token == ')':
+            if subqueries and subqueries[-1] == depth:
+                subqueries.pop()
+                state, aliased = 'after', False
+            else:
+                state = None
+            depth -= 1
+        elif upper in ('FROM', 'JOIN'):
+            state = 'table'
+        elif state == 'table' and name:
+            tables.add(token)
+            state, aliased = 'after', False
+        elif state == 'after' and token == ',':
+            state = 'table'
+        elif state == 'after' and (upper == 'AS' or (name and not aliased)):
+            aliased = aliased or upper != 'AS'
+        else:
+            state = None
+    
+    return tables
 
-def execute_query(query, params=None):
-    """Execute a query with optional parameters"""
-    conn = get_connection()
+def _written_tables(sql):
+    """Return the tables a statement writes to, or {'*'} for schema changes"""
+    if _SCHEMA_CHANGE.match(sql):
+        return {'*'}
+    return set(_WRITE_TABLES.findall(sql))
+
+@functools.lru_cache(maxsize=1024)
+def _fingerprint(sql):
+    """Normalize a statement by folding literals, placeholder lists and whitespace"""
+    sql = _FINGERPRINT_LITERALS.sub('?', sql)
+    sql = _FINGERPRINT_LISTS.sub('(?+)', sql)
+    return ' '.join(sql.split())
+
+def _query_caller():
+    """Return module.function of the first caller outside the data access layer"""
+    # Statements run by the writer thread are attributed to the code that queued them
+    caller = getattr(_local, 'write_caller', None)
+    if caller:
+        return caller
     
-    if params:
-        conn.execute(query, params)
-    else:
-        conn.execute(query)
+    frame = sys._getframe(3)
+    
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module not in (__name__, 'contextlib') and not module.startswith('pandas'):
+            return f"{module}.{frame.f_code.co_name}"
+        frame = frame.f_back
     
-    conn.commit()
-    conn.close()
+    return 'unknown'
 
-def fetch_one(query, params=None):
-    """Fetch one row from a query"""
-    conn = get_connection()
+def _profile_start(cursor, sql, parameters):
+    """Begin profiling a statement on a cursor; returns the start time or None if disabled"""
+    cursor.profile = None
+    if not QUERY_PROFILING:
+        return None
+    
+    fingerprint = _fingerprint(sql)
+    caller = _query_caller()
+    
+    with _query_stats_lock:
+        stats = _query_stats.get(fingerprint)
+        if stats is None:
+            stats = _query_stats[fingerprint] = {
+                "fingerprint": fingerprint, "calls": 0, "errors": 0, "slow": 0,
+                "total_time": 0.0, "max_time": 0.0, "rows": 0, "callers": set()
+            }
+        stats["calls"] += 1
+        stats["callers"].add(caller)
+    
+    cursor.profile = {"stats": stats, "sql": sql, "parameters": parameters, "caller": caller,
+                      "elapsed": 0.0, "rows": 0, "finished": False}
+    return time.perf_counter()
+
+def _profile_error(cursor, started):
+    """Count a failed statement against its fingerprint"""
+    if started is None:
+        return
+    
+    with _query_stats_lock:
+        cursor.profile["stats"]["errors"] += 1
+        cursor.profile["stats"]["total_time"] += time.perf_counter() - started
+    cursor.profile = None
+
+def _profile_step(cursor, started, rows, finished):
+    """Add the time and rows of an execute/fetch step, logging the statement once it finishes slow"""
+    profile = getattr(cursor, 'profile', None)
+    if started is None or profile is None or profile["finished"]:
+        return
+    
+    elapsed = time.perf_counter() - started
+    profile["elapsed"] += elapsed
+    profile["rows"] += rows
+    profile["finished"] = finished
+    
+    stats = profile["stats"]
+    with _query_stats_lock:
+        stats["total_time"] += elapsed
+        stats["rows"] += rows
+        stats["max_time"] = max(stats["max_time"], profile["elapsed"])
+        if finished and profile["elapsed"] >= SLOW_QUERY_THRESHOLD:
+            stats["slow"] += 1
+    
+    if finished and profile["elapsed"] >= SLOW_QUERY_THRESHOLD:
+        _log_slow_query(cursor.connection, profile)
+
+def _log_slow_query(conn, profile):
+    """Append a slow statement and its query plan to the slow query log"""
+    plan = []
+    if profile["parameters"] is not None and _EXPLAINABLE.match(profile["sql"]):
+        try:
+            # Bypass the tracking cursor so the plan lookup is not profiled itself
+            plan = [row[-1] for row in sqlite3.Connection.execute(
+                conn, "EXPLAIN QUERY PLAN " + profile["sql"], profile["parameters"]
+            ).fetchall()]
+        except sqlite3.Error as e:
+            plan = [f"unavailable: {e}"]
     
-    if params:
-        result = conn.execute(query, params).fetchone()
+    entry = {
+        "logged_at": datetime.now().isoformat(timespec='seconds'),
+        "duration_ms": round(profile["elapsed"] * 1000, 1),
+        "rows": profile["rows"],
+        "caller": profile["caller"],
+        "fingerprint": profile["stats"]["fingerprint"],
+        "plan": plan,
+    }
+    
+    try:
+        with _slow_log_lock, open(SLOW_QUERY_LOG, 'a') as log:
+            log.write(json.dumps(entry) + '\n')
+    except OSError as e:
+        print(f"Error writing slow query log: {e}")
+
+def get_query_stats(top_n=20, order_by="total_time"):
+    """Return the top_n statement fingerprints ordered by total_time, max_time, calls, rows or errors"""
+    with _query_stats_lock:
+        stats = [dict(s, callers=sorted(s["callers"])) for s in _query_stats.values()]
+    
+    for s in stats:
+        s["avg_time"] = s["total_time"] / s["calls"] if s["calls"] else 0.0
+    
+    return sorted(stats, key=lambda s: s[order_by], reverse=True)[:top_n]
+
+def reset_query_stats():
+    """Clear the aggregated query statistics"""
+    with _query_stats_lock:
+        _query_stats.clear()
+
+def read_slow_query_log(limit=100):
+    """Return the most recent slow query log entries, newest first"""
+    try:
+        with _slow_log_lock, open(SLOW_QUERY_LOG) as log:
+            lines = log.readlines()[-limit:]
+    except FileNotFoundError:
+        return []
+    
+    entries = []
+    for line in reversed(lines):
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            continue
+    
+    return entries
+
+def get_connection(read_only=False, path=None):
+    """Open a new SQLite database connection with the configured pragmas, optionally read-only or to another file"""
+    path = path or DB_PATH
+    if read_only:
+        database, uri = f"file:{pathname2url(os.path.abspath(path))}?mode=ro", True
     else:
-        result = conn.execute(query).fetchone()
+        database, uri = path, False
     
-    conn.close()
-    return result
+    conn = sqlite3.connect(
+        database,
+        detect_types=sqlite3.PARSE_COLNAMES,
+        check_same_thread=False,
+        timeout=BUSY_TIMEOUT,
+        factory=_TrackingConnection,
+        uri=uri
+    )
+    
+    for name, value in CONNECTION_PRAGMAS.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    
+    return conn
+
+def _is_healthy(conn):
+    """Check that a pooled connection can still run a statement"""
+    try:
+        conn.execute("SELECT 1").fetchone()
+        return True
+    except sqlite3.Error:
+        return False
+
+def _discard_connection(conn):
+    """Close a connection and free its slot in the pool"""
+    global _pool_created
+    
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+    
+    with _pool_lock:
+        _pool_created -= 1
+
+def _acquire_connection():
+    """Take an idle connection from the pool, opening one if the pool is not full"""
+    global _pool_created
+    
+    try:
+        conn, last_used = _pool.get_nowait()
+    except queue.Empty:
+        with _pool_lock:
+            can_open = _pool_created < POOL_SIZE
+            if can_open:
+                _pool_created += 1
+        
+        if can_open:
+            try:
+                return get_connection()
+            except Exception:
+                with _pool_lock:
+                    _pool_created -= 1
+                raise
+        
+        # Pool is full, wait for another thread to give a connection back
+        try:
+            conn, last_used = _pool.get(timeout=POOL_TIMEOUT)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Connection pool exhausted")
+    
+    # Ping connections that have been idle for a while before handing them out
+    if time.monotonic() - last_used > HEALTH_CHECK_INTERVAL and not _is_healthy(conn):
+        _discard_connection(conn)
+        return _acquire_connection()
+    
+    return conn
+
+def _release_connection(conn):
+    """Return a connection to the pool, rolling back any unfinished transaction"""
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+    except sqlite3.Error:
+        _discard_connection(conn)
+        return
+    
+    _pool.put((conn, time.monotonic()))
+
+@contextmanager
+def pooled_connection():
+    """Borrow a pooled connection, reusing the one already held by this thread"""
+    conn = getattr(_local, 'connection', None)
+    
+    if conn is not None:
+        yield conn
+        return
+    
+    conn = _acquire_connection()
+    _local.connection = conn
+    
+    try:
+        yield conn
+    finally:
+        _local.connection = None
+        _release_connection(conn)
+
+@contextmanager
+def transaction():
+    """Run a unit of work on one connection with a single BEGIN IMMEDIATE / COMMIT.
+    
+    Nested calls on the same thread join the outer transaction. Record helpers
+    called inside the block leave the commit to it and raise instead of
+    swallowing errors, so any failure rolls back the whole unit.
+    """
+    with pooled_connection() as conn:
+        depth = getattr(_local, 'transaction_depth', 0)
+        
+        if depth:
+            _local.transaction_depth = depth + 1
+            try:
+                yield conn
+            finally:
+                _local.transaction_depth = depth
+            return
+        
+        conn.execute("BEGIN IMMEDIATE")
+        _local.transaction_depth = 1
+        
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            _local.transaction_depth = 0
+
+@contextmanager
+def read_only_connection(path=None):
+    """Route this thread's reads through its own read-only connection until the block exits.
+    
+    The connection is opened on the thread's first use and kept for its lifetime,
+    so long-lived worker threads pay for it once and never take a pooled
+    connection away from page renders. Writes still go through the single writer.
+    path reads another database file instead, such as the analytics mirror.
+    """
+    path = path or DB_PATH
+    connections = getattr(_local, 'read_only_connections', None)
+    if connections is None:
+        connections = _local.read_only_connections = {}
+    
+    conn = connections.get(path)
+    
+    if conn is None:
+        conn = get_connection(read_only=True, path=path)
+        connections[path] = conn
+        with _read_only_lock:
+            _read_only_connections.append(conn)
+    
+    previous = getattr(_local, 'connection', None)
+    _local.connection = conn
+    
+    try:
+        yield conn
+    finally:
+        _local.connection = previous
+        if conn.in_transaction:
+            conn.rollback()
+
+def _in_transaction():
+    """Check whether the current thread is inside a transaction() block"""
+    return getattr(_local, 'transaction_depth', 0) > 0
+
+def get_pool_stats():
+    """Return the number of open, idle and in-use pooled connections"""
+    with _pool_lock:
+        created = _pool_created
+    idle = _pool.qsize()
+    
+    return {"size": POOL_SIZE, "open": created, "idle": idle, "in_use": created - idle}
+
+def close_pool():
+    """Close every idle pooled connection"""
+    while True:
+        try:
+            conn, _ = _pool.get_nowait()
+        except queue.Empty:
+            break
+        _discard_connection(conn)
+
+atexit.register(close_pool)
+
+def close_read_only_connections():
+    """Close every per-thread read-only connection"""
+    with _read_only_lock:
+        connections = list(_read_only_connections)
+        _read_only_connections.clear()
+    
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
 
-def fetch_all(query, params=None):
-    """Fetch all rows from a query"""
-    conn = get_connection()
+atexit.register(close_read_only_connections)
+
+def _writer_connection():
+    """Return the dedicated writer connection, opening it on first use"""
+    global _writer_conn
+    
+    if _writer_conn is None:
+        _writer_conn = get_connection()
+    return _writer_conn
+
+def _drain_writes():
+    """Commit queued write requests in groups until the queue is empty (caller holds the write lock)"""
+    conn = _writer_connection()
+    
+    while True:
+        batch = []
+        while len(batch) < WRITE_BATCH_SIZE:
+            try:
+                batch.append(_write_queue.get_nowait())
+            except queue.Empty:
+                break
+        
+        if not batch:
+            return
+        
+        _commit_write_batch(conn, batch)
+
+def _commit_write_batch(conn, batch):
+    """Run a group of write requests in one transaction and resolve their futures"""
+    deadline = time.monotonic() + WRITE_TIMEOUT
+    delay = 0.01
+    failures = []
     
-    if params:
-        results = conn.execute(query, params).fetchall()
+    while batch:
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            
+            for request in batch:
+                query, params, caller, future = request
+                _local.write_caller = caller
+                try:
+                    cursor = conn.execute(query, params)
+                except sqlite3.Error as e:
+                    if "locked" in str(e) or "busy" in str(e):
+                        raise
+                    # A bad request fails on its own: drop it and replay the rest of the group
+                    conn.rollback()
+                    failures.append((future, e))
+                    batch = [other for other in batch if other is not request]
+                    break
+                results.append((future, (cursor.lastrowid, cursor.rowcount)))
+            else:
+                conn.commit()
+                break
+        except sqlite3.OperationalError as e:
+            if conn.in_transaction:
+                conn.rollback()
+            
+            if ("locked" in str(e) or "busy" in str(e)) and time.monotonic() < deadline:
+                _writer_stats["busy_retries"] += 1
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+                continue
+            
+            results = [(future, e) for *_, future in batch]
+            break
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            results = [(future, e) for *_, future in batch]
+            break
+        finally:
+            _local.write_caller = None
     else:
-        results = conn.execute(query).fetchall()
+        results = []
+    
+    _writer_stats["requests"] += len(results) + len(failures)
+    _writer_stats["batches"] += 1
+    _writer_stats["max_batch"] = max(_writer_stats["max_batch"], len(results) + len(failures))
+    
+    # Callers are only released once their write is committed (or has definitely failed)
+    for future, result in results + failures:
+        if isinstance(result, Exception):
+            _writer_stats["failed"] += 1
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+def _submit_write(query, params):
+    """Queue a write and wait for it to commit; returns (lastrowid, rowcount).
+    
+    Whichever waiting caller holds the write lock acts as the single writer and
+    commits every queued request as a group, so callers never hand off to an
+    idle thread and a write is only acknowledged once it is durable.
+    """
+    future = Future()
+    caller = _query_caller() if QUERY_PROFILING else None
+    _write_queue.put((query, tuple(params or ()), caller, future))
+    
+    # Whoever holds the lock re-checks the queue after releasing it, so a caller
+    # that finds the lock taken can simply wait for its request to be committed
+    while not _write_queue.empty() and _write_lock.acquire(blocking=False):
+        try:
+            _drain_writes()
+        finally:
+            _write_lock.release()
+    
+    return future.result()
+
+def _run_write(query, params):
+    """Run a write in the current transaction, or through the writer thread outside one"""
+    if _in_transaction():
+        with pooled_connection() as conn:
+            cursor = conn.execute(query, params or ())
+            return cursor.lastrowid, cursor.rowcount
+    
+    return _submit_write(query, params)
+
+def get_writer_stats():
+    """Return counters for the single writer"""
+    stats = dict(_writer_stats)
+    stats["queued"] = _write_queue.qsize()
+    return stats
+
+def shutdown_writer():
+    """Commit any queued writes and close the writer connection"""
+    global _writer_conn
+    
+    with _write_lock:
+        if _writer_conn is None:
+            return
+        
+        _drain_writes()
+        _writer_conn.close()
+        _writer_conn = None
+
+atexit.register(shutdown_writer)
+
+def fts_match_expression(term, min_length=FTS_MIN_TERM_LENGTH):
+    """Build an FTS5 MATCH expression requiring every word of term, or None if no word is long enough.
+    
+    Words shorter than min_length (the trigram tokenizer cannot match fewer than
+    three characters) are dropped; callers fall back to LIKE when nothing is left.
+    """
+    words = [word for word in term.split() if len(word) >= min_length]
+    if not words:
+        return None
+    
+    # Quote each word as a phrase so punctuation such as '-' or '@' is matched literally
+    return ' '.join('"' + word.replace('"', '""') + '"' for word in words)
+
+def search_patients(term, limit=20, status=None):
+    """Return up to limit matching patients, names starting with the term first and then other substring matches.
+    
+    Rows are (patient_id, first_name, last_name, date_of_birth, contact_number, status).
+    Terms too short for the trigram index match an exact ID or a name prefix instead.
+    """
+    columns = "p.patient_id, p.first_name, p.last_name, p.date_of_birth, p.contact_number, p.status"
+    status_clause = " AND p.status = ?" if status else ""
+    status_params = [status] if status else []
+    
+    match_expression = fts_match_expression(term)
+    
+    if match_expression is None:
+        return fetch_all(
+            f"""
+            SELECT {columns} FROM Patients p
+            WHERE (p.patient_id = ? OR p.first_name LIKE ? OR p.last_name LIKE ?){status_clause}
+            ORDER BY p.last_name, p.first_name
+            LIMIT ?
+            """,
+            [term.strip(), f"{term.strip()}%", f"{term.strip()}%"] + status_params + [limit]
+        )
+    
+    # CROSS JOIN keeps the index as the outer loop so a status filter cannot make SQLite scan Patients first
+    tier_query = f"""
+        SELECT {columns} FROM PatientSearch s
+        CROSS JOIN Patients p ON p.patient_id = s.rowid
+        WHERE PatientSearch MATCH ?{status_clause}
+        LIMIT ?
+    """
+    
+    # Names starting with every word: '^' anchors a phrase to the start of the column.
+    # Skipped for IDs and phone numbers, which can never match a name
+    results = []
+    if any(char.isalpha() for char in term):
+        prefix_expression = "{first_name last_name} : (" + ' AND '.join('^' + phrase for phrase in match_expression.split(' ')) + ")"
+        results = fetch_all(tier_query, [prefix_expression] + status_params + [limit])
+    
+    if len(results) < limit:
+        seen = {row[0] for row in results}
+        for row in fetch_all(tier_query, [match_expression] + status_params + [limit + len(results)]):
+            if row[0] not in seen and len(results) < limit:
+                results.append(row)
     
-    conn.close()
     return results
 
-def query_to_dataframe(query, params=None):
-    """Execute a query and return results as a pandas DataFrame"""
-    conn = get_connection()
+def search_entities(entity, term, limit=20, status=None):
+    """Return up to limit (id, label) pairs for the patients, doctors or medications matching term.
     
-    try:
+    Patients go through search_patients; doctors and medications match a
+    case-insensitive name prefix or an exact ID, served by an index. An empty
+    term returns the first names alphabetically. Results go through the query
+    cache, since a page reruns on every keystroke.
+    """
+    table, key, label, name_column, condition, match_words = PICKER_ENTITIES[entity]
+    term = term.strip()
+    
+    if entity == 'patient':
+        if not term:
+            return fetch_all(
+                f"SELECT {key}, {label} FROM Patients{' WHERE status = ?' if status else ''} ORDER BY last_name, first_name LIMIT ?",
+                ([status] if status else []) + [limit],
+                cache=True
+            )
+        return [(row[0], f"{row[1]} {row[2]} (ID: {row[0]})") for row in search_patients(term, limit, status)]
+    
+    where_clauses = [condition] if condition else []
+    params = []
+    
+    if term.isdigit():
+        where_clauses.append(f"{key} = ?")
+        params.append(int(term))
+    else:
+        # Escape LIKE wildcards so the term only ever matches as a literal prefix
+        prefix = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        if match_words:
+            where_clauses.append(f"({name_column} LIKE ? ESCAPE '\\' OR {name_column} LIKE ? ESCAPE '\\')")
+            params.extend([prefix, '% ' + prefix])
+        else:
+            where_clauses.append(f"{name_column} LIKE ? ESCAPE '\\'")
+            params.append(prefix)
+    
+    if status:
+        where_clauses.append("status = ?")
+        params.append(status)
+    
+    return fetch_all(
+        f"""
+        SELECT {key}, {label} FROM {table}
+        WHERE {' AND '.join(where_clauses)}
+        ORDER BY {name_column} COLLATE NOCASE
+        LIMIT ?
+        """,
+        params + [limit],
+        cache=True
+    )
+
+def entity_label(entity, entity_id):
+    """Return the display label of one patient, doctor or medication, through the query cache"""
+    table, key, label = PICKER_ENTITIES[entity][:3]
+    
+    rows = fetch_all(f"SELECT {label} FROM {table} WHERE {key} = ?", (entity_id,), cache=True)
+    return rows[0][0] if rows else f"Unknown {entity} (ID: {entity_id})"
+
+def search_clinical_notes(term, doctor_id=None, start_date=None, end_date=None, order_by="relevance", page=1, page_size=20):
+    """Search medical histories and prescription notes, returning (results, total_matches, truncated) for one page.
+    
+    Each result is a dict with source, id, patient_id, patient, doctor, date, title and
+    snippet, where matched words in the snippet are wrapped in SNIPPET_MARKERS.
+    order_by is "relevance" (bm25) or "newest"; words match on their stem, so "infected" finds "infection".
+    Only the CLINICAL_SEARCH_WINDOW most recently entered matches of each source are ranked
+    and counted; truncated is True when a source had more.
+    """
+    match_expression = fts_match_expression(term, min_length=1)
+    if match_expression is None:
+        return [], 0, False
+    
+    # Walking the index newest-first stops after the window, so common words cost the same as rare ones.
+    # bm25 scoring needs a pass over each word's full document list, so it is skipped when sorting by date
+    rank_column = "NULL" if order_by == "newest" else "s.rank"
+    branches = []
+    params = []
+    for source, (fts_table, table, key, date_column, _) in CLINICAL_SEARCH_SOURCES.items():
+        filters = ""
+        params.append(match_expression)
+        if doctor_id:
+            filters += " AND t.doctor_id = ?"
+            params.append(doctor_id)
+        if start_date:
+            filters += f" AND t.{date_column} >= ?"
+            params.append(str(start_date))
+        if end_date:
+            filters += f" AND t.{date_column} < ?"
+            params.append(str(end_date + timedelta(days=1)))
+        params.append(CLINICAL_SEARCH_WINDOW)
+        
+        # CROSS JOIN keeps the index as the outer loop, as in search_patients
+        branches.append(f"""
+            SELECT * FROM (
+                SELECT '{source}' AS source, s.rowid AS id, t.{date_column} AS date, {rank_column} AS rank
+                FROM {fts_table} s
+                CROSS JOIN {table} t ON t.{key} = s.rowid
+                WHERE {fts_table} MATCH ?{filters}
+                ORDER BY s.rowid DESC
+                LIMIT ?
+            )
+        """)
+    
+    # The first row carries the counts so they survive a page past the end
+    order_clause = "date DESC, id DESC" if order_by == "newest" else "rank, id DESC"
+    page_rows = fetch_all(
+        f"""
+        WITH hits AS MATERIALIZED ({' UNION ALL '.join(branches)}),
+        counts AS (SELECT count(*) AS n FROM hits GROUP BY source)
+        SELECT NULL, NULL, (SELECT coalesce(sum(n), 0) FROM counts), (SELECT coalesce(max(n), 0) FROM counts)
+        UNION ALL
+        SELECT * FROM (SELECT source, id, NULL, NULL FROM hits ORDER BY {order_clause} LIMIT ? OFFSET ?)
+        """,
+        params + [page_size, (max(page, 1) - 1) * page_size]
+    )
+    
+    total, largest = page_rows[0][2], page_rows[0][3]
+    page_rows = page_rows[1:]
+    
+    # Snippets and joins are only computed for the rows on this page
+    details = {}
+    for source, (fts_table, table, key, date_column, title) in CLINICAL_SEARCH_SOURCES.items():
+        ids = [row[1] for row in page_rows if row[0] == source]
+        if not ids:
+            continue
+        
+        for row in fetch_all(
+            f"""
+            SELECT s.rowid, t.patient_id, p.first_name || ' ' || p.last_name, u.full_name, t.{date_column}, {title},
+                   snippet({fts_table}, -1, ?, ?, '…', {SNIPPET_TOKENS})
+            FROM {fts_table} s
+            CROSS JOIN {table} t ON t.{key} = s.rowid
+            LEFT JOIN Patients p ON p.patient_id = t.patient_id
+            LEFT JOIN Users u ON u.user_id = t.doctor_id
+            WHERE {fts_table} MATCH ? AND s.rowid IN ({', '.join('?' * len(ids))})
+            """,
+            list(SNIPPET_MARKERS) + [match_expression] + ids
+        ):
+            details[(source, row[0])] = {
+                "source": source, "id": row[0], "patient_id": row[1], "patient": row[2], "doctor": row[3],
+                "date": row[4], "title": row[5], "snippet": row[6],
+            }
+    
+    results = [details[(source, id)] for source, id, _, _ in page_rows if (source, id) in details]
+    return results, total, largest >= CLINICAL_SEARCH_WINDOW
+
+def _cache_key(query, params):
+    """Build a hashable cache key from a query and its parameters"""
+    if isinstance(params, dict):
+        return query, tuple(sorted(params.items()))
+    return query, tuple(params or ())
+
+def _cache_get(key):
+    """Return (hit, result) for a cache key, dropping the entry if it has expired"""
+    with _query_cache_lock:
+        entry = _query_cache.get(key)
+        
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del _query_cache[key]
+            _query_cache_stats["misses"] += 1
+            return False, None
+        
+        _query_cache.move_to_end(key)
+        _query_cache_stats["hits"] += 1
+        return True, entry[2]
+
+def _cache_generations(tables):
+    """Snapshot the invalidation generation of each table"""
+    with _query_cache_lock:
+        return {table: _table_generations.get(table, 0) for table in tables}
+
+def _cache_put(key, generations, result):
+    """Store a result unless one of its tables was invalidated while it was being read"""
+    with _query_cache_lock:
+        if any(_table_generations.get(table, 0) != generation for table, generation in generations.items()):
+            return
+        
+        _query_cache[key] = (time.monotonic() + QUERY_CACHE_TTL, set(generations), result)
+        _query_cache.move_to_end(key)
+        
+        while len(_query_cache) > QUERY_CACHE_SIZE:
+            _query_cache.popitem(last=False)
+            _query_cache_stats["evictions"] += 1
+
+def invalidate_cache(*tables):
+    """Drop cached results that read any of the given tables ('*' drops everything)"""
+    with _query_cache_lock:
+        if '*' in tables:
+            tables = set(_table_generations) | {t for entry in _query_cache.values() for t in entry[1]}
+            _query_cache.clear()
+        else:
+            stale = [key for key, entry in _query_cache.items() if entry[1] & set(tables)]
+            for key in stale:
+                del _query_cache[key]
+        
+        for table in tables:
+            _table_generations[table] = _table_generations.get(table, 0) + 1
+        
+        _query_cache_stats["invalidations"] += 1
+
+def _sees_uncommitted_writes():
+    """Check whether this thread reads through a connection with an open transaction, whose rows must not be cached"""
+    conn = getattr(_local, 'connection', None)
+    return conn is not None and conn.in_transaction
+
+def get_cache_stats():
+    """Return hit/miss/invalidation/eviction counters and the current cache size"""
+    with _query_cache_lock:
+        stats = dict(_query_cache_stats)
+        stats["entries"] = len(_query_cache)
+    
+    return stats
+
+def execute_query(query, params=None):
+    """Execute a write statement with optional parameters"""
+    _run_write(query, params)
+
+def fetch_one(query, params=None):
+    """Fetch one row from a query"""
+    with pooled_connection() as conn:
         if params:
-            df = pd.read_sql_query(query, conn, params=params)
+            result = conn.execute(query, params).fetchone()
+        else:
+            result = conn.execute(query).fetchone()
+    
+    return result
+
+def fetch_all(query, params=None, cache=False):
+    """Fetch all rows from a query, optionally through the query result cache"""
+    # Inside a transaction the cache would miss this connection's own writes, or keep them after a rollback
+    cache = cache and not _sees_uncommitted_writes()
+    
+    if cache:
+        key = _cache_key(query, params)
+        hit, results = _cache_get(key)
+        if hit:
+            return list(results)
+        generations = _cache_generations(_read_tables(query))
+    
+    with pooled_connection() as conn:
+        if params:
+            results = conn.execute(query, params).fetchall()
+        else:
+            results = conn.execute(query).fetchall()
+    
+    if cache:
+        _cache_put(key, generations, tuple(results))
+    
+    return results
+
+def get_dtype_map():
+    """Return the pandas dtype query_to_dataframe gives each known result column name.
+    
+    Columns declared DATE/DATETIME/TIMESTAMP in any table load as datetime64 and
+    CATEGORICAL_COLUMNS load as category; other columns keep pandas' inferred dtype.
+    """
+    global _column_dtypes
+    
+    if _column_dtypes is None:
+        dtypes = {}
+        with pooled_connection() as conn:
+            tables = [row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+            ).fetchall()]
+            
+            for table in tables:
+                for _, name, declared_type, _, _, _ in conn.execute(f"PRAGMA table_info({table})").fetchall():
+                    if declared_type.upper() in TIMESTAMP_TYPES:
+                        dtypes[name] = 'datetime64[ns]'
+                    elif name in CATEGORICAL_COLUMNS:
+                        dtypes[name] = 'category'
+        
+        _column_dtypes = dtypes
+    
+    return dict(_column_dtypes)
+
+def _apply_dtypes(df, dtypes=None):
+    """Convert result columns to their mapped dtypes in place, parsing timestamps in one vectorized pass"""
+    dtype_map = get_dtype_map()
+    if dtypes:
+        dtype_map.update(dtypes)
+    
+    for col in df.columns:
+        dtype = dtype_map.get(col)
+        
+        if dtype is None or df[col].dtype == dtype:
+            continue
+        
+        if str(dtype).startswith('datetime64'):
+            # SQLite stores dates and timestamps as ISO-8601 text
+            df[col] = pd.to_datetime(df[col], format='ISO8601', errors='coerce')
         else:
-            df = pd.read_sql_query(query, conn)
+            df[col] = df[col].astype(dtype)
+    
+    return df
+
+def query_to_dataframe(query, params=None, cache=False, dtypes=None):
+    """Execute a query and return results as a typed pandas DataFrame, optionally through the query result cache.
+    
+    Column dtypes come from get_dtype_map(); dtypes overrides or extends it,
+    e.g. for computed columns such as {'last_visit': 'datetime64[ns]'}.
+    """
+    cache = cache and not _sees_uncommitted_writes()
+    
+    if cache:
+        key = _cache_key(query, params) + (tuple(sorted((dtypes or {}).items())),)
+        hit, df = _cache_get(key)
+        if hit:
+            return df.copy()
+        generations = _cache_generations(_read_tables(query))
+    
+    try:
+        with pooled_connection() as conn:
+            if params:
+                df = pd.read_sql_query(query, conn, params=params)
+            else:
+                df = pd.read_sql_query(query, conn)
         
-        # Handle date columns gracefully
-        for col in df.columns:
-            if col.endswith('_date') or col in ['created_at', 'last_login', 'bill_date', 'due_date', 'date']:
-                try:
-                    df[col] = pd.to_datetime(df[col], errors='coerce')
-                except:
-                    pass  # Keep as is if conversion fails
+        _apply_dtypes(df, dtypes)
+        
+        if cache:
+            _cache_put(key, generations, df.copy())
         
         return df
     except Exception as e:
         print(f"Error in query_to_dataframe: {e}")
         # Return empty dataframe with expected columns if possible
         return pd.DataFrame()
-    finally:
-        conn.close()
 
-def insert_record(table, data):
-    """Insert a record into a table and return the ID"""
-    conn = None
-    retries = 3
-    retry_delay = 0.5
-    last_id = None
+def iter_query(query, params=None, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield (columns, rows) with at most chunk_size rows at a time without materializing the result"""
+    with pooled_connection() as conn:
+        cursor = conn.execute(query, params or ())
+        columns = [col[0] for col in cursor.description]
+        
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield columns, rows
+        finally:
+            cursor.close()
+
+def iter_dataframes(query, params=None, chunk_size=STREAM_CHUNK_SIZE, dtypes=None):
+    """Yield typed DataFrame chunks of at most chunk_size rows from a query"""
+    for columns, rows in iter_query(query, params, chunk_size):
+        yield _apply_dtypes(pd.DataFrame.from_records(rows, columns=columns), dtypes)
+
+def export_csv(query, params=None, destination=None, chunk_size=STREAM_CHUNK_SIZE, dtypes=None):
+    """Stream a query's full result to CSV one chunk at a time.
+    
+    Writes to destination (a binary file) or, if None, to a temporary file
+    that is returned rewound and ready to hand to st.download_button.
+    """
+    # Unbuffered, since st.download_button only accepts raw file objects
+    output = tempfile.TemporaryFile(buffering=0) if destination is None else destination
+    
+    header = True
+    for chunk in iter_dataframes(query, params, chunk_size, dtypes):
+        output.write(chunk.to_csv(index=False, header=header).encode('utf-8'))
+        header = False
+    
+    if header:
+        # No rows: still write the column names
+        with pooled_connection() as conn:
+            columns = [col[0] for col in conn.execute(query, params or ()).description]
+        output.write(pd.DataFrame(columns=columns).to_csv(index=False).encode('utf-8'))
+    
+    if destination is None:
+        output.seek(0)
+    
+    return output
+
+def _sandbox_authorizer(action, arg1, arg2, db_name, trigger):
+    """Allow custom report statements to read only; hidden columns read as NULL"""
+    if action == sqlite3.SQLITE_READ and ((arg1 or '').lower(), (arg2 or '').lower()) in SANDBOX_HIDDEN_COLUMNS:
+        return sqlite3.SQLITE_IGNORE
+    
+    return sqlite3.SQLITE_OK if action in _SANDBOX_ACTIONS else sqlite3.SQLITE_DENY
+
+def estimate_query_cost(conn, query, params=None):
+    """Estimate the rows a query's plan visits from EXPLAIN QUERY PLAN.
     
-    # Try multiple times to handle potential database locks
-    for attempt in range(retries):
+    Nested loops multiply: a scan visits every row of its table, an indexed
+    equality search SANDBOX_SEARCH_ROWS and an indexed range a tenth of the
+    table, so a cross join of two large tables costs the product of their sizes.
+    """
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {query}", params or ()).fetchall()
+    
+    tables = {row[0].lower(): row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"
+    ).fetchall()}
+    aliases = {alias.lower(): table.lower() for table, alias in _SANDBOX_ALIASES.findall(query)}
+    children = {}
+    for node_id, parent, _, detail in plan:
+        children.setdefault(parent, []).append((node_id, detail))
+    
+    sizes = {}  # Table or materialized subquery name -> estimated rows
+    
+    def table_rows(name):
+        name = name.lower()
+        table = tables.get(aliases.get(name, name), tables.get(name))
+        
+        if name in sizes:
+            return sizes[name]
+        if table is None:
+            return SANDBOX_UNKNOWN_ROWS
+        
         try:
-            conn = get_connection()
+            rows = conn.execute(f'SELECT MAX(rowid) FROM "{table}"').fetchone()[0]
+        except sqlite3.OperationalError:
+            # WITHOUT ROWID tables have no rowid to read the size from
+            rows = conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+        
+        sizes[name] = rows or 0
+        return sizes[name]
+    
+    def loop_cost(parent):
+        total, loops = 0.0, 1.0
+        
+        for node_id, detail in children.get(parent, []):
+            words = detail.split()
+            
+            if node_id in children:
+                # Subqueries, CTEs and compound parts carry their own loops
+                cost = loop_cost(node_id)
+                total += loops * cost if detail.startswith('CORRELATED') else cost
+                if words[0] in ('MATERIALIZE', 'CO-ROUTINE'):
+                    sizes[words[1].lower()] = cost
+            elif words[0] in ('SCAN', 'SEARCH') and words[1:2] != ['CONSTANT']:
+                rows = table_rows(words[1])
+                if words[0] == 'SEARCH':
+                    rows = rows / 10 if ('>' in detail or '<' in detail) else min(rows, SANDBOX_SEARCH_ROWS)
+                loops *= max(rows, 1)
+                total += loops
+            elif 'TEMP B-TREE' in detail:
+                total += loops
+        
+        return total
+    
+    return loop_cost(0)
+
+def run_sandboxed_query(query, params=None, preview_rows=1000, destination=None, cancel=None,
+                        time_budget=SANDBOX_TIME_BUDGET, max_rows=SANDBOX_MAX_ROWS,
+                        max_bytes=SANDBOX_MAX_BYTES, max_cost=SANDBOX_MAX_COST, path=None):
+    """Run ad hoc SQL from the custom reports tab inside a resource sandbox, streaming the result to CSV.
+    
+    The query gets its own read-only connection whose authorizer permits reads
+    only. A plan whose estimated cost exceeds max_cost is refused before it runs,
+    a progress handler stops it after time_budget seconds or once the cancel
+    event is set from any thread, and the CSV stops at max_rows rows or
+    max_bytes bytes. Returns a dict with the preview DataFrame, the CSV file
+    (rewound, as export_csv returns it), the row and byte counts, the cost
+    estimate, the elapsed seconds and what truncated the output, if anything.
+    path runs it against another database file, such as the analytics mirror.
+    Refusals, cancellation and time-outs with no rows raise sqlite3.OperationalError.
+    """
+    started = time.monotonic()
+    deadline = started + time_budget
+    stopped = []
+    
+    def check_budget():
+        if cancel is not None and cancel.is_set():
+            stopped.append('cancelled')
+        elif time.monotonic() > deadline:
+            stopped.append('time')
+        return 1 if stopped else 0
+    
+    conn = get_connection(read_only=True, path=path)
+    conn.set_authorizer(_sandbox_authorizer)
+    conn.setlimit(sqlite3.SQLITE_LIMIT_LENGTH, max(max_bytes, 1))
+    conn.set_progress_handler(check_budget, SANDBOX_PROGRESS_STEPS)
+    
+    # Unbuffered, since st.download_button only accepts raw file objects
+    output = tempfile.TemporaryFile(buffering=0) if destination is None else destination
+    rows, written, truncated, cost = 0, 0, None, 0.0
+    preview = []
+    
+    try:
+        cost = estimate_query_cost(conn, query, params)
+        if cost > max_cost:
+            raise sqlite3.OperationalError(
+                f"Query refused: its plan visits an estimated {cost:,.0f} rows (limit {max_cost:,.0f}). "
+                "Add a filter or join on an indexed column."
+            )
+        
+        cursor = conn.execute(query, params or ())
+        columns = []
+        for col in cursor.description:
+            # Self-joins repeat column names, which DataFrames cannot hold apart
+            name, copy = col[0], 2
+            while name in columns:
+                name, copy = f"{col[0]}_{copy}", copy + 1
+            columns.append(name)
+        
+        header = pd.DataFrame(columns=columns).to_csv(index=False).encode('utf-8')
+        output.write(header)
+        written = len(header)
+        
+        while truncated is None:
+            try:
+                chunk = cursor.fetchmany(SANDBOX_CHUNK_SIZE)
+            except sqlite3.OperationalError:
+                # Keep what was streamed before the time budget ran out
+                if stopped == ['time'] and rows:
+                    truncated = 'time'
+                    break
+                raise
             
-            columns = ', '.join(data.keys())
-            placeholders = ', '.join(['?' for _ in data])
-            values = tuple(data.values())
+            if not chunk:
+                break
+            if rows + len(chunk) > max_rows:
+                chunk = chunk[:max_rows - rows]
+                truncated = 'rows'
             
-            query = f"INSERT INTO {table} ({columns}) VALUES ({placeholders})"
+            df = _apply_dtypes(pd.DataFrame.from_records(chunk, columns=columns))
+            data = df.to_csv(index=False, header=False).encode('utf-8')
             
-            cursor = conn.cursor()
-            cursor.execute(query, values)
-            last_id = cursor.lastrowid
+            if written + len(data) > max_bytes:
+                # Keep the most whole rows of this chunk that still fit
+                fits, too_many = 0, len(df) + 1
+                while too_many - fits > 1:
+                    middle = (fits + too_many) // 2
+                    if written + len(df.head(middle).to_csv(index=False, header=False).encode('utf-8')) <= max_bytes:
+                        fits = middle
+                    else:
+                        too_many = middle
+                df = df.head(fits)
+                data = df.to_csv(index=False, header=False).encode('utf-8')
+                truncated = 'bytes'
             
-            conn.commit()
-            break  # Success, exit the retry loop
-        except sqlite3.OperationalError as e:
-            # If database is locked, retry after a delay
-            if "database is locked" in str(e) and attempt < retries - 1:
-                if conn:
-                    conn.close()
-                import time
-                time.sleep(retry_delay)
-                print(f"Database locked, retrying... (attempt {attempt+1})")
-            else:
-                # Re-raise the exception if it's not a locking issue or we've exhausted retries
-                if conn:
-                    conn.close()
-                print(f"Database error: {e}")
-                return None
-        except Exception as e:
-            # Handle any other exceptions
-            if conn:
-                conn.close()
-            print(f"Error inserting record: {e}")
-            return None
-        finally:
-            if conn:
-                conn.close()
+            output.write(data)
+            written += len(data)
+            
+            shown = sum(len(part) for part in preview)
+            if shown < preview_rows:
+                preview.append(df.head(preview_rows - shown))
+            rows += len(df)
+        
+        cursor.close()
+    except Exception as e:
+        if destination is None:
+            output.close()
+        if 'cancelled' in stopped:
+            raise sqlite3.OperationalError("Query cancelled") from e
+        if 'time' in stopped:
+            raise sqlite3.OperationalError(f"Query stopped after its {time_budget:g}s time budget") from e
+        if 'not authorized' in str(e):
+            raise sqlite3.OperationalError("Custom reports may only read data (SELECT or WITH queries)") from e
+        raise
+    finally:
+        conn.close()
+    
+    if destination is None:
+        output.seek(0)
+    
+    return {
+        "preview": pd.concat(preview, ignore_index=True) if preview else pd.DataFrame(columns=columns),
+        "csv": output,
+        "rows": rows,
+        "bytes": written,
+        "cost": cost,
+        "elapsed": time.monotonic() - started,
+        "truncated": truncated,
+    }
+
+def _keyset_condition(sort_keys, after):
+    """Build the WHERE condition selecting rows that sort after the key values in after"""
+    columns = [column for column, _ in sort_keys]
+    
+    # A row-value comparison can seek an index when every key sorts the same way. The
+    # leading key's own range lets SQLite seek an expression index too
+    if len({descending for _, descending in sort_keys}) == 1:
+        operator = '<' if sort_keys[0][1] else '>'
+        condition = f"{columns[0]} {operator}= ? AND ({', '.join(columns)}) {operator} ({', '.join('?' * len(columns))})"
+        return condition, [after[0]] + list(after)
+    
+    terms = []
+    params = []
+    for i, (column, descending) in enumerate(sort_keys):
+        equal = [f"{previous} = ?" for previous in columns[:i]]
+        terms.append('(' + ' AND '.join(equal + [f"{column} {'<' if descending else '>'} ?"]) + ')')
+        params.extend(list(after[:i]) + [after[i]])
+    
+    return '(' + ' OR '.join(terms) + ')', params
+
+def fetch_page(query, params=None, sort_keys=(), after=None, page_size=PAGE_SIZE, dtypes=None):
+    """Fetch one page of a query by keyset pagination, returning (df, last_key, has_more).
+    
+    query must not have its own ORDER BY or LIMIT. sort_keys is a sequence of
+    (column, descending) pairs naming non-NULL result columns and must end with a
+    unique one such as the primary key. Pass the last_key of one page as after to
+    fetch the next, so every page costs the same however deep it is.
+    """
+    sort_keys = list(sort_keys)
+    params = list(params or [])
+    
+    sql = f"SELECT * FROM ({query}) page"
+    if after is not None:
+        condition, key_params = _keyset_condition(sort_keys, after)
+        sql += f" WHERE {condition}"
+        params += key_params
+    
+    sql += " ORDER BY " + ', '.join(f"{column} {'DESC' if descending else 'ASC'}" for column, descending in sort_keys)
+    sql += " LIMIT ?"
+    
+    try:
+        # One extra row tells whether another page follows
+        with pooled_connection() as conn:
+            cursor = conn.execute(sql, params + [page_size + 1])
+            columns = [col[0] for col in cursor.description]
+            rows = cursor.fetchall()
+        
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        
+        last_key = None
+        if rows:
+            positions = [columns.index(column) for column, _ in sort_keys]
+            last_key = tuple(rows[-1][position] for position in positions)
+        
+        df = _apply_dtypes(pd.DataFrame.from_records(rows, columns=columns), dtypes)
+        return df, last_key, has_more
+    except Exception as e:
+        print(f"Error in fetch_page: {e}")
+        return pd.DataFrame(), None, False
+
+def estimate_count(query, params=None, cap=COUNT_ESTIMATE_CAP):
+    """Count a query's rows, stopping at cap, and return (count, exact).
+    
+    The count goes through the query result cache, so paging through a list
+    only pays for it once until one of its tables is written.
+    """
+    count = fetch_all(
+        f"SELECT count(*) FROM (SELECT 1 FROM ({query}) LIMIT ?)",
+        list(params or []) + [cap + 1],
+        cache=True
+    )[0][0]
+    
+    return min(count, cap), count <= cap
+
+def insert_record(table, data):
+    """Insert a record into a table and return the ID"""
+    columns = ', '.join(data.keys())
+    placeholders = ', '.join(['?' for _ in data])
+    values = tuple(data.values())
+    
+    query = f"INSERT INTO {table} ({columns}) VALUES ({placeholders})"
+    
+    try:
+        last_id, _ = _run_write(query, values)
+    except Exception as e:
+        # Inside a transaction the whole unit of work must fail and roll back
+        if _in_transaction():
+            raise
+        
+        print(f"Error inserting record: {e}")
+        return None
     
     return last_id
 
 def update_record(table, data, condition):
     """Update a record in a table"""
-    conn = None
-    retries = 3
-    retry_delay = 0.5
+    set_clause = ', '.join([f"{key} = ?" for key in data.keys()])
+    values = list(data.values())
     
-    # Try multiple times to handle potential database locks
-    for attempt in range(retries):
-        try:
-            conn = get_connection()
-            
-            set_clause = ', '.join([f"{key} = ?" for key in data.keys()])
-            values = list(data.values())
-            
-            where_clause = ' AND '.join([f"{key} = ?" for key in condition.keys()])
-            values.extend(condition.values())
-            
-            query = f"UPDATE {table} SET {set_clause} WHERE {where_clause}"
-            
-            conn.execute(query, values)
-            conn.commit()
-            break  # Success, exit the retry loop
-        except sqlite3.OperationalError as e:
-            # If database is locked, retry after a delay
-            if "database is locked" in str(e) and attempt < retries - 1:
-                if conn:
-                    conn.close()
-                import time
-                time.sleep(retry_delay)
-                print(f"Database locked during update, retrying... (attempt {attempt+1})")
-            else:
-                # Re-raise the exception if it's not a locking issue or we've exhausted retries
-                if conn:
-                    conn.close()
-                print(f"Database error during update: {e}")
-                return False
-        except Exception as e:
-            # Handle any other exceptions
-            if conn:
-                conn.close()
-            print(f"Error updating record: {e}")
-            return False
-        finally:
-            if conn:
-                conn.close()
+    where_clause = ' AND '.join([f"{key} = ?" for key in condition.keys()])
+    values.extend(condition.values())
+    
+    query = f"UPDATE {table} SET {set_clause} WHERE {where_clause}"
+    
+    try:
+        _run_write(query, values)
+    except Exception as e:
+        if _in_transaction():
+            raise
+        
+        print(f"Error updating record: {e}")
+        return False
     
     return True
 
 def delete_record(table, condition):
     """Delete a record from a table"""
-    conn = None
-    retries = 3
-    retry_delay = 0.5
+    where_clause = ' AND '.join([f"{key} = ?" for key in condition.keys()])
+    values = list(condition.values())
     
-    # Try multiple times to handle potential database locks
-    for attempt in range(retries):
-        try:
-            conn = get_connection()
-            
-            where_clause = ' AND '.join([f"{key} = ?" for key in condition.keys()])
-            values = list(condition.values())
-            
-            query = f"DELETE FROM {table} WHERE {where_clause}"
-            
-            conn.execute(query, values)
-            conn.commit()
-            break  # Success, exit the retry loop
-        except sqlite3.OperationalError as e:
-            # If database is locked, retry after a delay
-            if "database is locked" in str(e) and attempt < retries - 1:
-                if conn:
-                    conn.close()
-                import time
-                time.sleep(retry_delay)
-                print(f"Database locked during delete, retrying... (attempt {attempt+1})")
-            else:
-                # Re-raise the exception if it's not a locking issue or we've exhausted retries
-                if conn:
-                    conn.close()
-                print(f"Database error during delete: {e}")
-                return False
-        except Exception as e:
-            # Handle any other exceptions
-            if conn:
-                conn.close()
-            print(f"Error deleting record: {e}")
-            return False
-        finally:
-            if conn:
-                conn.close()
+    query = f"DELETE FROM {table} WHERE {where_clause}"
+    
+    try:
+        _run_write(query, values)
+    except Exception as e:
+        if _in_transaction():
+            raise
+        
+        print(f"Error deleting record: {e}")
+        return False
     
     return True
+
+def _rows_from(rows):
+    """Yield row dicts from an iterable of dicts or a DataFrame, with NaN/NaT as None"""
+    if isinstance(rows, pd.DataFrame):
+        rows = rows.astype(object).where(rows.notna(), None).to_dict('records')
+    
+    return iter(rows)
+
+def _chunks(rows, chunk_size):
+    """Split rows into lists of at most chunk_size rows sharing the same columns"""
+    chunk = []
+    columns = None
+    
+    for row in _rows_from(rows):
+        row_columns = tuple(row.keys())
+        
+        if chunk and (row_columns != columns or len(chunk) >= chunk_size):
+            yield columns, chunk
+            chunk = []
+        
+        columns = row_columns
+        chunk.append(row)
+    
+    if chunk:
+        yield columns, chunk
+
+def _primary_key(conn, table):
+    """Return the primary key column of a table"""
+    for _, name, _, _, _, pk in conn.execute(f"PRAGMA table_info({table})"):
+        if pk:
+            return name
+    return 'rowid'
+
+def insert_records(table, rows, chunk_size=1000):
+    """Insert many records in one transaction and return their IDs in order"""
+    ids = []
+    
+    try:
+        with transaction() as conn:
+            primary_key = None
+            
+            for columns, chunk in _chunks(rows, chunk_size):
+                placeholders = ', '.join(['?' for _ in columns])
+                query = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"
+                
+                conn.executemany(query, [tuple(row.values()) for row in chunk])
+                
+                primary_key = primary_key or _primary_key(conn, table)
+                if primary_key in columns:
+                    ids.extend(row[primary_key] for row in chunk)
+                else:
+                    # The write lock is held, so the chunk's generated IDs are consecutive
+                    last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+                    ids.extend(range(last_id - len(chunk) + 1, last_id + 1))
+    except Exception as e:
+        if _in_transaction():
+            raise
+        
+        print(f"Error inserting records: {e}")
+        return None
+    
+    return ids
+
+def update_records(table, rows, key_columns, chunk_size=1000):
+    """Update many records in one transaction, matching each row on key_columns.
+    
+    Returns the number of rows changed.
+    """
+    if isinstance(key_columns, str):
+        key_columns = [key_columns]
+    
+    updated = 0
+    
+    try:
+        with transaction() as conn:
+            for columns, chunk in _chunks(rows, chunk_size):
+                set_columns = [col for col in columns if col not in key_columns]
+                
+                set_clause = ', '.join([f"{col} = ?" for col in set_columns])
+                where_clause = ' AND '.join([f"{col} = ?" for col in key_columns])
+                query = f"UPDATE {table} SET {set_clause} WHERE {where_clause}"
+                
+                values = [
+                    tuple(row[col] for col in set_columns) + tuple(row[col] for col in key_columns)
+                    for row in chunk
+                ]
+                updated += conn.executemany(query, values).rowcount
+    except Exception as e:
+        if _in_transaction():
+            raise
+        
+        print(f"Error updating records: {e}")
+        return None
+    
+    return updated
+
+def upsert_records(table, rows, conflict_columns, chunk_size=1000):
+    """Insert many records, updating existing ones that clash on conflict_columns.
+    
+    conflict_columns must be covered by a primary key or unique index.
+    Returns the number of rows inserted or updated.
+    """
+    if isinstance(conflict_columns, str):
+        conflict_columns = [conflict_columns]
+    
+    changed = 0
+    
+    try:
+        with transaction() as conn:
+            for columns, chunk in _chunks(rows, chunk_size):
+                update_columns = [col for col in columns if col not in conflict_columns]
+                
+                placeholders = ', '.join(['?' for _ in columns])
+                query = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders}) ON CONFLICT ({', '.join(conflict_columns)})"
+                
+                if update_columns:
+                    query += " DO UPDATE SET " + ', '.join([f"{col} = excluded.{col}" for col in update_columns])
+                else:
+                    query += " DO NOTHING"
+                
+                changed += conn.executemany(query, [tuple(row.values()) for row in chunk]).rowcount
+    except Exception as e:
+        if _in_transaction():
+            raise
+        
+        print(f"Error upserting records: {e}")
+        return None
+    
+    return changed
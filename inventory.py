@@ -4,6 +4,7 @@ import pandas as pd
 import time
 from datetime import datetime, timedelta
 import audit
+import utils
 
 def get_low_stock_count():
     """Get count of items with stock below reorder level."""
@@ -15,6 +16,44 @@ def get_low_stock_count():
     )
     return result[0] if result else 0
 
+def adjust_inventory_stock(item_id, transaction_type, quantity, status=None):
+    """Add, remove or set an item's stock against its current level in one transaction.
+    
+    The status is derived from the new quantity unless one is given.
+    Returns the new quantity, or None if the item does not exist.
+    """
+    with database.transaction() as conn:
+        item = conn.execute(
+            "SELECT quantity, reorder_level FROM Inventory WHERE item_id = ?",
+            (item_id,)
+        ).fetchone()
+        
+        if not item:
+            return None
+        
+        new_quantity = item[0]
+        if transaction_type == "Add Stock":
+            new_quantity += quantity
+        elif transaction_type == "Remove Stock":
+            new_quantity = max(0, new_quantity - quantity)
+        else:  # Set Stock Level
+            new_quantity = quantity
+        
+        if status is None:
+            if new_quantity == 0:
+                status = "out of stock"
+            elif new_quantity <= (item[1] or 0):
+                status = "low stock"
+            else:
+                status = "available"
+        
+        conn.execute(
+            "UPDATE Inventory SET quantity = ?, status = ?, last_updated = ? WHERE item_id = ?",
+            (new_quantity, status, datetime.now(), item_id)
+        )
+    
+    return new_quantity
+
 def inventory_management():
     """Inventory management page."""
     st.header("Inventory Management")
@@ -34,7 +73,8 @@ def inventory_management():
             category_filter = st.selectbox(
                 "Category", 
                 ["All"] + sorted(set([row[0] for row in database.fetch_all(
-                    "SELECT DISTINCT category FROM Inventory ORDER BY category"
+                    "SELECT DISTINCT category FROM Inventory ORDER BY category",
+                    cache=True
                 ) or []])),
             )
         
@@ -84,10 +124,13 @@ def inventory_management():
         if where_clauses:
             query += " WHERE " + " AND ".join(where_clauses)
         
-        query += " ORDER BY category, item_name"
-        
-        # Execute query
-        inventory_df = database.query_to_dataframe(query, params)
+        # Fetch the current page, ordered by category and name with the ID as a tiebreaker for paging
+        inventory_df = utils.keyset_pager(
+            "inventory_list",
+            query,
+            params,
+            [("category", False), ("item_name", False), ("item_id", False)]
+        )
         
         if inventory_df.empty:
             st.info("No inventory items found matching your criteria.")
@@ -96,8 +139,8 @@ def inventory_management():
             inventory_df['total_value'] = inventory_df['quantity'] * inventory_df['unit_price']
             
             # Format dates and currency
-            inventory_df['expiry_date'] = pd.to_datetime(inventory_df['expiry_date']).dt.strftime('%Y-%m-%d')
-            inventory_df['last_updated'] = pd.to_datetime(inventory_df['last_updated']).dt.strftime('%Y-%m-%d')
+            inventory_df['expiry_date'] = inventory_df['expiry_date'].dt.strftime('%Y-%m-%d')
+            inventory_df['last_updated'] = inventory_df['last_updated'].dt.strftime('%Y-%m-%d')
             inventory_df['unit_price'] = inventory_df['unit_price'].apply(lambda x: f"${x:.2f}")
             inventory_df['total_value'] = inventory_df['total_value'].apply(lambda x: f"${x:.2f}")
             
@@ -124,24 +167,29 @@ def inventory_management():
             
             st.dataframe(display_df, use_container_width=True)
             
-            # Summary statistics
+            # Summary statistics cover every matching item, not just the current page
+            summary = database.fetch_all(
+                f"""
+                SELECT COUNT(*), COALESCE(SUM(quantity), 0), SUM(quantity <= reorder_level), COALESCE(SUM(quantity * unit_price), 0)
+                FROM ({query})
+                """,
+                params,
+                cache=True
+            )[0]
+            
             col1, col2, col3, col4 = st.columns(4)
             
             with col1:
-                total_items = len(inventory_df)
-                st.metric("Total Items", total_items)
+                st.metric("Total Items", summary[0])
             
             with col2:
-                total_quantity = inventory_df['quantity'].sum()
-                st.metric("Total Quantity", total_quantity)
+                st.metric("Total Quantity", summary[1])
             
             with col3:
-                low_stock_items = len(inventory_df[inventory_df['quantity'] <= inventory_df['reorder_level']])
-                st.metric("Low Stock Items", low_stock_items)
+                st.metric("Low Stock Items", summary[2] or 0)
             
             with col4:
-                total_value = inventory_df['quantity'] * pd.to_numeric(inventory_df['unit_price'].str.replace('$', ''))
-                st.metric("Total Inventory Value", f"${total_value.sum():.2f}")
+                st.metric("Total Inventory Value", f"${summary[3]:.2f}")
         
         # Item details and actions
         if not inventory_df.empty:
@@ -224,34 +272,8 @@ def inventory_management():
                                 with st.spinner("Updating stock..."):
                                     time.sleep(1)  # Simple animation delay
                                 
-                                # Calculate new quantity
-                                new_quantity = item[3]
-                                if transaction_type == "Add Stock":
-                                    new_quantity += quantity
-                                elif transaction_type == "Remove Stock":
-                                    new_quantity = max(0, new_quantity - quantity)
-                                else:  # Set Stock Level
-                                    new_quantity = quantity
-                                
-                                # Determine new status
-                                new_status = item[10]
-                                if new_quantity == 0:
-                                    new_status = "out of stock"
-                                elif new_quantity <= item[6]:
-                                    new_status = "low stock"
-                                else:
-                                    new_status = "available"
-                                
-                                # Update inventory
-                                database.update_record(
-                                    "Inventory",
-                                    {
-                                        "quantity": new_quantity,
-                                        "status": new_status,
-                                        "last_updated": datetime.now()
-                                    },
-                                    {"item_id": item_id}
-                                )
+                                # Apply the change to the current stock level atomically
+                                adjust_inventory_stock(item_id, transaction_type, quantity)
                                 
                                 # Record in audit log
                                 audit.record_activity(
@@ -529,24 +551,8 @@ def inventory_management():
                     # Get item ID
                     reorder_item_id = int(selected_reorder_item.split("ID: ")[1].rstrip(')'))
                     
-                    # Get current quantity
-                    current_quantity = database.fetch_one(
-                        "SELECT quantity FROM Inventory WHERE item_id = ?",
-                        (reorder_item_id,)
-                    )[0]
-                    
-                    # Update inventory
-                    new_quantity = current_quantity + reorder_amount
-                    
-                    database.update_record(
-                        "Inventory",
-                        {
-                            "quantity": new_quantity,
-                            "status": "available",
-                            "last_updated": datetime.now()
-                        },
-                        {"item_id": reorder_item_id}
-                    )
+                    # Add the ordered amount to the current quantity atomically
+                    new_quantity = adjust_inventory_stock(reorder_item_id, "Add Stock", reorder_amount, status="available")
                     
                     # Record in audit log
                     audit.record_activity(
@@ -586,7 +592,6 @@ def inventory_management():
             st.info("No items are due to expire in the next 30 days.")
         else:
             # Calculate days until expiry
-            expiring_items['expiry_date'] = pd.to_datetime(expiring_items['expiry_date'])
             expiring_items['days_until_expiry'] = (expiring_items['expiry_date'] - pd.to_datetime(today)).dt.days
             
             # Format for display
@@ -4,12 +4,23 @@ import pandas as pd
 from datetime import datetime
 import time
 import audit
+import utils
 
 def get_patient_count():
     """Get the total number of patients."""
     result = database.fetch_one("SELECT COUNT(*) FROM Patients WHERE status = 'active'")
     return result[0] if result else 0
 
+def name_match_condition(search_term):
+    """Build a condition true when every word of the term starts the patient's first or last name.
+    
+    Returns (sql, params), so "John Smith" and "smith jo" both rank as name matches.
+    """
+    words = search_term.split()
+    condition = ' AND '.join(['(p.first_name LIKE ? OR p.last_name LIKE ?)'] * len(words))
+    params = [f"{word}%" for word in words for _ in range(2)]
+    return f"({condition})", params
+
 def patient_management():
     """Patient management page."""
     st.header("Patient Management")
@@ -20,7 +31,7 @@ def patient_management():
         st.subheader("Patient List")
         
         # Search filters
-        col1, col2, col3 = st.columns(3)
+        col1, col2, col3, col4 = st.columns(4)
         
         with col1:
             search_term = st.text_input("Search by name or ID")
@@ -29,26 +40,42 @@ def patient_management():
             status_filter = st.selectbox("Status", ["All", "Active", "Inactive", "Discharged"])
         
         with col3:
-            sort_by = st.selectbox("Sort by", ["Registration Date", "Last Name", "First Name", "ID"])
+            age_filter = st.selectbox("Age Group", ["All"] + [label for label, _ in database.AGE_BANDS])
+        
+        with col4:
+            sort_by = st.selectbox("Sort by", ["Relevance", "Registration Date", "Last Name", "First Name", "ID"])
+        
+        # Search through the full-text index when the term is long enough for it
+        match_expression = database.fts_match_expression(search_term) if search_term else None
         
         # Prepare query
-        query = """
+        select_params = []
+        name_match = "0"
+        if sort_by == "Relevance" and match_expression:
+            # Names starting with each word of the term rank above other matches
+            name_match, select_params = name_match_condition(search_term)
+        
+        query = f"""
         SELECT 
-            patient_id, 
-            first_name, 
-            last_name, 
-            date_of_birth, 
-            gender, 
-            contact_number, 
-            registration_date, 
-            status
-        FROM Patients
+            p.patient_id, 
+            p.first_name, 
+            p.last_name, 
+            p.date_of_birth, 
+            p.gender, 
+            p.contact_number, 
+            p.registration_date, 
+            p.status,
+            {name_match} AS name_match
+        FROM Patients p
         """
         
-        params = []
+        params = list(select_params)
         where_clauses = []
         
-        if search_term:
+        if match_expression:
+            query += " JOIN (SELECT rowid FROM PatientSearch WHERE PatientSearch MATCH ?) s ON s.rowid = p.patient_id"
+            params.append(match_expression)
+        elif search_term:
             where_clauses.append("(first_name LIKE ? OR last_name LIKE ? OR patient_id LIKE ?)")
             params.extend([f"%{search_term}%", f"%{search_term}%", f"%{search_term}%"])
         
@@ -56,28 +83,35 @@ def patient_management():
             where_clauses.append("status = ?")
             params.append(status_filter.lower())
         
+        if age_filter != "All":
+            database.refresh_age_bands()
+            where_clauses.append("age_band = ?")
+            params.append(age_filter)
+        
         if where_clauses:
             query += " WHERE " + " AND ".join(where_clauses)
         
-        # Add sorting
-        if sort_by == "Registration Date":
-            query += " ORDER BY registration_date DESC"
+        # Sort keys end with the patient ID so every row has a unique position for paging
+        if sort_by == "Relevance" and match_expression:
+            sort_keys = [("name_match", True), ("last_name", False), ("first_name", False), ("patient_id", False)]
+        elif sort_by == "Relevance" or sort_by == "Registration Date":
+            sort_keys = [("registration_date", True), ("patient_id", True)]
         elif sort_by == "Last Name":
-            query += " ORDER BY last_name ASC"
+            sort_keys = [("last_name", False), ("first_name", False), ("patient_id", False)]
         elif sort_by == "First Name":
-            query += " ORDER BY first_name ASC"
-        elif sort_by == "ID":
-            query += " ORDER BY patient_id ASC"
+            sort_keys = [("first_name", False), ("patient_id", False)]
+        else:
+            sort_keys = [("patient_id", False)]
         
-        # Execute query
-        patients_df = database.query_to_dataframe(query, params)
+        # Fetch the current page
+        patients_df = utils.keyset_pager("patient_list", query, params, sort_keys)
         
         if patients_df.empty:
             st.info("No patients found matching your criteria.")
         else:
             # Format dates
-            patients_df['date_of_birth'] = pd.to_datetime(patients_df['date_of_birth']).dt.strftime('%Y-%m-%d')
-            patients_df['registration_date'] = pd.to_datetime(patients_df['registration_date']).dt.strftime('%Y-%m-%d')
+            patients_df['date_of_birth'] = patients_df['date_of_birth'].dt.strftime('%Y-%m-%d')
+            patients_df['registration_date'] = patients_df['registration_date'].dt.strftime('%Y-%m-%d')
             
             # Add a full name column
             patients_df['full_name'] = patients_df['first_name'] + ' ' + patients_df['last_name']
@@ -291,34 +325,11 @@ def medical_records(patient_id=None):
     if patient_id:
         patient_to_view = patient_id
     else:
-        # Get all patients
-        patients_df = database.query_to_dataframe(
-            """
-            SELECT patient_id, first_name, last_name
-            FROM Patients
-            WHERE status = 'active'
-            ORDER BY last_name, first_name
-            """
-        )
+        patient_to_view = utils.entity_picker("Select Patient", "patient", "medical_records_patient", status="active")
         
-        if patients_df.empty:
-            st.info("No patients found.")
-            return
-        
-        # Create selection options
-        patient_options = [f"{row['first_name']} {row['last_name']} (ID: {row['patient_id']})" for _, row in patients_df.iterrows()]
-        
-        # Add a "Select patient" option at the beginning
-        patient_options.insert(0, "Select patient")
-        
-        selected_option = st.selectbox("Select Patient", patient_options)
-        
-        if selected_option == "Select patient":
+        if patient_to_view is None:
             st.info("Please select a patient to view their medical records.")
             return
-        
-        # Extract patient_id from selection
-        patient_to_view = int(selected_option.split("ID: ")[1].rstrip(')'))
     
     # Get patient details
     patient = database.fetch_one(
@@ -346,7 +357,7 @@ def medical_records(patient_id=None):
             st.info("No medical records found for this patient.")
         else:
             # Format dates
-            medical_history_df['date'] = pd.to_datetime(medical_history_df['date']).dt.strftime('%Y-%m-%d %H:%M')
+            medical_history_df['date'] = medical_history_df['date'].dt.strftime('%Y-%m-%d %H:%M')
             
             # Rename columns for display
             display_df = medical_history_df.rename(columns={
@@ -403,6 +414,95 @@ def medical_records(patient_id=None):
                         time.sleep(1)
                         st.rerun()
 
+CLINICAL_SEARCH_PAGE_SIZE = 20
+
+def _highlight_snippet(snippet):
+    """Escape markdown in a search snippet and bold the matched words."""
+    for char in '\\`*_[]#<>|~$':
+        snippet = snippet.replace(char, '\\' + char)
+    
+    start, end = database.SNIPPET_MARKERS
+    return snippet.replace(start, '**').replace(end, '**').replace('\n', ' ')
+
+def clinical_search():
+    """Full-text search across medical records and prescription notes."""
+    st.header("Clinical Search")
+    
+    search_term = st.text_input("Search diagnoses, treatments and notes")
+    
+    col1, col2, col3, col4 = st.columns(4)
+    
+    with col1:
+        doctors_df = database.query_to_dataframe(
+            "SELECT user_id, full_name FROM Users WHERE role = 'doctor' ORDER BY full_name",
+            cache=True
+        )
+        doctor_options = {0: "All doctors"}
+        doctor_options.update(zip(doctors_df['user_id'].tolist(), doctors_df['full_name'].tolist()))
+        
+        doctor_id = st.selectbox("Doctor", options=list(doctor_options.keys()), format_func=lambda x: doctor_options[x])
+    
+    with col2:
+        start_date = st.date_input("From", value=None)
+    
+    with col3:
+        end_date = st.date_input("To", value=None)
+    
+    with col4:
+        sort_by = st.selectbox("Sort by", ["Relevance", "Newest"])
+    
+    if not search_term.strip():
+        st.info("Enter a search term to find matching medical records and prescriptions.")
+        return
+    
+    # Start from the first page whenever the search itself changes
+    search_key = (search_term, doctor_id, start_date, end_date, sort_by)
+    if st.session_state.get('clinical_search_key') != search_key:
+        st.session_state.clinical_search_key = search_key
+        st.session_state.clinical_search_page = 1
+    
+    results, total, truncated = database.search_clinical_notes(
+        search_term,
+        doctor_id=doctor_id or None,
+        start_date=start_date,
+        end_date=end_date,
+        order_by=sort_by.lower(),
+        page=st.session_state.clinical_search_page,
+        page_size=CLINICAL_SEARCH_PAGE_SIZE
+    )
+    
+    if total == 0:
+        st.info("No medical records or prescriptions match your search.")
+        return
+    
+    page_count = (total + CLINICAL_SEARCH_PAGE_SIZE - 1) // CLINICAL_SEARCH_PAGE_SIZE
+    st.write(f"**{total}{'+' if truncated else ''}** matches")
+    
+    if truncated:
+        st.caption(f"Only the {database.CLINICAL_SEARCH_WINDOW} most recently entered matches of each kind are shown. Add filters to narrow the search.")
+    
+    for result in results:
+        with st.container(border=True):
+            st.markdown(f"**{result['source']} #{result['id']}** - {result['title'] or ''}")
+            st.caption(f"{result['patient']} (ID: {result['patient_id']}) | {result['doctor'] or 'Unknown doctor'} | {str(result['date'])[:16]}")
+            st.markdown(_highlight_snippet(result['snippet'] or ''))
+    
+    # Pagination
+    col1, col2, col3 = st.columns([1, 2, 1])
+    
+    with col1:
+        if st.button("Previous", disabled=st.session_state.clinical_search_page <= 1):
+            st.session_state.clinical_search_page -= 1
+            st.rerun()
+    
+    with col2:
+        st.write(f"Page {st.session_state.clinical_search_page} of {page_count}")
+    
+    with col3:
+        if st.button("Next", disabled=st.session_state.clinical_search_page >= page_count):
+            st.session_state.clinical_search_page += 1
+            st.rerun()
+
 def my_patients(doctor_id):
     """View patients assigned to a specific doctor."""
     st.header("My Patients")
@@ -423,7 +523,7 @@ def my_patients(doctor_id):
         st.info("You have no patients assigned to you.")
     else:
         # Format dates
-        patients_df['date_of_birth'] = pd.to_datetime(patients_df['date_of_birth']).dt.strftime('%Y-%m-%d')
+        patients_df['date_of_birth'] = patients_df['date_of_birth'].dt.strftime('%Y-%m-%d')
         
         # Add a full name column
         patients_df['full_name'] = patients_df['first_name'] + ' ' + patients_df['last_name']
@@ -4,6 +4,7 @@ import pandas as pd
 from datetime import datetime, timedelta
 import time
 import audit
+import utils
 
 def get_pending_prescriptions_count():
     """Get the count of pending prescriptions."""
@@ -12,6 +13,74 @@ def get_pending_prescriptions_count():
     )
     return result[0] if result else 0
 
+def _stock_status(stock_quantity, reorder_level):
+    """Derive a medication status from its stock level."""
+    if stock_quantity == 0:
+        return "out of stock"
+    elif stock_quantity <= (reorder_level or 0):
+        return "low stock"
+    return "available"
+
+def fill_prescription(prescription_id, medication_id):
+    """Fill a pending prescription and deduct one unit of stock in one transaction.
+    
+    Returns (filled, message); nothing is written unless both updates succeed.
+    """
+    with database.transaction() as conn:
+        medication = conn.execute(
+            "SELECT stock_quantity, reorder_level FROM Pharmacy WHERE medication_id = ?",
+            (medication_id,)
+        ).fetchone()
+        
+        if not medication or medication[0] <= 0:
+            return False, "Cannot fill prescription. Medication is out of stock."
+        
+        # Only a still-pending prescription may be filled
+        filled = conn.execute(
+            "UPDATE Prescriptions SET status = 'filled' WHERE prescription_id = ? AND status = 'pending'",
+            (prescription_id,)
+        ).rowcount
+        
+        if not filled:
+            return False, "This prescription has already been processed."
+        
+        new_stock = medication[0] - 1
+        conn.execute(
+            "UPDATE Pharmacy SET stock_quantity = ?, status = ? WHERE medication_id = ?",
+            (new_stock, _stock_status(new_stock, medication[1]), medication_id)
+        )
+    
+    return True, f"Prescription filled successfully! Remaining stock: {new_stock}"
+
+def adjust_medication_stock(medication_id, transaction_type, quantity):
+    """Add, remove or set medication stock against the current level in one transaction.
+    
+    Returns the new stock level, or None if the medication does not exist.
+    """
+    with database.transaction() as conn:
+        medication = conn.execute(
+            "SELECT stock_quantity, reorder_level FROM Pharmacy WHERE medication_id = ?",
+            (medication_id,)
+        ).fetchone()
+        
+        if not medication:
+            return None
+        
+        new_quantity = medication[0]
+        if transaction_type == "Add Stock":
+            new_quantity += quantity
+        elif transaction_type == "Remove Stock":
+            new_quantity = max(0, new_quantity - quantity)
+        else:  # Set Stock Level
+            new_quantity = quantity
+        
+        conn.execute(
+            "UPDATE Pharmacy SET stock_quantity = ?, status = ? WHERE medication_id = ?",
+            (new_quantity, _stock_status(new_quantity, medication[1]), medication_id)
+        )
+    
+    return new_quantity
+
 def pharmacy_management():
     """Pharmacy management page."""
     st.header("Pharmacy Management")
@@ -31,7 +100,8 @@ def pharmacy_management():
             category_filter = st.selectbox(
                 "Category", 
                 ["All"] + sorted(set([row[0] for row in database.fetch_all(
-                    "SELECT DISTINCT category FROM Pharmacy ORDER BY category"
+                    "SELECT DISTINCT category FROM Pharmacy ORDER BY category",
+                    cache=True
                 ) or []])),
                 key="med_category"
             )
@@ -95,7 +165,7 @@ def pharmacy_management():
             medications_df['total_value'] = medications_df['stock_quantity'] * medications_df['unit_price']
             
             # Format dates and currency
-            medications_df['expiry_date'] = pd.to_datetime(medications_df['expiry_date']).dt.strftime('%Y-%m-%d')
+            medications_df['expiry_date'] = medications_df['expiry_date'].dt.strftime('%Y-%m-%d')
             medications_df['unit_price'] = medications_df['unit_price'].apply(lambda x: f"${x:.2f}")
             medications_df['total_value'] = medications_df['total_value'].apply(lambda x: f"${x:.2f}")
             
@@ -269,33 +339,8 @@ def pharmacy_management():
                                     time.sleep(1)  # Simple animation delay
                                 
                                 if update_type == "Update Stock":
-                                    # Calculate new quantity
-                                    new_quantity = med_details[5]  # current stock
-                                    if transaction_type == "Add Stock":
-                                        new_quantity += quantity
-                                    elif transaction_type == "Remove Stock":
-                                        new_quantity = max(0, new_quantity - quantity)
-                                    else:  # Set Stock Level
-                                        new_quantity = quantity
-                                    
-                                    # Determine new status
-                                    new_status = med_details[10]  # current status
-                                    if new_quantity == 0:
-                                        new_status = "out of stock"
-                                    elif new_quantity <= med_details[7]:  # reorder level
-                                        new_status = "low stock"
-                                    else:
-                                        new_status = "available"
-                                    
-                                    # Update medication
-                                    database.update_record(
-                                        "Pharmacy",
-                                        {
-                                            "stock_quantity": new_quantity,
-                                            "status": new_status
-                                        },
-                                        {"medication_id": med_id}
-                                    )
+                                    # Apply the change to the current stock level atomically
+                                    adjust_medication_stock(med_id, transaction_type, quantity)
                                     
                                     # Record in audit log
                                     audit.record_activity(
@@ -395,7 +440,7 @@ def pharmacy_management():
         
         # Time filter
         if time_filter == "Today":
-            where_clauses.append("DATE(p.created_at) = DATE('now')")
+            where_clauses.append("p.created_at >= DATE('now') AND p.created_at < DATE('now', '+1 day')")
         elif time_filter == "Last 7 Days":
             where_clauses.append("p.created_at >= datetime('now', '-7 days')")
         elif time_filter == "Last 30 Days":
@@ -405,16 +450,19 @@ def pharmacy_management():
         if where_clauses:
             query += " WHERE " + " AND ".join(where_clauses)
         
-        query += " ORDER BY p.created_at DESC"
-        
-        # Execute query
-        prescriptions_df = database.query_to_dataframe(query, params)
+        # Fetch the current page, newest first with the ID as a tiebreaker for paging
+        prescriptions_df = utils.keyset_pager(
+            "prescription_list",
+            query,
+            params,
+            [("created_at", True), ("prescription_id", True)]
+        )
         
         if prescriptions_df.empty:
             st.info("No prescriptions found matching your criteria.")
         else:
             # Format dates
-            prescriptions_df['created_at'] = pd.to_datetime(prescriptions_df['created_at']).dt.strftime('%Y-%m-%d %H:%M')
+            prescriptions_df['created_at'] = prescriptions_df['created_at'].dt.strftime('%Y-%m-%d %H:%M')
             
             # Add status indicators
             def get_status_indicator(status):
@@ -507,51 +555,15 @@ def pharmacy_management():
                     with col1:
                         if prescription[12] == "pending":
                             if st.button("Fill Prescription"):
-                                # Get medication stock
-                                med_stock = database.fetch_one(
-                                    "SELECT stock_quantity FROM Pharmacy WHERE medication_id = ?",
-                                    (prescription[5],)
-                                )[0]
+                                # Animation
+                                with st.spinner("Filling prescription..."):
+                                    time.sleep(1.5)  # Simple animation delay
                                 
-                                # Simple logic to determine if enough stock exists
+                                # Mark as filled and deduct 1 unit of stock in one transaction
                                 # For a real system, would need more complex logic based on dosage, duration, etc.
-                                if med_stock > 0:
-                                    # Animation
-                                    with st.spinner("Filling prescription..."):
-                                        time.sleep(1.5)  # Simple animation delay
-                                    
-                                    # Update prescription status
-                                    database.update_record(
-                                        "Prescriptions",
-                                        {"status": "filled"},
-                                        {"prescription_id": prescription_id}
-                                    )
-                                    
-                                    # Update medication stock (deduct 1 unit)
-                                    new_stock = med_stock - 1
-                                    
-                                    # Determine new status
-                                    med_reorder_level = database.fetch_one(
-                                        "SELECT reorder_level FROM Pharmacy WHERE medication_id = ?",
-                                        (prescription[5],)
-                                    )[0]
-                                    
-                                    new_status = "available"
-                                    if new_stock == 0:
-                                        new_status = "out of stock"
-                                    elif new_stock <= med_reorder_level:
-                                        new_status = "low stock"
-                                    
-                                    # Update medication
-                                    database.update_record(
-                                        "Pharmacy",
-                                        {
-                                            "stock_quantity": new_stock,
-                                            "status": new_status
-                                        },
-                                        {"medication_id": prescription[5]}
-                                    )
-                                    
+                                filled, message = fill_prescription(prescription_id, prescription[5])
+                                
+                                if filled:
                                     # Record in audit log
                                     audit.record_activity(
                                         st.session_state.user_id,
@@ -559,11 +571,11 @@ def pharmacy_management():
                                         f"Filled prescription ID {prescription_id} for patient {prescription[2]}"
                                     )
                                     
-                                    st.success("Prescription filled successfully!")
+                                    st.success(message)
                                     time.sleep(1)
                                     st.rerun()
                                 else:
-                                    st.error("Cannot fill prescription. Medication is out of stock.")
+                                    st.error(message)
                     
                     with col2:
                         if prescription[12] == "pending":
@@ -594,65 +606,25 @@ def pharmacy_management():
         if st.session_state.role in ['admin', 'doctor', 'pharmacist']:
             st.subheader("Create New Prescription")
             
+            # Patient, medication and doctor search sit outside the form so the matches update as the user types
+            col1, col2 = st.columns(2)
+            
+            with col1:
+                selected_patient = utils.entity_picker("Patient*", "patient", "new_prescription_patient", status="active")
+                selected_medication = utils.entity_picker(
+                    "Medication*", "medication", "new_prescription_medication", status="available"
+                )
+            
+            with col2:
+                # Doctor is the logged-in user if a doctor, or selectable if admin/pharmacist
+                if st.session_state.role == 'doctor':
+                    selected_doctor = st.session_state.user_id
+                    st.write(f"**Prescribing Doctor:** {st.session_state.username}")
+                else:
+                    selected_doctor = utils.entity_picker("Doctor*", "doctor", "new_prescription_doctor")
+            
             with st.form("new_prescription_form"):
-                col1, col2 = st.columns(2)
-                
-                with col1:
-                    # Get patient list
-                    patients_df = database.query_to_dataframe(
-                        "SELECT patient_id, first_name || ' ' || last_name as patient_name FROM Patients WHERE status = 'active'"
-                    )
-                    patient_options = {row['patient_id']: row['patient_name'] for _, row in patients_df.iterrows()}
-                    
-                    # Add a placeholder
-                    patient_options[0] = "Select a patient"
-                    
-                    # Get medication list
-                    medications_df = database.query_to_dataframe(
-                        "SELECT medication_id, name || ' (' || dosage || ')' as med_name FROM Pharmacy WHERE status = 'available'"
-                    )
-                    med_options = {row['medication_id']: row['med_name'] for _, row in medications_df.iterrows()}
-                    
-                    # Add a placeholder
-                    med_options[0] = "Select a medication"
-                    
-                    selected_patient = st.selectbox(
-                        "Patient*",
-                        options=list(patient_options.keys()),
-                        format_func=lambda x: patient_options[x],
-                        index=0
-                    )
-                    
-                    selected_medication = st.selectbox(
-                        "Medication*",
-                        options=list(med_options.keys()),
-                        format_func=lambda x: med_options[x],
-                        index=0
-                    )
-                
-                with col2:
-                    # Doctor is the logged-in user if a doctor, or selectable if admin/pharmacist
-                    if st.session_state.role == 'doctor':
-                        selected_doctor = st.session_state.user_id
-                        st.write(f"**Prescribing Doctor:** {st.session_state.username}")
-                    else:
-                        # Get doctor list
-                        doctors_df = database.query_to_dataframe(
-                            "SELECT user_id, full_name FROM Users WHERE role = 'doctor'"
-                        )
-                        doctor_options = {row['user_id']: row['full_name'] for _, row in doctors_df.iterrows()}
-                        
-                        # Add a placeholder
-                        doctor_options[0] = "Select a doctor"
-                        
-                        selected_doctor = st.selectbox(
-                            "Doctor*",
-                            options=list(doctor_options.keys()),
-                            format_func=lambda x: doctor_options[x],
-                            index=0
-                        )
-                    
-                    dosage = st.text_input("Dosage*", placeholder="e.g., 1 tablet")
+                dosage = st.text_input("Dosage*", placeholder="e.g., 1 tablet")
                 
                 col1, col2 = st.columns(2)
                 
@@ -667,8 +639,7 @@ def pharmacy_management():
                 prescription_submitted = st.form_submit_button("Create Prescription")
                 
                 if prescription_submitted:
-                    if (selected_patient == 0 or selected_medication == 0 or 
-                        (st.session_state.role != 'doctor' and selected_doctor == 0) or 
+                    if (selected_patient is None or selected_medication is None or selected_doctor is None or
                         not dosage or not frequency or not duration):
                         st.error("Please fill in all required fields.")
                     else:
@@ -714,81 +685,59 @@ def pharmacy_management():
         col1, col2 = st.columns(2)
         
         with col1:
-            medications_df = database.query_to_dataframe(
-                "SELECT medication_id, name FROM Pharmacy ORDER BY name"
-            )
+            med1 = utils.entity_picker("First Medication", "medication", "interaction_medication_1")
+            med2 = utils.entity_picker("Second Medication", "medication", "interaction_medication_2")
             
-            if not medications_df.empty:
-                medication_list = medications_df['name'].tolist()
-                
-                med1 = st.selectbox("First Medication", ["Select medication"] + medication_list)
-                med2 = st.selectbox("Second Medication", ["Select medication"] + medication_list)
-                
-                check_interaction = st.button("Check Interaction")
-                
-                if check_interaction:
-                    if med1 == "Select medication" or med2 == "Select medication":
-                        st.error("Please select both medications.")
-                    elif med1 == med2:
-                        st.warning("You've selected the same medication twice.")
-                    else:
-                        # This is a placeholder. In a real system, this would query a drug interaction database
-                        st.info(f"No known interactions between {med1} and {med2}.")
-            else:
-                st.warning("No medications in the database to check.")
+            check_interaction = st.button("Check Interaction")
+            
+            if check_interaction:
+                if med1 is None or med2 is None:
+                    st.error("Please select both medications.")
+                elif med1 == med2:
+                    st.warning("You've selected the same medication twice.")
+                else:
+                    # This is a placeholder. In a real system, this would query a drug interaction database
+                    st.info(
+                        f"No known interactions between {database.entity_label('medication', med1)} "
+                        f"and {database.entity_label('medication', med2)}."
+                    )
         
         with col2:
             st.write("#### Patient Medication Review")
             
-            patients_df = database.query_to_dataframe(
-                "SELECT patient_id, first_name || ' ' || last_name as patient_name FROM Patients WHERE status = 'active'"
-            )
+            selected_review_patient = utils.entity_picker("Select Patient", "patient", "review_patient", status="active")
             
-            if not patients_df.empty:
-                patient_options = {row['patient_id']: row['patient_name'] for _, row in patients_df.iterrows()}
-                patient_options[0] = "Select a patient"
-                
-                selected_review_patient = st.selectbox(
-                    "Select Patient",
-                    options=list(patient_options.keys()),
-                    format_func=lambda x: patient_options[x],
-                    index=0,
-                    key="review_patient"
+            if selected_review_patient is not None:
+                # Get patient's active prescriptions
+                active_prescriptions = database.query_to_dataframe(
+                    """
+                    SELECT 
+                        p.prescription_id,
+                        ph.name as medication,
+                        p.dosage,
+                        p.frequency,
+                        p.created_at
+                    FROM Prescriptions p
+                    JOIN Pharmacy ph ON p.medication_id = ph.medication_id
+                    WHERE p.patient_id = ? AND p.status = 'filled'
+                    ORDER BY p.created_at DESC
+                    """,
+                    (selected_review_patient,)
                 )
                 
-                if selected_review_patient != 0:
-                    # Get patient's active prescriptions
-                    active_prescriptions = database.query_to_dataframe(
-                        """
-                        SELECT 
-                            p.prescription_id,
-                            ph.name as medication,
-                            p.dosage,
-                            p.frequency,
-                            p.created_at
-                        FROM Prescriptions p
-                        JOIN Pharmacy ph ON p.medication_id = ph.medication_id
-                        WHERE p.patient_id = ? AND p.status = 'filled'
-                        ORDER BY p.created_at DESC
-                        """,
-                        (selected_review_patient,)
-                    )
+                if not active_prescriptions.empty:
+                    st.write("**Current Medications:**")
                     
-                    if not active_prescriptions.empty:
-                        st.write("**Current Medications:**")
-                        
-                        for _, row in active_prescriptions.iterrows():
-                            st.write(f"- {row['medication']} - {row['dosage']} - {row['frequency']}")
-                        
-                        st.write("**Potential Interactions:**")
-                        
-                        # Placeholder for interaction checking
-                        # In a real system, would check all medication combinations
-                        if len(active_prescriptions) > 1:
-                            st.info("No significant interactions detected among current medications.")
-                        else:
-                            st.success("Only one medication prescribed - no interactions to check.")
+                    for _, row in active_prescriptions.iterrows():
+                        st.write(f"- {row['medication']} - {row['dosage']} - {row['frequency']}")
+                    
+                    st.write("**Potential Interactions:**")
+                    
+                    # Placeholder for interaction checking
+                    # In a real system, would check all medication combinations
+                    if len(active_prescriptions) > 1:
+                        st.info("No significant interactions detected among current medications.")
                     else:
-                        st.info("This patient has no active prescriptions.")
-            else:
-                st.warning("No patients in the database.")
+                        st.success("Only one medication prescribed - no interactions to check.")
+                else:
+                    st.info("This patient has no active prescriptions.")
@@ -68,10 +68,9 @@ def populate_sample_data():
     ]
     
     # Add sample users if they don't exist already
-    for user in sample_users:
-        if user["username"] not in existing_usernames:
-            user_id = database.insert_record("Users", user)
-            print(f"Added user: {user['username']} (ID: {user_id})")
+    new_users = [user for user in sample_users if user["username"] not in existing_usernames]
+    for user, user_id in zip(new_users, database.insert_records("Users", new_users) or []):
+        print(f"Added user: {user['username']} (ID: {user_id})")
     
     # Get all users for reference in other tables
     all_users = database.fetch_all("SELECT user_id, username, role FROM Users")
@@ -97,6 +96,7 @@ def populate_sample_data():
         num_patients_to_add = 20 - existing_patients_count
         print(f"Adding {num_patients_to_add} new sample patients")
         
+        new_patients = []
         for i in range(num_patients_to_add):
             first_name = random.choice(first_names)
             last_name = random.choice(last_names)
@@ -118,8 +118,10 @@ def populate_sample_data():
                 "status": "active"
             }
             
-            patient_id = database.insert_record("Patients", patient)
-            print(f"Added patient: {first_name} {last_name} (ID: {patient_id})")
+            new_patients.append(patient)
+        
+        for patient, patient_id in zip(new_patients, database.insert_records("Patients", new_patients) or []):
+            print(f"Added patient: {patient['first_name']} {patient['last_name']} (ID: {patient_id})")
     
     # Get all patients for appointments and billing
     patients = database.fetch_all("SELECT patient_id, first_name, last_name FROM Patients")
@@ -133,6 +135,8 @@ def populate_sample_data():
         num_appointments_to_add = 30 - existing_appointments_count
         print(f"Adding {num_appointments_to_add} new sample appointments")
         
+        doctor_names = dict(doctors)
+        new_appointments = []
         for i in range(num_appointments_to_add):
             patient_id, _, _ = random.choice(patients)
             doctor_id, _ = random.choice(doctors)
@@ -174,8 +178,10 @@ def populate_sample_data():
                 "created_at": (datetime.now() - timedelta(days=random.randint(1, 30))).strftime('%Y-%m-%d %H:%M:%S')
             }
             
-            appointment_id = database.insert_record("Appointments", appointment)
-            print(f"Added appointment ID: {appointment_id} for patient {patient_id} with Dr. {doctors[doctors.index((doctor_id, doctors[doctors.index((doctor_id, _))][1]))][1]}")
+            new_appointments.append(appointment)
+        
+        for appointment, appointment_id in zip(new_appointments, database.insert_records("Appointments", new_appointments) or []):
+            print(f"Added appointment ID: {appointment_id} for patient {appointment['patient_id']} with Dr. {doctor_names[appointment['doctor_id']]}")
     
     # Add sample inventory items
     existing_inventory_count = database.fetch_one("SELECT COUNT(*) FROM Inventory")[0]
@@ -203,12 +209,12 @@ def populate_sample_data():
             {"item_name": "Hand Sanitizer", "category": "Medical Supplies", "quantity": random.randint(100, 300), "unit": "bottles", "unit_price": 7.50, "supplier": "PharmaCare", "reorder_level": 50, "expiry_date": (datetime.now() + timedelta(days=365)).strftime('%Y-%m-%d')}
         ]
         
-        for i in range(min(num_items_to_add, len(sample_inventory))):
-            item = sample_inventory[i]
+        new_items = sample_inventory[:num_items_to_add]
+        for item in new_items:
             item["last_updated"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             item["status"] = "available" if item["quantity"] > item["reorder_level"] else "low stock"
-            
-            item_id = database.insert_record("Inventory", item)
+        
+        for item, item_id in zip(new_items, database.insert_records("Inventory", new_items) or []):
             print(f"Added inventory item: {item['item_name']} (ID: {item_id})")
     
     # Add sample pharmacy items
@@ -237,11 +243,11 @@ def populate_sample_data():
             {"name": "Furosemide 40mg", "generic_name": "Furosemide", "category": "Diuretic", "dosage": "40mg", "stock_quantity": random.randint(100, 300), "unit_price": 11.50, "supplier": "PharmaCare", "reorder_level": 50, "expiry_date": (datetime.now() + timedelta(days=365)).strftime('%Y-%m-%d')}
         ]
         
-        for i in range(min(num_meds_to_add, len(sample_medications))):
-            med = sample_medications[i]
+        new_meds = sample_medications[:num_meds_to_add]
+        for med in new_meds:
             med["status"] = "available" if med["stock_quantity"] > med["reorder_level"] else "low stock"
-            
-            med_id = database.insert_record("Pharmacy", med)
+        
+        for med, med_id in zip(new_meds, database.insert_records("Pharmacy", new_meds) or []):
             print(f"Added medication: {med['name']} (ID: {med_id})")
     
     # Add sample billing records
@@ -282,6 +288,7 @@ def populate_sample_data():
             None  # For self-pay patients
         ]
         
+        new_bills = []
         for i in range(num_bills_to_add):
             patient_id, _, _ = random.choice(patients)
             service = random.choice(services)
@@ -312,8 +319,10 @@ def populate_sample_data():
                 "status": status
             }
             
-            bill_id = database.insert_record("Billing", bill)
-            print(f"Added bill: {bill_id} for patient {patient_id} - {service['description']} (KSH {service['amount']:.2f})")
+            new_bills.append(bill)
+        
+        for bill, bill_id in zip(new_bills, database.insert_records("Billing", new_bills) or []):
+            print(f"Added bill: {bill_id} for patient {bill['patient_id']} - {bill['service_description']} (KSH {bill['amount']:.2f})")
     
     # Add sample medical history records
     existing_medical_records_count = database.fetch_one("SELECT COUNT(*) FROM MedicalHistory")[0]
@@ -359,6 +368,7 @@ def populate_sample_data():
             "Statin therapy and lifestyle modifications"
         ]
         
+        new_records = []
         for i in range(num_records_to_add):
             patient_id, _, _ = random.choice(patients)
             doctor_id, _ = random.choice(doctors)
@@ -379,8 +389,10 @@ def populate_sample_data():
                 "notes": "Sample medical record"
             }
             
-            record_id = database.insert_record("MedicalHistory", record)
-            print(f"Added medical record: {record_id} for patient {patient_id} - {diagnosis}")
+            new_records.append(record)
+        
+        for record, record_id in zip(new_records, database.insert_records("MedicalHistory", new_records) or []):
+            print(f"Added medical record: {record_id} for patient {record['patient_id']} - {record['diagnosis']}")
     
     # Add sample prescriptions
     existing_prescriptions_count = database.fetch_one("SELECT COUNT(*) FROM Prescriptions")[0]
@@ -399,6 +411,8 @@ def populate_sample_data():
             statuses = ["pending", "filled", "cancelled", "expired"]
             weights = [0.3, 0.5, 0.1, 0.1]  # Probability weights
             
+            medication_names = dict(medications)
+            new_prescriptions = []
             for i in range(num_prescriptions_to_add):
                 patient_id, _, _ = random.choice(patients)
                 doctor_id, _ = random.choice(doctors)
@@ -423,8 +437,10 @@ def populate_sample_data():
                     "created_at": created_at.strftime('%Y-%m-%d %H:%M:%S')
                 }
                 
-                prescription_id = database.insert_record("Prescriptions", prescription)
-                print(f"Added prescription: {prescription_id} for patient {patient_id} - {medication_name}")
+                new_prescriptions.append(prescription)
+            
+            for prescription, prescription_id in zip(new_prescriptions, database.insert_records("Prescriptions", new_prescriptions) or []):
+                print(f"Added prescription: {prescription_id} for patient {prescription['patient_id']} - {medication_names[prescription['medication_id']]}")
     
     # Add sample staff records (for users with appropriate roles)
     staff_roles = ['doctor', 'nurse', 'receptionist', 'pharmacist']
@@ -456,6 +472,7 @@ def populate_sample_data():
             'pharmacist': ['Chief Pharmacist', 'Clinical Pharmacist', 'Staff Pharmacist']
         }
         
+        new_staff = []
         for user_id, username, role in users_needing_staff_records:
             department = random.choice(departments.get(role, ['General']))
             position = random.choice(positions.get(role, ['Staff']))
@@ -484,8 +501,11 @@ def populate_sample_data():
                 "status": "active"
             }
             
-            staff_id = database.insert_record("Staff", staff)
-            print(f"Added staff record: {staff_id} for {username} ({role}) in {department}")
+            new_staff.append(staff)
+        
+        staff_ids = database.insert_records("Staff", new_staff) or []
+        for (user_id, username, role), staff, staff_id in zip(users_needing_staff_records, new_staff, staff_ids):
+            print(f"Added staff record: {staff_id} for {username} ({role}) in {staff['department']}")
     
     print("Database population complete!")
 
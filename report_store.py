@@ -0,0 +1,256 @@
+import database
+from datetime import datetime, timedelta
+import os
+import re
+import threading
+import time
+import pandas as pd
+
+# Each scheduled report keeps its versioned Parquet snapshots in its own folder here
+REPORT_STORE_DIR = os.environ.get('HOSPITAL_REPORT_STORE', 'report_snapshots')
+SNAPSHOTS_KEPT = int(os.environ.get('HOSPITAL_REPORT_SNAPSHOTS_KEPT', '5'))  # Versions kept per report
+SCHEDULER_INTERVAL = 30  # Seconds between checks for reports that are due
+REFRESH_WAIT = float(os.environ.get('HOSPITAL_REPORT_REFRESH_WAIT', '60'))  # Seconds a page waits on a requested refresh
+SNAPSHOT_SUFFIX = '.parquet'
+VERSION_FORMAT = '%Y%m%dT%H%M%S%f'  # Snapshot file names, so they sort by age
+
+# Allowed range of each cron field: minute, hour, day of month, month, day of week (0 = Sunday)
+CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+CRON_HORIZON = timedelta(days=5 * 366)  # Schedules with no run this far ahead never run
+
+# Registered reports: name -> query, params and cron schedule
+_reports = {}
+_reports_lock = threading.Lock()
+
+# Background scheduler and the manual refreshes waiting for it
+_scheduler = None
+_scheduler_lock = threading.Lock()
+_wakeup = threading.Event()
+_requested = {}  # Report name -> events set once its next refresh finishes
+_scheduler_stats = {"refreshes": 0, "failures": 0, "last_refresh_time": 0.0}
+
+# Snapshots already read from disk, by path; files never change once written
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+def parse_schedule(schedule):
+    """Parse a five-field cron expression into the set of values each field allows.
+    
+    Fields accept *, numbers, a-b ranges, comma lists and /step, as in cron.
+    Day of week 7 is Sunday, like 0. Raises ValueError for anything else.
+    """
+    fields = schedule.split()
+    if len(fields) != len(CRON_FIELDS):
+        raise ValueError(f"Schedule '{schedule}' needs {len(CRON_FIELDS)} fields")
+    
+    allowed = []
+    for field, (low, high) in zip(fields, CRON_FIELDS):
+        values = set()
+        
+        for part in field.split(','):
+            spec, _, step = part.partition('/')
+            try:
+                if spec == '*':
+                    start, end = low, high
+                elif '-' in spec:
+                    start, end = (int(value) for value in spec.split('-', 1))
+                else:
+                    start = int(spec)
+                    end = high if step else start
+                step = int(step or 1)
+            except ValueError:
+                raise ValueError(f"Schedule '{schedule}' has an invalid field '{field}'")
+            
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError(f"Schedule '{schedule}' has an out of range field '{field}'")
+            values.update(range(start, end + 1, step))
+        
+        allowed.append(values)
+    
+    if 7 in allowed[4]:
+        allowed[4] = (allowed[4] - {7}) | {0}
+    
+    # As in cron, restricting both day fields runs on days matching either
+    days_restricted = (fields[2] != '*', fields[4] != '*')
+    return allowed, days_restricted
+
+def next_run(schedule, after):
+    """Return the first minute strictly after `after` that a cron schedule runs at."""
+    (minutes, hours, days, months, weekdays), (by_day, by_weekday) = parse_schedule(schedule)
+    
+    moment = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    limit = moment + CRON_HORIZON
+    
+    while moment < limit:
+        day_matches = moment.day in days
+        weekday_matches = (moment.weekday() + 1) % 7 in weekdays
+        if by_day and by_weekday:
+            day_matches = day_matches or weekday_matches
+        else:
+            day_matches = day_matches and weekday_matches
+        
+        # Skip whole months, days and hours that cannot match
+        if moment.month not in months:
+            moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+        elif not day_matches:
+            moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+        elif moment.hour not in hours:
+            moment = moment.replace(minute=0) + timedelta(hours=1)
+        elif moment.minute not in minutes:
+            moment += timedelta(minutes=1)
+        else:
+            return moment
+    
+    raise ValueError(f"Schedule '{schedule}' never runs")
+
+def register_report(name, query, schedule, params=None):
+    """Register a report query to be refreshed in the background on a cron schedule."""
+    parse_schedule(schedule)
+    
+    with _reports_lock:
+        _reports[name] = {"query": query, "params": params, "schedule": schedule}
+
+def _report_dir(name):
+    """Return the folder holding a report's snapshots."""
+    return os.path.join(REPORT_STORE_DIR, re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_'))
+
+def list_snapshots(name):
+    """Return a report's stored snapshots as (taken_at, path) pairs, newest first."""
+    directory = _report_dir(name)
+    if not os.path.isdir(directory):
+        return []
+    
+    snapshots = []
+    for filename in os.listdir(directory):
+        if not filename.endswith(SNAPSHOT_SUFFIX):
+            continue
+        try:
+            taken_at = datetime.strptime(filename[:-len(SNAPSHOT_SUFFIX)], VERSION_FORMAT)
+        except ValueError:
+            continue
+        snapshots.append((taken_at, os.path.join(directory, filename)))
+    
+    return sorted(snapshots, reverse=True)
+
+def load_snapshot(path):
+    """Return the DataFrame stored in a snapshot file, reading each file from disk only once."""
+    with _loaded_lock:
+        df = _loaded.get(path)
+    
+    if df is None:
+        df = pd.read_parquet(path)
+        with _loaded_lock:
+            _loaded[path] = df
+    
+    return df.copy()
+
+def latest_snapshot(name):
+    """Return a report's newest snapshot as (DataFrame, taken_at), or (None, None) if it has none."""
+    snapshots = list_snapshots(name)
+    if not snapshots:
+        return None, None
+    
+    taken_at, path = snapshots[0]
+    return load_snapshot(path), taken_at
+
+def refresh_report(name):
+    """Run a registered report now and store the result as its newest snapshot; returns the snapshot path."""
+    with _reports_lock:
+        report = _reports[name]
+    
+    started = time.monotonic()
+    taken_at = datetime.now()
+    
+    # Report workers read through their own read-only connection, never a pooled one
+    with database.read_only_connection() as conn:
+        df = pd.read_sql_query(report["query"], conn, params=report["params"])
+    
+    df.attrs['query_time'] = time.monotonic() - started
+    
+    directory = _report_dir(name)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, taken_at.strftime(VERSION_FORMAT) + SNAPSHOT_SUFFIX)
+    
+    # Write under a temporary name so readers never see a half-written snapshot
+    df.to_parquet(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+    
+    for _, old_path in list_snapshots(name)[SNAPSHOTS_KEPT:]:
+        os.remove(old_path)
+        with _loaded_lock:
+            _loaded.pop(old_path, None)
+    
+    with _scheduler_lock:
+        _scheduler_stats["refreshes"] += 1
+        _scheduler_stats["last_refresh_time"] = time.monotonic() - started
+    
+    return path
+
+def next_refresh(name):
+    """Return when a report is next due, or None if it is not registered."""
+    with _reports_lock:
+        report = _reports.get(name)
+    if report is None:
+        return None
+    
+    snapshots = list_snapshots(name)
+    if not snapshots:
+        return datetime.now()
+    
+    return next_run(report["schedule"], snapshots[0][0])
+
+def start_scheduler():
+    """Start the background report scheduler unless it is already running."""
+    global _scheduler
+    
+    with _scheduler_lock:
+        if _scheduler is None or not _scheduler.is_alive():
+            _scheduler = threading.Thread(target=_run_scheduler, name="report-scheduler", daemon=True)
+            _scheduler.start()
+
+def request_refresh(name):
+    """Ask the scheduler to refresh a report now; returns an event set once the refresh finishes."""
+    done = threading.Event()
+    
+    with _scheduler_lock:
+        _requested.setdefault(name, []).append(done)
+    
+    start_scheduler()
+    _wakeup.set()
+    return done
+
+def _run_scheduler():
+    """Refresh requested reports and reports whose schedule is due, then sleep until the next check."""
+    while True:
+        _wakeup.clear()
+        
+        with _scheduler_lock:
+            requested = dict(_requested)
+            _requested.clear()
+        with _reports_lock:
+            names = list(_reports)
+        
+        for name in names:
+            try:
+                due = next_refresh(name)
+                if name in requested or due <= datetime.now():
+                    refresh_report(name)
+            except Exception as e:
+                with _scheduler_lock:
+                    _scheduler_stats["failures"] += 1
+                print(f"Error refreshing report {name}: {e}")
+            
+            for done in requested.pop(name, []):
+                done.set()
+        
+        # Requests for reports that are not registered
+        for waiting in requested.values():
+            for done in waiting:
+                done.set()
+        
+        _wakeup.wait(SCHEDULER_INTERVAL)
+
+def get_scheduler_stats():
+    """Return counters for scheduled report refreshes."""
+    with _scheduler_lock:
+        return dict(_scheduler_stats)
@@ -1,17 +1,529 @@
 import streamlit as st
 import database
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
 import plotly.express as px
 import plotly.graph_objects as go
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+import threading
 import utils
+import report_store
+import analytics
+
+# Most rows of a custom report shown on screen; the CSV export includes everything
+REPORT_PREVIEW_ROWS = 1000
+
+# Most points a time-series chart sends to the browser, whatever the selected range
+CHART_MAX_POINTS = int(os.environ.get('HOSPITAL_CHART_MAX_POINTS', '200'))
+
+# Chart buckets from finest to coarsest, as (label, resample rule)
+CHART_GRANULARITIES = (("Day", "D"), ("Week", "W"), ("Month", "MS"))
+
+# Worker threads that run report panel queries concurrently
+REPORT_WORKERS = int(os.environ.get('HOSPITAL_REPORT_WORKERS', '6'))
+
+# Shared by every session; each worker reads through its own read-only connection
+_report_executor = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix="report-panel")
+
+# Saved report templates, refreshed in the background on a cron schedule and
+# served from their latest stored snapshot
+REPORT_TEMPLATES = {
+    "Patient Visits by Month": {
+        "schedule": "0 * * * *",
+        "query": """
+            SELECT 
+                strftime('%Y-%m', day) as month,
+                SUM(appointments) as visit_count
+            FROM DailyAppointments
+            WHERE NULLIF(status, '') != 'cancelled'
+            GROUP BY month
+            ORDER BY month
+        """,
+    },
+    "Top Doctors by Appointments": {
+        "schedule": "*/15 * * * *",
+        "query": """
+            SELECT 
+                u.full_name as doctor_name,
+                SUM(a.appointments) as appointment_count
+            FROM DailyAppointments a
+            JOIN Users u ON a.doctor_id = u.user_id
+            WHERE a.status = 'completed'
+            GROUP BY doctor_name
+            ORDER BY appointment_count DESC
+        """,
+    },
+    "Revenue by Insurance Provider": {
+        "schedule": "*/15 * * * *",
+        "query": """
+            SELECT 
+                COALESCE(NULLIF(insurance_provider, ''), 'Self-Pay') as provider,
+                SUM(bills) as bill_count,
+                SUM(amount) as total_amount
+            FROM DailyBilling
+            GROUP BY provider
+            ORDER BY total_amount DESC
+        """,
+    },
+}
+
+for name, template in REPORT_TEMPLATES.items():
+    report_store.register_report(name, template["query"], template["schedule"])
+
+def _load_template(name):
+    """Put a saved template's query in the custom query editor (runs before the editor is drawn)."""
+    st.session_state.custom_query = REPORT_TEMPLATES[name]["query"]
+
+def _run_panel_query(query, params, kind, path):
+    """Run one panel's query on a report worker and return (result, seconds)."""
+    started = time.perf_counter()
+    
+    with database.read_only_connection(path):
+        if kind == "value":
+            result = database.fetch_one(query, params)[0]
+        else:
+            result = database.query_to_dataframe(query, params)
+    
+    return result, time.perf_counter() - started
+
+def submit_panel(query, params, render, *render_args, kind="frame", path=None):
+    """Start a panel's query on the report pool and reserve the panel's place on the page.
+    
+    kind "frame" loads a DataFrame and "value" a single scalar; path reads another
+    database file such as the analytics mirror. Once the query finishes,
+    render_panels() calls render(result, *render_args) in that place.
+    """
+    placeholder = st.empty()
+    placeholder.caption("Loading...")
+    
+    return {
+        "future": _report_executor.submit(_run_panel_query, query, params, kind, path),
+        "placeholder": placeholder,
+        "render": render,
+        "args": render_args,
+    }
+
+def render_panels(panels):
+    """Render each submitted panel as soon as its query finishes; returns {panel: seconds}."""
+    names = {panel["future"]: name for name, panel in panels.items()}
+    timings = {}
+    
+    for future in as_completed(names):
+        name = names[future]
+        panel = panels[name]
+        
+        try:
+            result, elapsed = future.result()
+        except Exception as e:
+            print(f"Error loading report panel {name}: {e}")
+            panel["placeholder"].error(f"Could not load {name}.")
+            continue
+        
+        timings[name] = elapsed
+        with panel["placeholder"].container():
+            panel["render"](result, *panel["args"])
+    
+    return timings
+
+def _lttb(values, threshold):
+    """Return the indices of the points Largest-Triangle-Three-Buckets keeps from evenly spaced values.
+    
+    The first and last points are always kept. The rest are split into
+    threshold - 2 buckets, and each bucket keeps the point forming the largest
+    triangle with the point kept before it and the average of the next bucket,
+    so peaks and dips survive where plain averaging would flatten them.
+    """
+    n = len(values)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    kept = [0]
+    
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        
+        # The next bucket's average, or the last point after the final bucket
+        next_start, next_end = (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        next_x = (next_start + next_end - 1) / 2
+        next_y = values[next_start:next_end].mean()
+        
+        prev = kept[-1]
+        candidates = np.arange(start, end)
+        areas = np.abs(
+            (prev - next_x) * (values[start:end] - values[prev])
+            - (prev - candidates) * (next_y - values[prev])
+        )
+        kept.append(start + int(np.argmax(areas)))
+    
+    kept.append(n - 1)
+    return np.array(kept)
+
+def _time_series(daily, column, start_date, end_date):
+    """Bucket per-day totals for a line chart of at most CHART_MAX_POINTS points; returns (frame, granularity).
+    
+    Missing days count as zero. The finest of day, week or month that fits is
+    used, and if even months do not fit, LTTB thins them to the limit.
+    """
+    days = pd.date_range(start=start_date, end=end_date)
+    series = pd.Series(daily[column].to_numpy(dtype=float), index=pd.to_datetime(daily['date']))
+    series = series.reindex(days, fill_value=0)
+    
+    for granularity, rule in CHART_GRANULARITIES:
+        bucketed = series if rule == "D" else series.resample(rule).sum()
+        if len(bucketed) <= CHART_MAX_POINTS:
+            break
+    
+    frame = bucketed.rename_axis('date').reset_index(name=column)
+    if len(frame) > CHART_MAX_POINTS:
+        frame = frame.iloc[_lttb(frame[column].to_numpy(), CHART_MAX_POINTS)]
+    
+    return frame, granularity
+
+def _render_registrations(patients_over_time, start_date, end_date):
+    """Line chart of new registrations per day, week or month."""
+    if patients_over_time.empty:
+        st.info("No patient registrations in the selected time period.")
+        return
+    
+    chart_df, granularity = _time_series(patients_over_time, 'count', start_date, end_date)
+    
+    fig = px.line(
+        chart_df,
+        x='date',
+        y='count',
+        title='New Patient Registrations Over Time',
+        labels={'date': 'Date', 'count': f'Registrations per {granularity}'}
+    )
+    
+    st.plotly_chart(fig, use_container_width=True)
+
+def _render_demographics(patient_demographics):
+    """Pie chart of patients by gender."""
+    if patient_demographics.empty:
+        st.info("No patient demographic data available.")
+        return
+    
+    fig = px.pie(
+        patient_demographics,
+        values='count',
+        names='gender',
+        title='Patients by Gender',
+        color_discrete_sequence=px.colors.sequential.Teal
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
+def _render_age_distribution(age_distribution):
+    """Bar chart of patients per age band, youngest first."""
+    if age_distribution.empty:
+        st.info("No patient age data available.")
+        return
+    
+    # Order the bars from youngest to oldest band
+    age_distribution['age_group'] = pd.Categorical(
+        age_distribution['age_group'].astype(str),
+        categories=[label for label, _ in database.AGE_BANDS],
+        ordered=True
+    )
+    age_distribution = age_distribution.sort_values('age_group')
+    
+    fig = px.bar(
+        age_distribution,
+        x='age_group',
+        y='count',
+        title='Patient Age Distribution',
+        labels={'age_group': 'Age Group', 'count': 'Number of Patients'},
+        color_discrete_sequence=['#f0e6d2']
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
+def _render_appointment_status(appointment_status):
+    """Pie chart of appointments by status."""
+    if appointment_status.empty:
+        st.info("No appointment data available for the selected period.")
+        return
+    
+    fig = px.pie(
+        appointment_status,
+        values='count',
+        names='status',
+        title='Appointments by Status',
+        color_discrete_sequence=px.colors.qualitative.Pastel
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
+def _render_appointments_by_day(appointments_by_day):
+    """Bar chart of appointments per weekday, Monday first."""
+    if appointments_by_day.empty:
+        st.info("No appointment data available for the selected period.")
+        return
+    
+    # Ensure all days of week are included
+    all_days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+    day_df = pd.DataFrame({'day_of_week': all_days})
+    
+    merged_days = pd.merge(day_df, appointments_by_day, on='day_of_week', how='left')
+    merged_days['count'] = merged_days['count'].fillna(0)
+    
+    # Create ordered categorical type for proper sorting
+    merged_days['day_of_week'] = pd.Categorical(
+        merged_days['day_of_week'],
+        categories=all_days,
+        ordered=True
+    )
+    merged_days = merged_days.sort_values('day_of_week')
+    
+    fig = px.bar(
+        merged_days,
+        x='day_of_week',
+        y='count',
+        title='Appointments by Day of Week',
+        labels={'day_of_week': 'Day', 'count': 'Number of Appointments'},
+        color_discrete_sequence=['#f0e6d2']
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
+def _render_currency_metric(value, label):
+    """Single metric formatted as currency."""
+    st.metric(label, utils.format_currency(value))
+
+def _render_count_metric(value, label):
+    """Single metric shown as a plain count."""
+    st.metric(label, value)
+
+def _render_revenue(revenue_over_time, start_date, end_date):
+    """Line chart of paid revenue per day, week or month."""
+    if revenue_over_time.empty:
+        st.info("No revenue data available for the selected period.")
+        return
+    
+    chart_df, granularity = _time_series(revenue_over_time, 'revenue', start_date, end_date)
+    
+    fig = px.line(
+        chart_df,
+        x='date',
+        y='revenue',
+        title='Revenue Over Time',
+        labels={'date': 'Date', 'revenue': f'Revenue per {granularity} (KSh)'}
+    )
+    
+    fig.update_traces(line_color='#4c9085')
+    st.plotly_chart(fig, use_container_width=True)
+
+def _render_revenue_by_service(revenue_by_service):
+    """Table of the ten highest-earning services."""
+    if revenue_by_service.empty:
+        st.info("No revenue by service data available for the selected period.")
+        return
+    
+    # Format currency columns
+    revenue_by_service['total_amount'] = revenue_by_service['total_amount'].apply(utils.format_currency)
+    revenue_by_service['avg_amount'] = revenue_by_service['avg_amount'].apply(utils.format_currency)
+    
+    # Display as table
+    st.dataframe(revenue_by_service, use_container_width=True)
+
+def _render_payment_status(payment_status):
+    """Pie chart of billed amounts by payment status."""
+    if payment_status.empty:
+        st.info("No payment status data available for the selected period.")
+        return
+    
+    fig = px.pie(
+        payment_status,
+        values='total_amount',
+        names='status',
+        title='Total Amount by Payment Status',
+        color_discrete_sequence=px.colors.sequential.Viridis
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
+def _render_inventory_by_category(inventory_by_category):
+    """Table and bar chart of inventory value per category."""
+    if inventory_by_category.empty:
+        st.info("No inventory data available.")
+        return
+    
+    # Store numeric values for chart before formatting
+    inventory_by_category['value_numeric'] = inventory_by_category['total_value']
+    
+    # Format currency column for display
+    inventory_by_category['total_value'] = inventory_by_category['total_value'].apply(utils.format_currency)
+    
+    # Display as table and chart
+    st.dataframe(
+        inventory_by_category[['category', 'item_count', 'total_quantity', 'total_value']],
+        use_container_width=True
+    )
+    
+    fig = px.bar(
+        inventory_by_category,
+        x='category',
+        y='value_numeric',
+        title='Inventory Value by Category',
+        labels={'category': 'Category', 'value_numeric': 'Total Value (KSh)'},
+        color_discrete_sequence=['#f0e6d2']
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
+def _render_top_items(top_items):
+    """Table of the ten most valuable inventory items."""
+    if top_items.empty:
+        st.info("No inventory data available.")
+        return
+    
+    # Format currency columns
+    top_items['unit_price'] = top_items['unit_price'].apply(utils.format_currency)
+    top_items['total_value'] = top_items['total_value'].apply(utils.format_currency)
+    
+    # Display as table
+    st.dataframe(top_items, use_container_width=True)
+
+def _render_pharmacy_inventory(pharmacy_inventory):
+    """Pie chart of pharmacy stock value per category."""
+    if pharmacy_inventory.empty:
+        st.info("No pharmacy inventory data available.")
+        return
+    
+    # Store numeric values for chart before formatting
+    pharmacy_inventory['value_numeric'] = pharmacy_inventory['total_value']
+    
+    # Format currency column for display
+    pharmacy_inventory['total_value'] = pharmacy_inventory['total_value'].apply(utils.format_currency)
+    
+    # Display as chart
+    fig = px.pie(
+        pharmacy_inventory,
+        values='value_numeric',
+        names='category',
+        title='Pharmacy Inventory Value by Category',
+        color_discrete_sequence=px.colors.sequential.Teal
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
+def _render_custom_query(area, future, cancel, query_started):
+    """Poll a sandboxed custom query with a Cancel button, then show its results in the area kept for them."""
+    with area:
+        status = st.empty()
+        
+        try:
+            # Clicking Cancel (or any other widget) interrupts this loop at its next
+            # update; the finally clause then stops the query so it frees its worker
+            st.button("Cancel Query")
+            while not future.done():
+                status.caption(
+                    f"Running for {time.perf_counter() - query_started:.0f}s "
+                    f"(limit {database.SANDBOX_TIME_BUDGET:g}s)..."
+                )
+                wait([future], timeout=0.25)
+        finally:
+            if not future.done():
+                cancel.set()
+        
+        status.empty()
+        
+        try:
+            result = future.result()
+            result_df = result["preview"]
+            
+            st.caption(
+                f"{result['rows']:,} rows in {result['elapsed']:.2f}s "
+                f"(plan estimate: {result['cost']:,.0f} rows visited)"
+            )
+            
+            if result["truncated"] == "rows":
+                st.warning(f"Output stopped at the {database.SANDBOX_MAX_ROWS:,} row limit.")
+            elif result["truncated"] == "bytes":
+                st.warning(f"Output stopped at the {database.SANDBOX_MAX_BYTES // (1024 * 1024)} MB CSV size limit.")
+            elif result["truncated"] == "time":
+                st.warning(f"Query hit its {database.SANDBOX_TIME_BUDGET:g}s time budget; showing the rows produced so far.")
+            
+            if result_df.empty:
+                st.info("Query returned no results.")
+            else:
+                # Display results
+                st.write("#### Query Results")
+                
+                if result["rows"] > REPORT_PREVIEW_ROWS:
+                    st.info(f"Showing the first {REPORT_PREVIEW_ROWS} rows. Download the CSV for the full result.")
+                
+                st.dataframe(result_df, use_container_width=True)
+                
+                # The CSV was streamed by the same run, so the query is not executed twice
+                st.download_button(
+                    label="Download CSV",
+                    data=result["csv"],
+                    file_name=f"custom_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+                    mime="text/csv"
+                )
+                
+                # Attempt to create a basic visualization if there are 2-3 columns
+                if len(result_df.columns) == 2:
+                    numeric_cols = result_df.select_dtypes(include=['number']).columns
+                    if len(numeric_cols) == 1:
+                        category_col = [col for col in result_df.columns if col not in numeric_cols][0]
+                        value_col = numeric_cols[0]
+                        
+                        st.write("#### Visualization")
+                        
+                        # Limit to top 10 if there are many rows
+                        if len(result_df) > 10:
+                            chart_df = result_df.sort_values(value_col, ascending=False).head(10)
+                            st.info("Showing visualization for top 10 results only.")
+                        else:
+                            chart_df = result_df
+                        
+                        fig = px.bar(
+                            chart_df, 
+                            x=category_col, 
+                            y=value_col,
+                            title=f"{value_col} by {category_col}",
+                            color_discrete_sequence=['#f0e6d2']
+                        )
+                        st.plotly_chart(fig, use_container_width=True)
+        
+        except Exception as e:
+            st.error(f"Error executing query: {str(e)}")
 
 def reports_management():
     """Reports and analytics page."""
     st.header("Reports & Analytics")
     
+    # Reports can read the analytics mirror instead of the live file the clinics write to
+    source = st.radio("Data Source", ["Live database", "Analytics mirror"], horizontal=True, key="report_source")
+    source_path = None
+    
+    if source == "Analytics mirror":
+        col1, col2 = st.columns([4, 1])
+        
+        with col2:
+            if st.button("Sync Now"):
+                with st.spinner("Syncing analytics mirror..."):
+                    analytics.sync_mirror()
+        
+        status = analytics.get_mirror_status()
+        
+        with col1:
+            if status is None:
+                st.info("The analytics mirror has not been built yet; showing live data.")
+            else:
+                source_path = analytics.MIRROR_PATH
+                freshness = f"Mirror synced {utils.format_time_difference(status['synced_at'], datetime.now())} ago"
+                if status['pending_changes']:
+                    freshness += f"; {status['pending_changes']:,} newer changes not yet copied"
+                st.caption(freshness)
+    
     tab1, tab2, tab3, tab4 = st.tabs(["Patient Statistics", "Financial Reports", "Inventory Reports", "Custom Reports"])
     
+    # Every panel's query starts as soon as it is declared; the panels are
+    # drawn in place as their results arrive once the page is laid out
+    panels = {}
+    custom_run = None
+    started = time.perf_counter()
+    
     with tab1:
         st.subheader("Patient Statistics")
         
@@ -22,141 +534,75 @@ def reports_management():
             key="patient_time_period"
         )
         
+        # Calculate date range based on selection
+        end_date = datetime.now().date()
+        if time_period == "Last 30 Days":
+            start_date = end_date - timedelta(days=30)
+        elif time_period == "Last 3 Months":
+            start_date = end_date - timedelta(days=90)
+        elif time_period == "Last 6 Months":
+            start_date = end_date - timedelta(days=180)
+        elif time_period == "Last Year":
+            start_date = end_date - timedelta(days=365)
+        else:  # All Time
+            start_date = datetime(2000, 1, 1).date()
+        
+        date_params = (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+        
         col1, col2 = st.columns(2)
         
         with col1:
-            # Calculate date range based on selection
-            end_date = datetime.now().date()
-            if time_period == "Last 30 Days":
-                start_date = end_date - timedelta(days=30)
-            elif time_period == "Last 3 Months":
-                start_date = end_date - timedelta(days=90)
-            elif time_period == "Last 6 Months":
-                start_date = end_date - timedelta(days=180)
-            elif time_period == "Last Year":
-                start_date = end_date - timedelta(days=365)
-            else:  # All Time
-                start_date = datetime(2000, 1, 1).date()
-            
             # New patient registrations over time
             st.write("#### New Patient Registrations")
             
-            patients_over_time = database.query_to_dataframe(
+            panels["New Patient Registrations"] = submit_panel(
                 """
-                SELECT date(registration_date) as date, COUNT(*) as count
-                FROM Patients
-                WHERE registration_date BETWEEN ? AND ?
-                GROUP BY date(registration_date)
-                ORDER BY date
+                SELECT day as date, SUM(patients) as count
+                FROM DailyRegistrations
+                WHERE day BETWEEN ? AND ?
+                GROUP BY day
+                HAVING SUM(patients) > 0
+                ORDER BY day
                 """,
-                (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+                date_params,
+                _render_registrations, start_date, end_date,
+                path=source_path
             )
-            
-            if patients_over_time.empty:
-                st.info("No patient registrations in the selected time period.")
-            else:
-                # Fill in missing dates with zero counts
-                date_range = pd.date_range(start=start_date, end=end_date)
-                full_date_df = pd.DataFrame({'date': date_range})
-                full_date_df['date'] = full_date_df['date'].dt.strftime('%Y-%m-%d')
-                
-                patients_over_time['date'] = patients_over_time['date'].astype(str)
-                
-                merged_df = pd.merge(full_date_df, patients_over_time, on='date', how='left')
-                merged_df['count'] = merged_df['count'].fillna(0)
-                
-                # For longer time periods, resample to avoid overcrowded x-axis
-                if time_period in ["Last 6 Months", "Last Year", "All Time"]:
-                    merged_df['date'] = pd.to_datetime(merged_df['date'])
-                    if time_period == "Last 6 Months":
-                        resampled = merged_df.set_index('date').resample('W').sum().reset_index()
-                    else:  # Last Year or All Time
-                        resampled = merged_df.set_index('date').resample('M').sum().reset_index()
-                    
-                    fig = px.line(
-                        resampled, 
-                        x='date', 
-                        y='count',
-                        title='New Patient Registrations Over Time',
-                        labels={'date': 'Date', 'count': 'Number of Registrations'}
-                    )
-                else:
-                    fig = px.line(
-                        merged_df, 
-                        x='date', 
-                        y='count',
-                        title='New Patient Registrations Over Time',
-                        labels={'date': 'Date', 'count': 'Number of Registrations'}
-                    )
-                
-                st.plotly_chart(fig, use_container_width=True)
         
         with col2:
             # Patient demographics
             st.write("#### Patient Demographics")
             
-            patient_demographics = database.query_to_dataframe(
+            panels["Patient Demographics"] = submit_panel(
                 """
-                SELECT gender, COUNT(*) as count
-                FROM Patients
+                SELECT NULLIF(gender, '') as gender, SUM(patients) as count
+                FROM DailyRegistrations
                 GROUP BY gender
-                """
+                HAVING SUM(patients) > 0
+                """,
+                None,
+                _render_demographics,
+                path=source_path
             )
-            
-            if patient_demographics.empty:
-                st.info("No patient demographic data available.")
-            else:
-                fig = px.pie(
-                    patient_demographics, 
-                    values='count', 
-                    names='gender',
-                    title='Patients by Gender',
-                    color_discrete_sequence=px.colors.sequential.Teal
-                )
-                st.plotly_chart(fig, use_container_width=True)
         
         # Age distribution
         st.write("#### Patient Age Distribution")
         
-        age_distribution = database.query_to_dataframe(
+        # Bands are precomputed per patient and kept current by a daily rebalance,
+        # which writes and so runs here rather than on a read-only report worker
+        database.refresh_age_bands()
+        panels["Patient Age Distribution"] = submit_panel(
             """
-            SELECT 
-                CASE 
-                    WHEN (julianday('now') - julianday(date_of_birth)) / 365.25 < 18 THEN 'Under 18'
-                    WHEN (julianday('now') - julianday(date_of_birth)) / 365.25 BETWEEN 18 AND 30 THEN '18-30'
-                    WHEN (julianday('now') - julianday(date_of_birth)) / 365.25 BETWEEN 31 AND 45 THEN '31-45'
-                    WHEN (julianday('now') - julianday(date_of_birth)) / 365.25 BETWEEN 46 AND 60 THEN '46-60'
-                    WHEN (julianday('now') - julianday(date_of_birth)) / 365.25 BETWEEN 61 AND 75 THEN '61-75'
-                    ELSE 'Over 75'
-                END as age_group,
-                COUNT(*) as count
+            SELECT age_band as age_group, COUNT(*) as count
             FROM Patients
-            GROUP BY age_group
-            ORDER BY 
-                CASE age_group
-                    WHEN 'Under 18' THEN 1
-                    WHEN '18-30' THEN 2
-                    WHEN '31-45' THEN 3
-                    WHEN '46-60' THEN 4
-                    WHEN '61-75' THEN 5
-                    ELSE 6
-                END
-            """
+            WHERE age_band IS NOT NULL
+            GROUP BY age_band
+            """,
+            None,
+            _render_age_distribution,
+            path=source_path
         )
         
-        if age_distribution.empty:
-            st.info("No patient age data available.")
-        else:
-            fig = px.bar(
-                age_distribution, 
-                x='age_group', 
-                y='count',
-                title='Patient Age Distribution',
-                labels={'age_group': 'Age Group', 'count': 'Number of Patients'},
-                color_discrete_sequence=['#f0e6d2']
-            )
-            st.plotly_chart(fig, use_container_width=True)
-        
         # Appointment statistics
         st.write("#### Appointment Statistics")
         
@@ -164,34 +610,25 @@ def reports_management():
         
         with col1:
             # Appointments by status
-            appointment_status = database.query_to_dataframe(
+            panels["Appointments by Status"] = submit_panel(
                 """
-                SELECT status, COUNT(*) as count
-                FROM Appointments
-                WHERE appointment_date BETWEEN ? AND ?
+                SELECT NULLIF(status, '') as status, SUM(appointments) as count
+                FROM DailyAppointments
+                WHERE day BETWEEN ? AND ?
                 GROUP BY status
+                HAVING SUM(appointments) > 0
                 """,
-                (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+                date_params,
+                _render_appointment_status,
+                path=source_path
             )
-            
-            if appointment_status.empty:
-                st.info("No appointment data available for the selected period.")
-            else:
-                fig = px.pie(
-                    appointment_status, 
-                    values='count', 
-                    names='status',
-                    title='Appointments by Status',
-                    color_discrete_sequence=px.colors.qualitative.Pastel
-                )
-                st.plotly_chart(fig, use_container_width=True)
         
         with col2:
             # Appointments by day of week
-            appointments_by_day = database.query_to_dataframe(
+            panels["Appointments by Day of Week"] = submit_panel(
                 """
-                SELECT 
-                    CASE cast(strftime('%w', appointment_date) as integer)
+                SELECT
+                    CASE cast(strftime('%w', day) as integer)
                         WHEN 0 THEN 'Sunday'
                         WHEN 1 THEN 'Monday'
                         WHEN 2 THEN 'Tuesday'
@@ -200,42 +637,17 @@ def reports_management():
                         WHEN 5 THEN 'Friday'
                         WHEN 6 THEN 'Saturday'
                     END as day_of_week,
-                    COUNT(*) as count
-                FROM Appointments
-                WHERE appointment_date BETWEEN ? AND ?
+                    SUM(appointments) as count
+                FROM DailyAppointments
+                WHERE day BETWEEN ? AND ?
                 GROUP BY day_of_week
-                ORDER BY cast(strftime('%w', appointment_date) as integer)
+                HAVING SUM(appointments) > 0
+                ORDER BY cast(strftime('%w', day) as integer)
                 """,
-                (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+                date_params,
+                _render_appointments_by_day,
+                path=source_path
             )
-            
-            if appointments_by_day.empty:
-                st.info("No appointment data available for the selected period.")
-            else:
-                # Ensure all days of week are included
-                all_days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-                day_df = pd.DataFrame({'day_of_week': all_days})
-                
-                merged_days = pd.merge(day_df, appointments_by_day, on='day_of_week', how='left')
-                merged_days['count'] = merged_days['count'].fillna(0)
-                
-                # Create ordered categorical type for proper sorting
-                merged_days['day_of_week'] = pd.Categorical(
-                    merged_days['day_of_week'], 
-                    categories=all_days, 
-                    ordered=True
-                )
-                merged_days = merged_days.sort_values('day_of_week')
-                
-                fig = px.bar(
-                    merged_days, 
-                    x='day_of_week', 
-                    y='count',
-                    title='Appointments by Day of Week',
-                    labels={'day_of_week': 'Day', 'count': 'Number of Appointments'},
-                    color_discrete_sequence=['#f0e6d2']
-                )
-                st.plotly_chart(fig, use_container_width=True)
     
     with tab2:
         st.subheader("Financial Reports")
@@ -260,6 +672,8 @@ def reports_management():
         else:  # All Time
             start_date = datetime(2000, 1, 1).date()
         
+        date_params = (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+        
         # Revenue summary
         st.write("#### Revenue Summary")
         
@@ -267,152 +681,102 @@ def reports_management():
         
         with col1:
             # Total revenue
-            total_revenue = database.fetch_one(
+            panels["Total Revenue"] = submit_panel(
                 """
-                SELECT COALESCE(SUM(amount), 0) FROM Billing 
-                WHERE bill_date BETWEEN ? AND ? AND status = 'paid'
+                SELECT COALESCE(SUM(amount), 0) FROM DailyBilling
+                WHERE day BETWEEN ? AND ? AND status = 'paid'
                 """,
-                (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
-            )[0]
-            
-            st.metric("Total Revenue", utils.format_currency(total_revenue))
+                date_params,
+                _render_currency_metric, "Total Revenue",
+                kind="value",
+                path=source_path
+            )
         
         with col2:
             # Pending payments
-            pending_amount = database.fetch_one(
+            panels["Pending Payments"] = submit_panel(
                 """
-                SELECT COALESCE(SUM(amount), 0) FROM Billing 
-                WHERE bill_date BETWEEN ? AND ? AND status != 'paid'
+                SELECT COALESCE(SUM(amount), 0) FROM DailyBilling
+                WHERE day BETWEEN ? AND ? AND NULLIF(status, '') != 'paid'
                 """,
-                (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
-            )[0]
-            
-            st.metric("Pending Payments", utils.format_currency(pending_amount))
+                date_params,
+                _render_currency_metric, "Pending Payments",
+                kind="value",
+                path=source_path
+            )
         
         with col3:
             # Average bill amount
-            avg_bill = database.fetch_one(
+            panels["Average Bill"] = submit_panel(
                 """
-                SELECT COALESCE(AVG(amount), 0) FROM Billing 
-                WHERE bill_date BETWEEN ? AND ?
+                SELECT COALESCE(SUM(amount) / NULLIF(SUM(bills), 0), 0) FROM DailyBilling
+                WHERE day BETWEEN ? AND ?
                 """,
-                (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
-            )[0]
-            
-            st.metric("Average Bill", utils.format_currency(avg_bill))
+                date_params,
+                _render_currency_metric, "Average Bill",
+                kind="value",
+                path=source_path
+            )
         
         # Revenue over time
         st.write("#### Revenue Over Time")
         
-        revenue_over_time = database.query_to_dataframe(
+        panels["Revenue Over Time"] = submit_panel(
             """
-            SELECT 
-                date(bill_date) as date, 
+            SELECT
+                day as date,
                 SUM(amount) as revenue
-            FROM Billing
-            WHERE bill_date BETWEEN ? AND ? AND status = 'paid'
-            GROUP BY date(bill_date)
-            ORDER BY date
+            FROM DailyBilling
+            WHERE day BETWEEN ? AND ? AND status = 'paid'
+            GROUP BY day
+            HAVING SUM(bills) > 0
+            ORDER BY day
             """,
-            (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+            date_params,
+            _render_revenue, start_date, end_date,
+            path=source_path
         )
         
-        if revenue_over_time.empty:
-            st.info("No revenue data available for the selected period.")
-        else:
-            # Fill in missing dates with zero revenue
-            date_range = pd.date_range(start=start_date, end=end_date)
-            full_date_df = pd.DataFrame({'date': date_range})
-            full_date_df['date'] = full_date_df['date'].dt.strftime('%Y-%m-%d')
-            
-            revenue_over_time['date'] = revenue_over_time['date'].astype(str)
-            
-            merged_df = pd.merge(full_date_df, revenue_over_time, on='date', how='left')
-            merged_df['revenue'] = merged_df['revenue'].fillna(0)
-            
-            # For longer time periods, resample to avoid overcrowded x-axis
-            if financial_period in ["Last 6 Months", "Last Year", "All Time"]:
-                merged_df['date'] = pd.to_datetime(merged_df['date'])
-                if financial_period == "Last 6 Months":
-                    resampled = merged_df.set_index('date').resample('W').sum().reset_index()
-                else:  # Last Year or All Time
-                    resampled = merged_df.set_index('date').resample('M').sum().reset_index()
-                
-                fig = px.line(
-                    resampled, 
-                    x='date', 
-                    y='revenue',
-                    title='Revenue Over Time',
-                    labels={'date': 'Date', 'revenue': 'Revenue (KSh)'}
-                )
-            else:
-                fig = px.line(
-                    merged_df, 
-                    x='date', 
-                    y='revenue',
-                    title='Revenue Over Time',
-                    labels={'date': 'Date', 'revenue': 'Revenue (KSh)'}
-                )
-            
-            fig.update_traces(line_color='#4c9085')
-            st.plotly_chart(fig, use_container_width=True)
-        
         # Revenue by service
         st.write("#### Revenue by Service Type")
         
-        revenue_by_service = database.query_to_dataframe(
+        panels["Revenue by Service Type"] = submit_panel(
             """
-            SELECT 
+            SELECT
                 service_description,
-                COUNT(*) as count,
+                SUM(bills) as count,
                 SUM(amount) as total_amount,
-                AVG(amount) as avg_amount
-            FROM Billing
-            WHERE bill_date BETWEEN ? AND ?
+                SUM(amount) / SUM(bills) as avg_amount
+            FROM DailyBilling
+            WHERE day BETWEEN ? AND ?
             GROUP BY service_description
+            HAVING SUM(bills) > 0
             ORDER BY total_amount DESC
             LIMIT 10
             """,
-            (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+            date_params,
+            _render_revenue_by_service,
+            path=source_path
         )
         
-        if revenue_by_service.empty:
-            st.info("No revenue by service data available for the selected period.")
-        else:
-            # Format currency columns
-            revenue_by_service['total_amount'] = revenue_by_service['total_amount'].apply(utils.format_currency)
-            revenue_by_service['avg_amount'] = revenue_by_service['avg_amount'].apply(utils.format_currency)
-            
-            # Display as table
-            st.dataframe(revenue_by_service, use_container_width=True)
-        
         # Payment status distribution
         st.write("#### Payment Status Distribution")
         
-        payment_status = database.query_to_dataframe(
+        panels["Payment Status Distribution"] = submit_panel(
             """
-            SELECT 
-                status,
-                COUNT(*) as count,
+            SELECT
+                NULLIF(status, '') as status,
+                SUM(bills) as count,
                 SUM(amount) as total_amount
-            FROM Billing
-            WHERE bill_date BETWEEN ? AND ?
+            FROM DailyBilling
+            WHERE day BETWEEN ? AND ?
             GROUP BY status
+            HAVING SUM(bills) > 0
             """,
-            (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+            date_params,
+            _render_payment_status,
+            path=source_path
         )
-        
-        if payment_status.empty:
-            st.info("No payment status data available for the selected period.")
-        else:
-            fig = px.pie(
-                payment_status, 
-                values='total_amount', 
-                names='status',
-                title='Total Amount by Payment Status',
-                color_discrete_sequence=px.colors.sequential.Viridis
-            )
-            st.plotly_chart(fig, use_container_width=True)
     
     with tab3:
         st.subheader("Inventory Reports")
@@ -424,83 +788,66 @@ def reports_management():
         
         with col1:
             # Total inventory value
-            total_inventory_value = database.fetch_one(
+            panels["Total Inventory Value"] = submit_panel(
                 """
-                SELECT COALESCE(SUM(quantity * unit_price), 0) FROM Inventory
-                """
-            )[0]
-            
-            st.metric("Total Inventory Value", utils.format_currency(total_inventory_value))
+                SELECT COALESCE(SUM(value), 0) FROM InventoryByCategory
+                """,
+                None,
+                _render_currency_metric, "Total Inventory Value",
+                kind="value",
+                path=source_path
+            )
         
         with col2:
             # Low stock items
-            low_stock_count = database.fetch_one(
-                """
-                SELECT COUNT(*) FROM Inventory 
-                WHERE quantity <= reorder_level AND status = 'available'
+            panels["Low Stock Items"] = submit_panel(
                 """
-            )[0]
-            
-            st.metric("Low Stock Items", low_stock_count)
+                SELECT COALESCE(SUM(value), 0) FROM Counters
+                WHERE name = 'low_stock_items' AND bucket = ''
+                """,
+                None,
+                _render_count_metric, "Low Stock Items",
+                kind="value",
+                path=source_path
+            )
         
         with col3:
             # Out of stock items
-            out_of_stock_count = database.fetch_one(
-                """
-                SELECT COUNT(*) FROM Inventory 
-                WHERE quantity = 0 OR status = 'out of stock'
+            panels["Out of Stock Items"] = submit_panel(
                 """
-            )[0]
-            
-            st.metric("Out of Stock Items", out_of_stock_count)
+                SELECT COALESCE(SUM(out_of_stock), 0) FROM InventoryByCategory
+                """,
+                None,
+                _render_count_metric, "Out of Stock Items",
+                kind="value",
+                path=source_path
+            )
         
         # Inventory by category
         st.write("#### Inventory by Category")
         
-        inventory_by_category = database.query_to_dataframe(
+        panels["Inventory by Category"] = submit_panel(
             """
-            SELECT 
+            SELECT
                 category,
-                COUNT(*) as item_count,
-                SUM(quantity) as total_quantity,
-                SUM(quantity * unit_price) as total_value
-            FROM Inventory
-            GROUP BY category
+                items as item_count,
+                quantity as total_quantity,
+                value as total_value
+            FROM InventoryByCategory
+            WHERE items > 0
             ORDER BY total_value DESC
-            """
+            """,
+            None,
+            _render_inventory_by_category,
+            path=source_path
         )
         
-        if inventory_by_category.empty:
-            st.info("No inventory data available.")
-        else:
-            # Store numeric values for chart before formatting
-            inventory_by_category['value_numeric'] = inventory_by_category['total_value']
-            
-            # Format currency column for display
-            inventory_by_category['total_value'] = inventory_by_category['total_value'].apply(utils.format_currency)
-            
-            # Display as table and chart
-            st.dataframe(
-                inventory_by_category[['category', 'item_count', 'total_quantity', 'total_value']], 
-                use_container_width=True
-            )
-            
-            fig = px.bar(
-                inventory_by_category, 
-                x='category', 
-                y='value_numeric',
-                title='Inventory Value by Category',
-                labels={'category': 'Category', 'value_numeric': 'Total Value (KSh)'},
-                color_discrete_sequence=['#f0e6d2']
-            )
-            st.plotly_chart(fig, use_container_width=True)
-        
         # Top items by value
         st.write("#### Top Items by Value")
         
-        top_items = database.query_to_dataframe(
+        panels["Top Items by Value"] = submit_panel(
             """
-            SELECT 
+            SELECT
                 item_name,
                 category,
                 quantity,
@@ -509,25 +856,18 @@ def reports_management():
             FROM Inventory
             ORDER BY total_value DESC
             LIMIT 10
-            """
+            """,
+            None,
+            _render_top_items,
+            path=source_path
         )
         
-        if top_items.empty:
-            st.info("No inventory data available.")
-        else:
-            # Format currency columns
-            top_items['unit_price'] = top_items['unit_price'].apply(utils.format_currency)
-            top_items['total_value'] = top_items['total_value'].apply(utils.format_currency)
-            
-            # Display as table
-            st.dataframe(top_items, use_container_width=True)
-        
         # Pharmacy inventory
         st.write("#### Pharmacy Inventory")
         
-        pharmacy_inventory = database.query_to_dataframe(
+        panels["Pharmacy Inventory"] = submit_panel(
             """
-            SELECT 
+            SELECT
                 category,
                 COUNT(*) as med_count,
                 SUM(stock_quantity) as total_quantity,
@@ -535,36 +875,18 @@ def reports_management():
             FROM Pharmacy
             GROUP BY category
             ORDER BY total_value DESC
-            """
+            """,
+            None,
+            _render_pharmacy_inventory,
+            path=source_path
         )
-        
-        if pharmacy_inventory.empty:
-            st.info("No pharmacy inventory data available.")
-        else:
-            # Store numeric values for chart before formatting
-            pharmacy_inventory['value_numeric'] = pharmacy_inventory['total_value']
-            
-            # Format currency column for display
-            pharmacy_inventory['total_value'] = pharmacy_inventory['total_value'].apply(utils.format_currency)
-            
-            # Display as chart
-            fig = px.pie(
-                pharmacy_inventory, 
-                values='value_numeric', 
-                names='category',
-                title='Pharmacy Inventory Value by Category',
-                color_discrete_sequence=px.colors.sequential.Teal
-            )
-            st.plotly_chart(fig, use_container_width=True)
-    
     with tab4:
         st.subheader("Custom Reports")
         
         st.write("Create custom reports by specifying your own SQL query.")
         
-        custom_query = st.text_area(
-            "Enter SQL Query",
-            """
+        if "custom_query" not in st.session_state:
+            st.session_state.custom_query = """
             -- Example: Get count of appointments by doctor
             SELECT 
                 u.full_name as doctor_name,
@@ -573,90 +895,96 @@ def reports_management():
             JOIN Users u ON a.doctor_id = u.user_id
             GROUP BY doctor_name
             ORDER BY appointment_count DESC
-            """,
-            height=200
-        )
+            """
+        
+        custom_query = st.text_area("Enter SQL Query", height=200, key="custom_query")
         
         if st.button("Run Query"):
-            try:
-                # Execute the custom query
-                result_df = database.query_to_dataframe(custom_query)
-                
-                if result_df.empty:
-                    st.info("Query returned no results.")
-                else:
-                    # Display results
-                    st.write("#### Query Results")
-                    st.dataframe(result_df, use_container_width=True)
-                    
-                    # Attempt to create a basic visualization if there are 2-3 columns
-                    if len(result_df.columns) == 2:
-                        numeric_cols = result_df.select_dtypes(include=['number']).columns
-                        if len(numeric_cols) == 1:
-                            category_col = [col for col in result_df.columns if col not in numeric_cols][0]
-                            value_col = numeric_cols[0]
-                            
-                            st.write("#### Visualization")
-                            
-                            # Limit to top 10 if there are many rows
-                            if len(result_df) > 10:
-                                chart_df = result_df.sort_values(value_col, ascending=False).head(10)
-                                st.info("Showing visualization for top 10 results only.")
-                            else:
-                                chart_df = result_df
-                            
-                            fig = px.bar(
-                                chart_df, 
-                                x=category_col, 
-                                y=value_col,
-                                title=f"{value_col} by {category_col}",
-                                color_discrete_sequence=['#f0e6d2']
-                            )
-                            st.plotly_chart(fig, use_container_width=True)
-            
-            except Exception as e:
-                st.error(f"Error executing query: {str(e)}")
+            # The query runs in the sandbox on a report worker and is polled once the
+            # panels are drawn, so they never wait behind it
+            cancel = threading.Event()
+            future = _report_executor.submit(
+                database.run_sandboxed_query, custom_query, preview_rows=REPORT_PREVIEW_ROWS, cancel=cancel,
+                path=source_path
+            )
+            custom_run = (st.container(), future, cancel, time.perf_counter())
         
         # Saved report templates
         st.write("#### Saved Report Templates")
         
-        report_templates = {
-            "Patient Visits by Month": """
-                SELECT 
-                    strftime('%Y-%m', appointment_date) as month,
-                    COUNT(*) as visit_count
-                FROM Appointments
-                WHERE status != 'cancelled'
-                GROUP BY month
-                ORDER BY month
-            """,
-            "Top Doctors by Appointments": """
-                SELECT 
-                    u.full_name as doctor_name,
-                    COUNT(*) as appointment_count
-                FROM Appointments a
-                JOIN Users u ON a.doctor_id = u.user_id
-                WHERE a.status = 'completed'
-                GROUP BY doctor_name
-                ORDER BY appointment_count DESC
-            """,
-            "Revenue by Insurance Provider": """
-                SELECT 
-                    COALESCE(insurance_provider, 'Self-Pay') as provider,
-                    COUNT(*) as bill_count,
-                    SUM(amount) as total_amount
-                FROM Billing
-                GROUP BY provider
-                ORDER BY total_amount DESC
-            """
-        }
         
         selected_template = st.selectbox(
             "Load Template", 
-            ["Select a template..."] + list(report_templates.keys())
+            ["Select a template..."] + list(REPORT_TEMPLATES.keys())
         )
         
         if selected_template != "Select a template...":
-            if st.button("Load Template"):
-                st.session_state.custom_query = report_templates[selected_template]
-                st.rerun()
+            snapshots = report_store.list_snapshots(selected_template)
+            
+            if not snapshots:
+                with st.spinner("Running this report for the first time..."):
+                    finished = report_store.request_refresh(selected_template).wait(report_store.REFRESH_WAIT)
+                snapshots = report_store.list_snapshots(selected_template)
+            
+            if not snapshots:
+                if finished:
+                    st.info("This report has no stored results yet. Try refreshing it.")
+                else:
+                    st.info(f"This report is still running after {report_store.REFRESH_WAIT:g}s; its results will appear once it finishes.")
+            else:
+                # Served straight from the stored snapshot, without querying the database
+                version = st.selectbox(
+                    "Snapshot",
+                    range(len(snapshots)),
+                    format_func=lambda i: snapshots[i][0].strftime('%Y-%m-%d %H:%M:%S') + (" (latest)" if i == 0 else ""),
+                    key=f"template_snapshot_{selected_template}"
+                )
+                taken_at, path = snapshots[version]
+                
+                st.caption(
+                    f"Taken {utils.format_time_difference(taken_at, datetime.now())} ago; "
+                    f"next scheduled refresh at {report_store.next_refresh(selected_template).strftime('%H:%M')}"
+                )
+                st.dataframe(report_store.load_snapshot(path), use_container_width=True)
+            
+            col1, col2 = st.columns(2)
+            
+            with col1:
+                if st.button("Refresh Now"):
+                    with st.spinner("Refreshing report..."):
+                        finished = report_store.request_refresh(selected_template).wait(report_store.REFRESH_WAIT)
+                    if finished:
+                        st.rerun()
+                    # The refresh carries on in the background; the snapshot shown above is the previous one
+                    st.warning(
+                        f"The refresh is still running after {report_store.REFRESH_WAIT:g}s; "
+                        "the results above are from the previous snapshot until it finishes."
+                    )
+            
+            with col2:
+                st.button("Load Template", on_click=_load_template, args=(selected_template,))
+    
+    # Draw each panel as its query finishes, so the page waits on the slowest query rather than the sum
+    timings = render_panels(panels)
+    
+    if timings:
+        elapsed = time.perf_counter() - started
+        slowest = max(timings, key=timings.get)
+        
+        with st.expander("Report Timings"):
+            st.caption(
+                f"{len(timings)} panels loaded in {elapsed:.2f}s; "
+                f"slowest was {slowest} at {timings[slowest]:.2f}s, "
+                f"{sum(timings.values()):.2f}s if run one after another"
+            )
+            st.dataframe(
+                pd.DataFrame(
+                    sorted(timings.items(), key=lambda item: item[1], reverse=True),
+                    columns=["Panel", "Seconds"]
+                ),
+                use_container_width=True,
+                hide_index=True
+            )
+    
+    if custom_run is not None:
+        _render_custom_query(*custom_run)
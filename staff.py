@@ -40,7 +40,8 @@ def staff_management():
             department_filter = st.selectbox(
                 "Department", 
                 ["All"] + sorted(set([row[0] for row in database.fetch_all(
-                    "SELECT DISTINCT department FROM Staff ORDER BY department"
+                    "SELECT DISTINCT department FROM Staff ORDER BY department",
+                    cache=True
                 ) or []])),
             )
         
@@ -91,8 +92,8 @@ def staff_management():
             st.info("No staff members found matching your criteria.")
         else:
             # Format dates and currency
-            staff_df['hire_date'] = pd.to_datetime(staff_df['hire_date']).dt.strftime('%Y-%m-%d')
-            staff_df['last_login'] = pd.to_datetime(staff_df['last_login']).dt.strftime('%Y-%m-%d %H:%M')
+            staff_df['hire_date'] = staff_df['hire_date'].dt.strftime('%Y-%m-%d')
+            staff_df['last_login'] = staff_df['last_login'].dt.strftime('%Y-%m-%d %H:%M')
             staff_df['salary'] = staff_df['salary'].apply(lambda x: f"${x:,.2f}" if x else "Not specified")
             
             # Reorder and rename columns for display
@@ -322,7 +323,7 @@ def staff_management():
                             st.info("No activity recorded for this staff member.")
                         else:
                             # Format dates
-                            activity_df['timestamp'] = pd.to_datetime(activity_df['timestamp']).dt.strftime('%Y-%m-%d %H:%M:%S')
+                            activity_df['timestamp'] = activity_df['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S')
                             
                             # Rename columns for display
                             activity_df.columns = ['Activity', 'Details', 'Timestamp']
@@ -0,0 +1,29 @@
+import pytest
+import database
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Point the database module at a freshly initialized file for one test."""
+    monkeypatch.setattr(database, 'DB_PATH', str(tmp_path / 'hospital_management.db'))
+    monkeypatch.setattr(database, 'SLOW_QUERY_LOG', str(tmp_path / 'slow_queries.log'))
+    database.invalidate_cache('*')
+    database.init_db()
+    
+    yield database.DB_PATH
+    
+    # Pooled, writer and read-only connections all point at the old file
+    database.shutdown_writer()
+    database.close_pool()
+    database.close_read_only_connections()
+    database.invalidate_cache('*')
+
+@pytest.fixture
+def patient(db):
+    """Insert one patient and return its ID."""
+    return database.insert_record("Patients", {
+        "first_name": "John",
+        "last_name": "Smith",
+        "date_of_birth": "1980-05-17",
+        "gender": "Male",
+        "contact_number": "0700000000",
+    })
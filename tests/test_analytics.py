@@ -0,0 +1,71 @@
+import sqlite3
+import pytest
+import analytics
+import database
+
+@pytest.fixture
+def mirror(db, tmp_path, monkeypatch):
+    """Build an analytics mirror of the test database and return its path."""
+    monkeypatch.setattr(analytics, 'MIRROR_PATH', str(tmp_path / 'hospital_management_analytics.db'))
+    analytics.sync_mirror()
+    return analytics.MIRROR_PATH
+
+def _differences(mirror):
+    """Return the mirrored tables whose rows differ from the live ones."""
+    conn = analytics._open_mirror()
+    try:
+        return [
+            name for name, _ in analytics._mirrored_tables(conn)
+            if sorted(conn.execute(f'SELECT * FROM main."{name}"').fetchall(), key=repr)
+            != sorted(conn.execute(f'SELECT * FROM live."{name}"').fetchall(), key=repr)
+        ]
+    finally:
+        conn.close()
+
+def _add_bill(patient, amount, status='paid'):
+    return database.insert_record("Billing", {
+        "patient_id": patient, "service_description": "Consultation", "amount": amount,
+        "bill_date": "2025-01-01 10:00:00", "status": status,
+    })
+
+def test_idle_sync_writes_nothing(mirror, patient):
+    _add_bill(patient, 100.0)
+    analytics.sync_mirror()
+    
+    assert analytics.sync_mirror() == 0
+
+def test_sync_copies_changes_and_rollups(mirror, patient):
+    first = _add_bill(patient, 100.0)
+    second = _add_bill(patient, 250.0, status='unpaid')
+    analytics.sync_mirror()
+    
+    database.update_record("Billing", {"status": "paid"}, {"bill_id": second})
+    database.delete_record("Billing", {"bill_id": first})
+    database.update_record("Patients", {"status": "inactive"}, {"patient_id": patient})
+    
+    # Two bills changed, one patient changed, and the rollup and counter rows they feed
+    assert 0 < analytics.sync_mirror() < 20
+    assert _differences(mirror) == []
+
+def test_change_log_is_capped_and_overflow_rebuilds_the_mirror(mirror, patient):
+    rebuilds = analytics.get_mirror_stats()["rebuilds"]
+    
+    # More changes than the log keeps, as if the mirror had not synced for a long time
+    database.execute_query(
+        """
+        WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < ?)
+        INSERT INTO MirrorChanges (table_name, row_id) SELECT 'Patients', ? FROM n
+        """,
+        (database.MIRROR_LOG_LIMIT + 5000, patient)
+    )
+    database.update_record("Patients", {"notes": "changed after the overflow"}, {"patient_id": patient})
+    
+    logged, first_seq = database.fetch_one("SELECT COUNT(*), MIN(seq) FROM MirrorChanges")
+    assert logged <= database.MIRROR_LOG_LIMIT + 1000
+    assert first_seq > 1
+    
+    analytics.sync_mirror()
+    
+    assert analytics.get_mirror_stats()["rebuilds"] == rebuilds + 1
+    assert _differences(mirror) == []
+    assert database.fetch_one("SELECT COUNT(*) FROM MirrorChanges")[0] == 0
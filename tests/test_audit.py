@@ -0,0 +1,35 @@
+import threading
+import audit
+import database
+
+def test_no_audit_records_lost_under_concurrent_writes(db, patient):
+    users, events_per_user = 8, 250
+    
+    def log_activity(user_id):
+        for i in range(events_per_user):
+            audit.record_activity(user_id, "View Patient", f"event {i}")
+    
+    def write_patients():
+        for i in range(100):
+            database.update_record("Patients", {"notes": f"note {i}"}, {"patient_id": patient})
+    
+    def hold_write_lock():
+        for _ in range(20):
+            with database.transaction() as conn:
+                conn.execute("UPDATE Patients SET address = 'Ward 3' WHERE patient_id = ?", (patient,))
+    
+    threads = [threading.Thread(target=log_activity, args=(user_id,)) for user_id in range(1, users + 1)]
+    threads += [threading.Thread(target=write_patients), threading.Thread(target=hold_write_lock)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    try:
+        audit.flush_audit_log()
+        
+        counts = dict(database.fetch_all("SELECT user_id, COUNT(*) FROM AuditLogs GROUP BY user_id"))
+        assert counts == {user_id: events_per_user for user_id in range(1, users + 1)}
+        assert audit.get_audit_writer_stats()["dropped"] == 0
+    finally:
+        audit.shutdown_audit_writer()
@@ -0,0 +1,23 @@
+import billing
+import database
+
+def test_unpaid_bills_page_through_bills_without_a_due_date(db, patient):
+    due_dates = ['2025-03-01', None, '2025-01-15', None, '2025-01-15', '2025-02-01', None]
+    ids = database.insert_records("Billing", [
+        {"patient_id": patient, "service_description": f"Service {i}", "amount": 100.0 + i,
+         "due_date": due_date, "status": 'unpaid' if i != 5 else 'paid'}
+        for i, due_date in enumerate(due_dates)
+    ])
+    
+    seen = []
+    after = None
+    while True:
+        df, after, has_more = database.fetch_page(
+            billing.UNPAID_BILLS_QUERY, sort_keys=billing.UNPAID_BILLS_SORT, after=after, page_size=2
+        )
+        seen.extend(df['bill_id'].tolist())
+        if not has_more:
+            break
+    
+    # Dated bills by due date, then undated bills, each in ID order; the paid bill is left out
+    assert seen == [ids[2], ids[4], ids[0], ids[1], ids[3], ids[6]]
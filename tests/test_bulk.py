@@ -0,0 +1,84 @@
+import os
+import time
+import pandas as pd
+import pytest
+import database
+
+# Rows loaded by the opt-in throughput benchmark
+BENCHMARK_ROWS = int(os.environ.get('HOSPITAL_BENCHMARK_ROWS', '100000'))
+
+def _inventory_rows(count, start=0):
+    return [
+        {"item_name": f"Item {i}", "category": "Consumables", "quantity": i % 500,
+         "unit_price": 1.5, "reorder_level": 10}
+        for i in range(start, start + count)
+    ]
+
+def test_insert_records_returns_ids_across_chunks(db):
+    database.insert_record("Inventory", _inventory_rows(1)[0])
+    database.delete_record("Inventory", {"item_name": "Item 0"})
+    
+    ids = database.insert_records("Inventory", _inventory_rows(25, start=1), chunk_size=10)
+    
+    # AUTOINCREMENT skips the deleted row's ID, so generated IDs start at 2
+    assert ids == list(range(2, 27))
+    stored = dict(database.fetch_all("SELECT item_id, item_name FROM Inventory"))
+    assert stored == {item_id: f"Item {item_id - 1}" for item_id in ids}
+
+def test_insert_records_returns_explicit_ids_and_skips_nulls_from_dataframes(db):
+    rows = pd.DataFrame(_inventory_rows(5))
+    rows.insert(0, "item_id", [100, 50, 75, 10, 20])
+    rows.loc[2, "reorder_level"] = None
+    
+    assert database.insert_records("Inventory", rows, chunk_size=2) == [100, 50, 75, 10, 20]
+    assert database.fetch_one("SELECT reorder_level FROM Inventory WHERE item_id = 75")[0] is None
+
+def test_update_and_upsert_records_count_changed_rows(db):
+    ids = database.insert_records("Inventory", _inventory_rows(30), chunk_size=7)
+    
+    updated = database.update_records(
+        "Inventory", [{"item_id": item_id, "quantity": 0} for item_id in ids[:12]], "item_id", chunk_size=5
+    )
+    upserted = database.upsert_records(
+        "Inventory",
+        [{"item_id": item_id, **row} for item_id, row in zip([ids[0], 1000], _inventory_rows(2, start=501))],
+        "item_id"
+    )
+    
+    assert updated == 12
+    assert upserted == 2
+    # The upsert replaced the first updated row and added item 1000
+    assert database.fetch_one("SELECT COUNT(*) FROM Inventory WHERE quantity = 0")[0] == 11
+    assert database.fetch_all("SELECT item_id, item_name FROM Inventory WHERE item_id IN (?, 1000)", (ids[0],)) == [
+        (ids[0], "Item 501"), (1000, "Item 502")
+    ]
+
+@pytest.mark.benchmark
+def test_bulk_load_throughput(db):
+    """Load BENCHMARK_ROWS Inventory rows one at a time and in bulk, and report rows/s for each."""
+    rows = _inventory_rows(BENCHMARK_ROWS)
+    rates = {}
+    
+    started = time.perf_counter()
+    for row in rows:
+        database.insert_record("Inventory", row)
+    rates["insert_record loop"] = BENCHMARK_ROWS / (time.perf_counter() - started)
+    
+    database.execute_query("DELETE FROM Inventory")
+    
+    started = time.perf_counter()
+    ids = database.insert_records("Inventory", rows)
+    rates["insert_records"] = BENCHMARK_ROWS / (time.perf_counter() - started)
+    
+    started = time.perf_counter()
+    updated = database.update_records(
+        "Inventory", [{"item_id": item_id, "quantity": 1} for item_id in ids], "item_id"
+    )
+    rates["update_records"] = BENCHMARK_ROWS / (time.perf_counter() - started)
+    
+    print()
+    for name, rate in rates.items():
+        print(f"{name:>20}: {rate:>10,.0f} rows/s ({BENCHMARK_ROWS:,} rows)")
+    
+    assert len(ids) == updated == BENCHMARK_ROWS
+    assert rates["insert_records"] > rates["insert_record loop"]
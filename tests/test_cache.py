@@ -0,0 +1,45 @@
+import pytest
+import database
+
+COUNT_QUERY = "SELECT COUNT(*) FROM Patients"
+FRAME_QUERY = "SELECT COUNT(*) AS n FROM Patients"
+
+def test_cached_reads_inside_a_rolled_back_transaction_are_not_kept(db, patient):
+    assert database.fetch_all(COUNT_QUERY, cache=True) == [(1,)]
+    assert database.query_to_dataframe(FRAME_QUERY, cache=True)['n'].tolist() == [1]
+    
+    with pytest.raises(RuntimeError):
+        with database.transaction():
+            database.insert_record("Patients", {
+                "first_name": "Jane", "last_name": "Doe", "date_of_birth": "1990-01-01",
+                "gender": "Female", "contact_number": "0711111111",
+            })
+            # The transaction sees its own uncommitted row
+            assert database.fetch_all(COUNT_QUERY, cache=True) == [(2,)]
+            assert database.query_to_dataframe(FRAME_QUERY, cache=True)['n'].tolist() == [2]
+            raise RuntimeError("roll back")
+    
+    assert database.fetch_all(COUNT_QUERY, cache=True) == [(1,)]
+    assert database.query_to_dataframe(FRAME_QUERY, cache=True)['n'].tolist() == [1]
+
+def test_committed_writes_invalidate_cached_reads(db, patient):
+    assert database.fetch_all(COUNT_QUERY, cache=True) == [(1,)]
+    assert database.fetch_all(COUNT_QUERY, cache=True) == [(1,)]
+    
+    database.delete_record("Patients", {"patient_id": patient})
+    
+    assert database.fetch_all(COUNT_QUERY, cache=True) == [(0,)]
+
+def test_comma_joined_tables_invalidate_cached_reads(db, patient):
+    query = """
+        SELECT p.patient_id, COUNT(b.bill_id)
+        FROM Patients p, (SELECT 1) one, Billing b
+        WHERE b.patient_id = p.patient_id
+        GROUP BY p.patient_id
+    """
+    assert database._read_tables(query) == {'Patients', 'Billing'}
+    assert database.fetch_all(query, cache=True) == []
+    
+    database.insert_record("Billing", {"patient_id": patient, "service_description": "X-ray", "amount": 800.0})
+    
+    assert database.fetch_all(query, cache=True) == [(patient, 1)]
@@ -0,0 +1,59 @@
+from datetime import datetime
+import appointment
+import billing
+import dashboard
+import database
+import inventory
+import patient as patient_module
+import pharmacy
+import staff
+
+def test_snapshot_matches_the_per_metric_queries(db, patient, monkeypatch):
+    # The snapshot is shared by the whole process; keep this one to the test
+    monkeypatch.setattr(dashboard, '_snapshot', None)
+    today = datetime.now().strftime('%Y-%m-%d')
+    database.insert_records("Inventory", [
+        {"item_name": "Gloves", "category": "Supplies", "quantity": 5, "unit_price": 1.0, "reorder_level": 10},
+        {"item_name": "Masks", "category": "Supplies", "quantity": 50, "unit_price": 0.5, "reorder_level": 10},
+    ])
+    medications = database.insert_records("Pharmacy", [
+        {"name": "Amoxicillin", "stock_quantity": 100, "unit_price": 12.5, "reorder_level": 50},
+        {"name": "Ibuprofen", "stock_quantity": 100, "unit_price": 3.0, "reorder_level": 50},
+        {"name": "Insulin", "stock_quantity": 100, "unit_price": 40.0, "reorder_level": 50},
+    ])
+    database.insert_records("Prescriptions", [
+        {"patient_id": patient, "doctor_id": 1, "medication_id": medications[0],
+         "dosage": "500mg", "frequency": "3 times daily", "duration": "5 days"}
+        for _ in range(3)
+    ])
+    database.insert_records("Billing", [
+        {"patient_id": patient, "service_description": "Consultation", "amount": 80.0,
+         "bill_date": f"{today} 09:30:00", "status": 'paid'},
+        {"patient_id": patient, "service_description": "X-ray", "amount": 120.0,
+         "bill_date": f"{today} 10:00:00", "status": 'unpaid'},
+    ])
+
+    # One medication runs low and another runs out through the normal stock path
+    pharmacy.adjust_medication_stock(medications[1], "Set Stock Level", 10)
+    pharmacy.adjust_medication_stock(medications[2], "Set Stock Level", 0)
+
+    snapshot = dashboard._refresh_snapshot()
+
+    assert snapshot['patient_count'] == patient_module.get_patient_count() == 1
+    assert snapshot['today_appointments'] == appointment.get_appointments_count_for_today()
+    assert snapshot['low_stock_count'] == inventory.get_low_stock_count() == 1
+    assert snapshot['today_revenue'] == billing.get_revenue_for_today() == 80.0
+    assert snapshot['active_staff'] == staff.get_active_staff_count()
+    assert snapshot['total_staff'] == staff.get_total_staff_count()
+    assert snapshot['pending_prescriptions'] == pharmacy.get_pending_prescriptions_count() == 3
+
+    # The eighth metric has no per-metric helper; count its rows directly
+    low_stock_medications = database.fetch_one(
+        "SELECT COUNT(*) FROM Pharmacy WHERE status IN ('low stock', 'out of stock')"
+    )[0]
+    assert snapshot['low_stock_medications'] == low_stock_medications == 2
+
+    pharmacy.adjust_medication_stock(medications[2], "Add Stock", 200)
+
+    assert dashboard._refresh_snapshot()['low_stock_medications'] == 1
+    assert database.verify_counters() == []
@@ -0,0 +1,27 @@
+import database
+
+def test_page_queries_use_their_indexes(db):
+    assert database.check_query_plans() == []
+
+def test_counters_match_their_tables(db, patient):
+    database.insert_records("Billing", [
+        {"patient_id": patient, "service_description": "Consultation", "amount": 1500.0,
+         "bill_date": "2025-01-0%d 10:00:00" % day, "status": status}
+        for day, status in ((1, 'paid'), (1, 'unpaid'), (2, 'paid'), (3, 'paid'))
+    ])
+    database.update_record("Billing", {"status": "paid"}, {"status": "unpaid"})
+    database.delete_record("Billing", {"bill_date": "2025-01-03 10:00:00"})
+    database.insert_record("Prescriptions", {
+        "patient_id": patient, "doctor_id": 1, "medication_id": 1, "dosage": "10mg",
+        "frequency": "daily", "duration": "7 days", "status": "pending",
+    })
+    
+    assert database.verify_counters() == []
+    assert database.fetch_one(
+        "SELECT value FROM Counters WHERE name = 'paid_revenue' AND bucket = '2025-01-01'"
+    )[0] == 3000.0
+
+def test_verify_counters_reports_drift(db, patient):
+    database.execute_query("UPDATE Counters SET value = value + 1 WHERE name = 'active_patients'")
+    
+    assert database.verify_counters() == [('active_patients', '', 2, 1)]
@@ -0,0 +1,20 @@
+import database
+import patient
+
+def _name_matches(term):
+    condition, params = patient.name_match_condition(term)
+    return [row[0] for row in database.fetch_all(
+        f"SELECT p.patient_id FROM Patients p WHERE {condition} ORDER BY p.patient_id", params
+    )]
+
+def test_multi_word_terms_match_first_and_last_names(db, patient):
+    other = database.insert_record("Patients", {
+        "first_name": "Johnny", "last_name": "Walker", "date_of_birth": "1975-02-01",
+        "gender": "Male", "contact_number": "0722222222",
+    })
+    
+    assert _name_matches("John Smith") == [patient]
+    assert _name_matches("smith jo") == [patient]
+    assert _name_matches("John") == [patient, other]
+    assert _name_matches("John Walker") == [other]
+    assert _name_matches("ohn Smith") == []
@@ -0,0 +1,43 @@
+import threading
+import database
+import pharmacy
+
+def test_parallel_dispensing_loses_no_stock_updates(db, patient):
+    start_stock = 1000
+    medication = database.insert_record("Pharmacy", {
+        "name": "Amoxicillin", "dosage": "500mg", "stock_quantity": start_stock,
+        "unit_price": 12.5, "reorder_level": 50,
+    })
+    prescriptions = database.insert_records("Prescriptions", [
+        {"patient_id": patient, "doctor_id": 1, "medication_id": medication,
+         "dosage": "500mg", "frequency": "3 times daily", "duration": "5 days"}
+        for _ in range(200)
+    ])
+    
+    filled = []
+    removed = []
+    
+    def fill(share):
+        # Every prescription is attempted by two threads; only one may dispense it
+        for prescription_id in share:
+            ok, _ = pharmacy.fill_prescription(prescription_id, medication)
+            if ok:
+                filled.append(prescription_id)
+    
+    def remove_stock():
+        for _ in range(25):
+            pharmacy.adjust_medication_stock(medication, "Remove Stock", 3)
+            removed.append(3)
+    
+    shares = [prescriptions[i::4] for i in range(4)]
+    threads = [threading.Thread(target=fill, args=(share,)) for share in shares + shares]
+    threads += [threading.Thread(target=remove_stock) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert sorted(filled) == sorted(prescriptions)
+    stock = database.fetch_one("SELECT stock_quantity FROM Pharmacy WHERE medication_id = ?", (medication,))[0]
+    assert stock == start_stock - len(filled) - sum(removed)
+    assert database.fetch_one("SELECT COUNT(*) FROM Prescriptions WHERE status = 'filled'")[0] == len(prescriptions)
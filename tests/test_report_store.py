@@ -0,0 +1,78 @@
+from datetime import datetime
+import pandas as pd
+import pytest
+import database
+import report_store
+
+def test_parse_schedule_ranges_lists_and_steps():
+    (minutes, hours, days, months, weekdays), restricted = report_store.parse_schedule("0-10/5 1,3 */10 6-8 *")
+    
+    assert minutes == {0, 5, 10}
+    assert hours == {1, 3}
+    assert days == {1, 11, 21, 31}
+    assert months == {6, 7, 8}
+    assert weekdays == set(range(7))
+    assert restricted == (True, False)
+
+def test_parse_schedule_steps_from_a_start_and_sunday_as_seven():
+    (minutes, _, _, _, weekdays), _ = report_store.parse_schedule("5/20 * * * 5-7")
+    
+    assert minutes == {5, 25, 45}
+    assert weekdays == {5, 6, 0}
+
+@pytest.mark.parametrize("schedule", [
+    "* * * *",
+    "60 * * * *",
+    "* 24 * * *",
+    "* * 0 * *",
+    "*/0 * * * *",
+    "10-5 * * * *",
+    "a * * * *",
+])
+def test_parse_schedule_rejects_invalid_schedules(schedule):
+    with pytest.raises(ValueError):
+        report_store.parse_schedule(schedule)
+
+@pytest.mark.parametrize("schedule, after, expected", [
+    # Strictly after, even on a matching minute
+    ("0 * * * *", datetime(2026, 10, 16, 10, 0, 0), datetime(2026, 10, 16, 11, 0)),
+    ("*/15 * * * *", datetime(2026, 10, 16, 10, 7, 30), datetime(2026, 10, 16, 10, 15)),
+    # Weekdays only: Friday evening runs again on Monday
+    ("30 9 * * 1-5", datetime(2026, 10, 16, 10, 0), datetime(2026, 10, 19, 9, 30)),
+    # Across the end of the year
+    ("0 0 1 1 *", datetime(2026, 10, 17), datetime(2027, 1, 1)),
+    # Day of month alone
+    ("0 0 13 * *", datetime(2026, 10, 1), datetime(2026, 10, 13)),
+    # Day of month and day of week together run on either: the 13th or any Friday
+    ("0 0 13 * 5", datetime(2026, 10, 1), datetime(2026, 10, 2)),
+    ("0 0 13 * 5", datetime(2026, 10, 10), datetime(2026, 10, 13)),
+    # Day of week with day of month left as * runs on that weekday only
+    ("0 0 * * 0", datetime(2026, 10, 13), datetime(2026, 10, 18)),
+    # Leap day
+    ("0 12 29 2 *", datetime(2026, 10, 17), datetime(2028, 2, 29, 12, 0)),
+])
+def test_next_run(schedule, after, expected):
+    assert report_store.next_run(schedule, after) == expected
+
+def test_next_run_raises_for_schedules_that_never_run():
+    with pytest.raises(ValueError, match="never runs"):
+        report_store.next_run("0 0 30 2 *", datetime(2026, 10, 17))
+
+def test_refresh_round_trips_through_parquet_and_keeps_recent_snapshots(db, patient, tmp_path, monkeypatch):
+    monkeypatch.setattr(report_store, 'REPORT_STORE_DIR', str(tmp_path / 'snapshots'))
+    monkeypatch.setattr(report_store, 'SNAPSHOTS_KEPT', 2)
+    monkeypatch.setattr(report_store, '_reports', {})
+    report_store.register_report(
+        "Patients by Gender",
+        "SELECT gender, COUNT(*) AS patients, AVG(?) AS weight FROM Patients GROUP BY gender",
+        "0 * * * *",
+        params=(1.5,)
+    )
+    
+    paths = [report_store.refresh_report("Patients by Gender") for _ in range(3)]
+    df, taken_at = report_store.latest_snapshot("Patients by Gender")
+    
+    expected = pd.DataFrame({"gender": ["Male"], "patients": [1], "weight": [1.5]})
+    pd.testing.assert_frame_equal(df, expected)
+    assert [path for _, path in report_store.list_snapshots("Patients by Gender")] == paths[:0:-1]
+    assert report_store.next_refresh("Patients by Gender") == report_store.next_run("0 * * * *", taken_at)
@@ -0,0 +1,57 @@
+import sqlite3
+import threading
+import pytest
+import database
+
+# Counts upwards forever; only the sandbox can stop it
+RUNAWAY_QUERY = "WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n) SELECT COUNT(*) FROM n"
+NUMBERS_QUERY = "WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < 5000) SELECT x, 'row ' || x AS label FROM n"
+
+def test_runaway_query_stops_at_its_time_budget(db):
+    with pytest.raises(sqlite3.OperationalError, match="time budget"):
+        database.run_sandboxed_query(RUNAWAY_QUERY, time_budget=0.2, max_cost=float('inf'))
+
+def test_runaway_query_can_be_cancelled(db):
+    cancel = threading.Event()
+    threading.Timer(0.2, cancel.set).start()
+    
+    with pytest.raises(sqlite3.OperationalError, match="cancelled"):
+        database.run_sandboxed_query(RUNAWAY_QUERY, cancel=cancel, time_budget=60, max_cost=float('inf'))
+
+def test_output_stops_at_the_row_cap(db):
+    result = database.run_sandboxed_query(NUMBERS_QUERY, preview_rows=100, max_rows=1234, max_cost=float('inf'))
+    
+    assert result["truncated"] == "rows"
+    assert result["rows"] == 1234
+    assert len(result["preview"]) == 100
+    assert len(result["csv"].read().decode().splitlines()) == 1234 + 1
+
+def test_output_stops_at_the_byte_cap(db):
+    result = database.run_sandboxed_query(NUMBERS_QUERY, max_bytes=1000, max_cost=float('inf'))
+    csv = result["csv"].read()
+    
+    assert result["truncated"] == "bytes"
+    assert len(csv) == result["bytes"] <= 1000
+    assert csv.decode().endswith("\n")
+
+@pytest.mark.parametrize("query", [
+    "DELETE FROM Patients",
+    "UPDATE Patients SET status = 'inactive'",
+    "ATTACH DATABASE ':memory:' AS other",
+])
+def test_statements_that_are_not_reads_are_refused(db, patient, query):
+    with pytest.raises(sqlite3.OperationalError, match="may only read"):
+        database.run_sandboxed_query(query)
+    
+    assert database.fetch_one("SELECT COUNT(*) FROM Patients WHERE status = 'active'")[0] == 1
+
+def test_user_passwords_read_as_null(db):
+    database.insert_record("Users", {
+        "username": "admin", "password": "secret-hash", "email": "admin@example.com",
+        "full_name": "Admin", "role": "admin",
+    })
+    
+    for query in ("SELECT username, password FROM Users", "SELECT u.password AS p FROM Users u"):
+        preview = database.run_sandboxed_query(query)["preview"]
+        assert preview.iloc[0].isna().tolist()[-1]
+        assert "secret-hash" not in preview.to_string()
@@ -0,0 +1,43 @@
+import statistics
+import threading
+import time
+import database
+
+def test_writer_loses_nothing_under_concurrent_load(db, patient):
+    threads, writes_per_thread = 8, 250
+    latencies = []
+    before = database.get_writer_stats()
+    
+    def write_bills(thread_number):
+        for i in range(writes_per_thread):
+            started = time.perf_counter()
+            database.execute_query(
+                "INSERT INTO Billing (patient_id, service_description, amount) VALUES (?, ?, ?)",
+                (patient, f"thread {thread_number}", i + 1)
+            )
+            latencies.append(time.perf_counter() - started)
+    
+    def read_while_writing():
+        # Readers share the pool with writers and must not hold up the writer
+        for _ in range(200):
+            database.fetch_one("SELECT COUNT(*) FROM Billing")
+    
+    workers = [threading.Thread(target=write_bills, args=(n,)) for n in range(threads)]
+    workers.append(threading.Thread(target=read_while_writing))
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    
+    after = database.get_writer_stats()
+    cuts = statistics.quantiles(latencies, n=100)
+    print(
+        f"\n{len(latencies)} writes in {after['batches'] - before['batches']} batches, "
+        f"p50 {cuts[49] * 1000:.2f} ms, p99 {cuts[98] * 1000:.2f} ms, largest batch {after['max_batch']}"
+    )
+    
+    assert after["failed"] == before["failed"]
+    assert after["queued"] == 0
+    rows = dict(database.fetch_all("SELECT service_description, COUNT(*) FROM Billing GROUP BY 1"))
+    assert rows == {f"thread {n}": writes_per_thread for n in range(threads)}
+    assert database.fetch_one("SELECT SUM(amount) FROM Billing")[0] == threads * writes_per_thread * (writes_per_thread + 1) / 2
@@ -1,4 +1,5 @@
 import streamlit as st
+import database
 from datetime import datetime, timedelta
 
 def format_time_difference(start_time, end_time):
@@ -173,3 +174,90 @@ def mask_pii(text, mask_char='*'):
     
     visible_chars = len(text) // 4
     return text[:visible_chars] + mask_char * (len(text) - 2 * visible_chars) + text[-visible_chars:]
+
+def keyset_pager(key, query, params=None, sort_keys=(), page_size=None, dtypes=None):
+    """
+    Show Previous/Next controls for a list and return its current page, paging by keyset.
+    
+    Args:
+        key (str): Unique name for this list's paging state
+        query (str): The list query, without ORDER BY or LIMIT
+        params (list): Query parameters
+        sort_keys (list): (column, descending) pairs ending with a unique column
+        page_size (int): Rows per page, defaults to database.PAGE_SIZE
+        dtypes (dict): Extra column dtypes, as for database.query_to_dataframe
+    
+    Returns:
+        DataFrame: The rows of the current page
+    """
+    page_size = page_size or database.PAGE_SIZE
+    
+    # Start again from the first page whenever the filters or sort order change
+    state_key = f"{key}_pager"
+    signature = (query, tuple(params or ()), tuple(sort_keys), page_size)
+    state = st.session_state.get(state_key)
+    if state is None or state['signature'] != signature:
+        state = {'signature': signature, 'cursors': [None]}
+        st.session_state[state_key] = state
+    
+    df, last_key, has_more = database.fetch_page(query, params, sort_keys, state['cursors'][-1], page_size, dtypes)
+    total, exact = database.estimate_count(query, params)
+    
+    page_number = len(state['cursors'])
+    first_row = (page_number - 1) * page_size + 1
+    
+    col1, col2, col3 = st.columns([1, 4, 1])
+    
+    with col1:
+        if st.button("Previous", key=f"{key}_previous", disabled=page_number == 1):
+            state['cursors'].pop()
+            st.rerun()
+    
+    with col2:
+        if not df.empty:
+            st.caption(f"Rows {first_row}-{first_row + len(df) - 1} of {total}{'' if exact else '+'}")
+    
+    with col3:
+        if st.button("Next", key=f"{key}_next", disabled=not has_more):
+            state['cursors'].append(last_key)
+            st.rerun()
+    
+    return df
+
+def entity_picker(label, entity, key, default=None, status=None, limit=20):
+    """
+    Searchable select for a patient, doctor or medication that only loads the matches for what is typed.
+    
+    Args:
+        label (str): Label shown above the search box
+        entity (str): 'patient', 'doctor' or 'medication'
+        key (str): Unique widget key
+        default (int): ID selected until the user picks another
+        status (str): Only offer records with this status, e.g. 'active'
+        limit (int): Maximum number of matches offered
+    
+    Returns:
+        int: The selected ID, or None if nothing is selected
+    """
+    # The choice is kept separately so it survives the option list changing as the user types
+    selected_key = f"{key}_selected"
+    current = st.session_state.get(selected_key, default)
+    
+    search_term = st.text_input(label, key=f"{key}_search", placeholder="Type a name or ID to search")
+    
+    matches = dict(database.search_entities(entity, search_term, limit, status))
+    options = [None] + list(matches)
+    if current is not None and current not in matches:
+        options.insert(1, current)
+    
+    selected = st.selectbox(
+        label,
+        options,
+        index=options.index(current) if current in options else 0,
+        format_func=lambda x: f"Select a {entity}" if x is None else matches.get(x) or database.entity_label(entity, x),
+        key=key,
+        label_visibility="collapsed"
+    )
+    
+    st.session_state[selected_key] = selected
+    return selected